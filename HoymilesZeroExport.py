@@ -17,14 +17,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 __author__ = "Tobias Kraft"
-__version__ = "1.104"
+__version__ = "1.129"
 
 import time
 from requests.sessions import Session
 from requests.auth import HTTPBasicAuth
 from requests.auth import HTTPDigestAuth
 from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+import requests
+from urllib.parse import urlsplit
+from urllib3.connection import HTTPConnection
+import socket
+import http.client
 import os
 import logging
 from logging.handlers import TimedRotatingFileHandler
@@ -34,12 +38,23 @@ import sys
 from packaging import version
 import argparse
 import subprocess
-from config_provider import ConfigFileConfigProvider, MqttHandler, ConfigProviderChain
+import threading
+import base64
+import hashlib
+import random
+import math
+import statistics
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from config_provider import ConfigFileConfigProvider, MqttHandler, ConfigProviderChain, HttpApiHandler
+from regulation import CreatePowermeterFilter, GetPowermeterMaxPoint, GetPollSetpoint, CutLimitToProduction, GetSetpoint, ApplyLimitsToSetpoint, IsRelevantLimitChange, AllocateLimit
 import json
 from pyModbusTCP.client import ModbusClient
 import struct
 
-session = Session()
+# all HttpDevice instances, for statistics
+HTTP_DEVICES = []
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
@@ -107,6 +122,11 @@ def CastToInt(pValueToCast):
         raise
 
 def SetLimit(pLimit):
+    # the scheduler thread changes availability and max watt of the inverters under the same lock
+    with CONTROLLER_LOCK:
+        SetLimitLocked(pLimit)
+
+def SetLimitLocked(pLimit):
     try:
         if not hasattr(SetLimit, "LastLimit"):
             SetLimit.LastLimit = CastToInt(0)
@@ -114,6 +134,9 @@ def SetLimit(pLimit):
             SetLimit.LastLimitAck = bool(False)
         if (SetLimit.LastLimit == CastToInt(pLimit)) and SetLimit.LastLimitAck:
             logger.info("Inverterlimit was already accepted at %s Watt",CastToInt(pLimit))
+            # limits held back by the rate limit are sent as soon as they are due, allocated for the current limit
+            if LIMIT_SHAPER.pending:
+                SendInverterLimits(CalculateInverterLimits(CastToInt(pLimit)))
             CrossCheckLimit()
             return
         if (SetLimit.LastLimit == CastToInt(pLimit)) and not SetLimit.LastLimitAck:
@@ -130,94 +153,102 @@ def SetLimit(pLimit):
         else:
             PublishGlobalState("limit", CastToInt(pLimit))
 
-        RemainingLimit = CastToInt(pLimit)
-
-        RemainingLimit -= GetMinWattFromAllInverters()
-
-        # Handle non-battery inverters first
-        if RemainingLimit >= GetMaxWattFromAllNonBatteryInverters() - GetMinWattFromAllNonBatteryInverters():
-            nonBatteryInvertersLimit = GetMaxWattFromAllNonBatteryInverters() - GetMinWattFromAllNonBatteryInverters()
-        else:
-            nonBatteryInvertersLimit = RemainingLimit
-
-        for i in range(INVERTER_COUNT):
-            if not AVAILABLE[i] or HOY_BATTERY_MODE[i]:
-                continue
-
-            # Calculate proportional limit for non-battery inverters
-            NewLimit = CastToInt(nonBatteryInvertersLimit * (HOY_MAX_WATT[i] - GetMinWatt(i)) / (GetMaxWattFromAllNonBatteryInverters() - GetMinWattFromAllNonBatteryInverters()))
-
-            NewLimit += GetMinWatt(i)
-
-            # Apply the calculated limit to the inverter
-            NewLimit = ApplyLimitsToSetpointInverter(i, NewLimit)
-            if HOY_COMPENSATE_WATT_FACTOR[i] != 1:
-                logger.info('Ahoy: Inverter "%s": compensate Limit from %s Watt to %s Watt', NAME[i], CastToInt(NewLimit), CastToInt(NewLimit*HOY_COMPENSATE_WATT_FACTOR[i]))
-                NewLimit = CastToInt(NewLimit * HOY_COMPENSATE_WATT_FACTOR[i])
-                NewLimit = ApplyLimitsToMaxInverterLimits(i, NewLimit)
-
-            if (NewLimit == CastToInt(CURRENT_LIMIT[i])) and LASTLIMITACKNOWLEDGED[i]:
-                logger.info('Inverter "%s": Already at %s Watt',NAME[i],CastToInt(NewLimit))
-                continue
-
-            LASTLIMITACKNOWLEDGED[i] = True
-
-            PublishInverterState(i, "limit", NewLimit)
-            DTU.SetLimit(i, NewLimit)
-            if not DTU.WaitForAck(i, SET_LIMIT_TIMEOUT_SECONDS):
-                SetLimit.LastLimitAck = False
-                LASTLIMITACKNOWLEDGED[i] = False
-
-        # Adjust RemainingLimit based on what was assigned to non-battery inverters
-        RemainingLimit -= nonBatteryInvertersLimit
-
-        # Then handle battery inverters based on priority
-        for j in range(1, 6):
-            batteryMaxWattSamePrio = GetMaxWattFromAllBatteryInvertersSamePrio(j)
-            if batteryMaxWattSamePrio <= 0:
-                continue
-
-            if RemainingLimit >= batteryMaxWattSamePrio - GetMinWattFromAllBatteryInvertersWithSamePriority(j):
-                LimitPrio = batteryMaxWattSamePrio - GetMinWattFromAllBatteryInvertersWithSamePriority(j)
-            else:
-                LimitPrio = RemainingLimit
-
-            for i in range(INVERTER_COUNT):
-                if (not HOY_BATTERY_MODE[i]):
-                    continue
-                if (not AVAILABLE[i]) or (not HOY_BATTERY_GOOD_VOLTAGE[i]):
-                    continue
-                if CONFIG_PROVIDER.get_battery_priority(i) != j:
-                    continue
-
-                # Calculate proportional limit for battery inverters
-                NewLimit = CastToInt(LimitPrio * (HOY_MAX_WATT[i] - GetMinWatt(i)) / (GetMaxWattFromAllBatteryInvertersSamePrio(j) - GetMinWattFromAllBatteryInvertersWithSamePriority(j)))
-                NewLimit += GetMinWatt(i)
-
-                NewLimit = ApplyLimitsToSetpointInverter(i, NewLimit)
-                if HOY_COMPENSATE_WATT_FACTOR[i] != 1:
-                    logger.info('Ahoy: Inverter "%s": compensate Limit from %s Watt to %s Watt', NAME[i], CastToInt(NewLimit), CastToInt(NewLimit*HOY_COMPENSATE_WATT_FACTOR[i]))
-                    NewLimit = CastToInt(NewLimit * HOY_COMPENSATE_WATT_FACTOR[i])
-                    NewLimit = ApplyLimitsToMaxInverterLimits(i, NewLimit)
-
-                if (NewLimit == CastToInt(CURRENT_LIMIT[i])) and LASTLIMITACKNOWLEDGED[i]:
-                    logger.info('Inverter "%s": Already at %s Watt',NAME[i],CastToInt(NewLimit))
-                    continue
-
-                LASTLIMITACKNOWLEDGED[i] = True
-
-                PublishInverterState(i, "limit", NewLimit)
-                DTU.SetLimit(i, NewLimit)
-                if not DTU.WaitForAck(i, SET_LIMIT_TIMEOUT_SECONDS):
-                    SetLimit.LastLimitAck = False
-                    LASTLIMITACKNOWLEDGED[i] = False
-
-            RemainingLimit -= LimitPrio
+        SendInverterLimits(CalculateInverterLimits(CastToInt(pLimit)))
     except:
         logger.error("Exception at SetLimit")
         SetLimit.LastLimitAck = False
         raise
 
+def SetSafeLimit():
+    # called by the watchdog thread: the limit commands are not acknowledged. The locks are not waited for long because
+    # the main thread may be blocked in a DTU request, returns False if they are busy (the watchdog tries again)
+    if not CONTROLLER_LOCK.acquire(timeout=1):
+        logger.info('Watchdog: limit setting is busy, safe limit is retried')
+        return False
+    try:
+        if not DTU_COMMAND_LOCK.acquire(timeout=1):
+            logger.info('Watchdog: DTU is busy, safe limit is retried')
+            return False
+        try:
+            for i in range(INVERTER_COUNT):
+                if not AVAILABLE[i]:
+                    continue
+                try:
+                    logger.info('Inverter "%s": set to safe limit of %s Watt', NAME[i], GetMinWatt(i))
+                    DTU.SetLimit(i, GetMinWatt(i))
+                    LIMIT_SHAPER.ReportCommand(i)
+                except Exception as e:
+                    logger.error('Inverter "%s": safe limit not set: %s', NAME[i], e)
+                # send the regulated limit again as soon as the powermeter is back
+                LASTLIMITACKNOWLEDGED[i] = False
+            SetLimit.LastLimitAck = False
+        finally:
+            DTU_COMMAND_LOCK.release()
+    finally:
+        CONTROLLER_LOCK.release()
+    return True
+
+def SendInverterLimits(pLimits: dict):
+    # pLimits is the complete allocation {inverter id: limit}
+    # drop irrelevant changes, hold back too frequent ones and send the rest at once (in parallel with more than one DTU)
+    Commands = LIMIT_SHAPER.Shape(pLimits)
+    for i, NewLimit in Commands.items():
+        LASTLIMITACKNOWLEDGED[i] = True
+        PublishInverterState(i, "limit", NewLimit)
+
+    with DTU_COMMAND_LOCK:
+        Acks = DTU.SetLimits(Commands, SET_LIMIT_TIMEOUT_SECONDS)
+    for i, ack in Acks.items():
+        if not ack:
+            SetLimit.LastLimitAck = False
+            LASTLIMITACKNOWLEDGED[i] = False
+    if Commands:
+        PRODUCTION.ReportLimits(sum(CURRENT_LIMIT[i] for i in range(INVERTER_COUNT) if AVAILABLE[i] and HOY_BATTERY_GOOD_VOLTAGE[i] and CURRENT_LIMIT[i] >= 0))
+
+def GetAllocationGroups():
+    # non-battery inverters first, then battery inverters by priority 1 (high) ... 5 (low)
+    groups = [[i for i in range(INVERTER_COUNT) if AVAILABLE[i] and not HOY_BATTERY_MODE[i] and HOY_BATTERY_GOOD_VOLTAGE[i]]]
+    for j in range(1, 6):
+        groups.append([i for i in range(INVERTER_COUNT) if AVAILABLE[i] and HOY_BATTERY_MODE[i] and HOY_BATTERY_GOOD_VOLTAGE[i] and CONFIG_PROVIDER.get_battery_priority(i) == j])
+    return [group for group in groups if group]
+
+def GetMaxOutputWatt(pInverter: int):
+    # highest output that can be reached when the compensated limit is clamped to the inverter rating
+    if COMPENSATION is not None and COMPENSATION.IsTrained(pInverter):
+        MaxOutput = COMPENSATION.GetOutput(pInverter, HOY_INVERTER_WATT[pInverter])
+    elif HOY_COMPENSATE_WATT_FACTOR[pInverter] <= 0:
+        return HOY_MAX_WATT[pInverter]
+    else:
+        MaxOutput = HOY_INVERTER_WATT[pInverter] / HOY_COMPENSATE_WATT_FACTOR[pInverter]
+    return max(GetMinWatt(pInverter), min(HOY_MAX_WATT[pInverter], MaxOutput))
+
+def GetCompensatedLimit(pInverter: int, pWatts: int):
+    # limit to send for an output of pWatts: learned compensation or HOY_COMPENSATE_WATT_FACTOR
+    if COMPENSATION is not None and COMPENSATION.IsTrained(pInverter):
+        return CastToInt(round(COMPENSATION.GetLimit(pInverter, pWatts)))
+    return CastToInt(round(pWatts * HOY_COMPENSATE_WATT_FACTOR[pInverter]))
+
+def CalculateInverterLimits(pLimit: int):
+    """
+    Split the total limit on the inverters in one pass: every inverter gets its min watt, the rest fills the groups
+    (non-battery, then battery priority 1..5) one after the other, within a group proportional to the free capacity.
+    The bounds already include the compensation (HOY_COMPENSATE_WATT_FACTOR or learned), so nothing is lost by clamping afterwards and the
+    rounded limits add up to the requested limit. Returns {inverter id: limit to send}.
+    """
+    Groups = GetAllocationGroups()
+    Inverters = [i for group in Groups for i in group]
+    Output = AllocateLimit(pLimit, Groups, {i: GetMinWatt(i) for i in Inverters}, {i: GetMaxOutputWatt(i) for i in Inverters})
+
+    Limits = {}
+    for i in Inverters:
+        NewLimit = Output[i]
+        CompensatedLimit = GetCompensatedLimit(i, NewLimit)
+        if CompensatedLimit != NewLimit:
+            logger.info('Inverter "%s": compensate Limit from %s Watt to %s Watt', NAME[i], NewLimit, CompensatedLimit)
+            NewLimit = ApplyLimitsToMaxInverterLimits(i, CompensatedLimit)
+        Limits[i] = NewLimit
+    return Limits
+
 def ResetInverterData(pInverterId):
     attributes_to_delete = [
         "LastLimit",
@@ -250,22 +281,47 @@ def ResetInverterData(pInverterId):
 def GetHoymilesAvailable():
     try:
         GetHoymilesAvailable = False
-        for i in range(INVERTER_COUNT):
-            try:
-                WasAvail = AVAILABLE[i]
-                AVAILABLE[i] = ENABLED[i] and DTU.GetAvailable(i)
-                if AVAILABLE[i]:
-                    GetHoymilesAvailable = True
-                    if not WasAvail:
-                        ResetInverterData(i)
-                        GetHoymilesInfo()
-            except Exception as e:
-                AVAILABLE[i] = False
-                logger.error("Exception at GetHoymilesAvailable, Inverter %s (%s) not reachable", i, NAME[i])
-                if hasattr(e, 'message'):
-                    logger.error(e.message)
-                else:
-                    logger.error(e)
+        # unreachable inverters are skipped until their backoff has elapsed, they don't cost any cycle time
+        ProbeIds = [i for i in range(INVERTER_COUNT) if ENABLED[i] and AVAILABILITY.IsProbeDue(i)]
+        Results = DTU.GetAvailableBulk(ProbeIds)
+        NewlyAvailable = False
+        # applied under the controller lock, the limit calculation of the main thread must not see a half updated state
+        with CONTROLLER_LOCK:
+            for i in range(INVERTER_COUNT):
+                try:
+                    if i not in Results:
+                        AVAILABLE[i] = False
+                        continue
+                    if isinstance(Results[i], Exception):
+                        raise Results[i]
+                    WasAvail = AVAILABLE[i]
+                    AVAILABLE[i] = bool(Results[i])
+                    if AVAILABLE[i]:
+                        AVAILABILITY.ReportAvailable(i)
+                        GetHoymilesAvailable = True
+                        if not WasAvail:
+                            ResetInverterData(i)
+                            NewlyAvailable = True
+                    else:
+                        AVAILABILITY.ReportUnavailable(i, pDtuReachable=True)
+                except Exception as e:
+                    AVAILABLE[i] = False
+                    AVAILABILITY.ReportUnavailable(i, pDtuReachable=False)
+                    logger.error("Exception at GetHoymilesAvailable, Inverter %s (%s) not reachable", i, NAME[i])
+                    if hasattr(e, 'message'):
+                        logger.error(e.message)
+                    else:
+                        logger.error(e)
+        # one request per inverter, outside of the controller lock
+        if NewlyAvailable:
+            GetHoymilesInfo()
+        # the last AC power before an inverter goes offline detects the sunset, independent of the intermediate meter
+        ACPowers = DTU.GetACPowerBulk([i for i in ProbeIds if AVAILABLE[i]])
+        for i, ACPower in ACPowers.items():
+            if isinstance(ACPower, Exception):
+                logger.error('Inverter "%s": AC power not readable: %s', NAME[i], ACPower)
+                continue
+            AVAILABILITY.ReportACPower(i, ACPower)
         return GetHoymilesAvailable
     except:
         logger.error('Exception at GetHoymilesAvailable')
@@ -328,7 +384,8 @@ def SetHoymilesPowerStatus(pInverterId, pActive):
                 else:
                     logger.info("Retry Counter exceeded: Inverter PowerStatus already OFF")
                 return
-        DTU.SetPowerStatus(pInverterId, pActive)
+        with DTU_COMMAND_LOCK:
+            DTU.SetPowerStatus(pInverterId, pActive)
         time.sleep(SET_POWER_STATUS_DELAY_IN_SECONDS)
     except:
         logger.error("Exception at SetHoymilesPowerStatus")
@@ -357,32 +414,44 @@ def GetCheckBattery():
                     result = True
                     continue
                 minVoltage = GetHoymilesPanelMinVoltage(i)
-
-                if minVoltage <= HOY_BATTERY_THRESHOLD_OFF_LIMIT_IN_V[i]:
-                    SetHoymilesPowerStatus(i, False)
-                    HOY_BATTERY_GOOD_VOLTAGE[i] = False
-                    HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_reduce_wattage(i)
-
-                elif minVoltage <= HOY_BATTERY_THRESHOLD_REDUCE_LIMIT_IN_V[i]:
-                    if HOY_MAX_WATT[i] != CONFIG_PROVIDER.get_reduce_wattage(i):
+                PowerStatus = None
+                ResetToMinLimit = False
+                # only the decision and the state update under the controller lock, the limit calculation of the main thread must not see a half updated state
+                with CONTROLLER_LOCK:
+                    if minVoltage <= HOY_BATTERY_THRESHOLD_OFF_LIMIT_IN_V[i]:
+                        PowerStatus = False
+                        HOY_BATTERY_GOOD_VOLTAGE[i] = False
                         HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_reduce_wattage(i)
-                        SetLimit.LastLimit = -1
-
-                elif minVoltage >= HOY_BATTERY_THRESHOLD_ON_LIMIT_IN_V[i]:
-                    SetHoymilesPowerStatus(i, True)
-                    if not HOY_BATTERY_GOOD_VOLTAGE[i]:
-                        DTU.SetLimit(i, GetMinWatt(i))
-                        DTU.WaitForAck(i, SET_LIMIT_TIMEOUT_SECONDS)
-                        SetLimit.LastLimit = -1
-                    HOY_BATTERY_GOOD_VOLTAGE[i] = True
-                    if (minVoltage >= HOY_BATTERY_THRESHOLD_NORMAL_LIMIT_IN_V[i]) and (HOY_MAX_WATT[i] != CONFIG_PROVIDER.get_normal_wattage(i)):
-                        HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_normal_wattage(i)
-                        SetLimit.LastLimit = -1
-
-                elif minVoltage >= HOY_BATTERY_THRESHOLD_NORMAL_LIMIT_IN_V[i]:
-                    if HOY_MAX_WATT[i] != CONFIG_PROVIDER.get_normal_wattage(i):
-                        HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_normal_wattage(i)
-                        SetLimit.LastLimit = -1
+
+                    elif minVoltage <= HOY_BATTERY_THRESHOLD_REDUCE_LIMIT_IN_V[i]:
+                        if HOY_MAX_WATT[i] != CONFIG_PROVIDER.get_reduce_wattage(i):
+                            HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_reduce_wattage(i)
+                            SetLimit.LastLimit = -1
+
+                    elif minVoltage >= HOY_BATTERY_THRESHOLD_ON_LIMIT_IN_V[i]:
+                        PowerStatus = True
+                        ResetToMinLimit = not HOY_BATTERY_GOOD_VOLTAGE[i]
+                        if (minVoltage >= HOY_BATTERY_THRESHOLD_NORMAL_LIMIT_IN_V[i]) and (HOY_MAX_WATT[i] != CONFIG_PROVIDER.get_normal_wattage(i)):
+                            HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_normal_wattage(i)
+                            SetLimit.LastLimit = -1
+
+                    elif minVoltage >= HOY_BATTERY_THRESHOLD_NORMAL_LIMIT_IN_V[i]:
+                        if HOY_MAX_WATT[i] != CONFIG_PROVIDER.get_normal_wattage(i):
+                            HOY_MAX_WATT[i] = CONFIG_PROVIDER.get_normal_wattage(i)
+                            SetLimit.LastLimit = -1
+
+                # the power status command waits SET_POWER_STATUS_DELAY_IN_SECONDS and the limit waits for the ack: outside of the controller lock
+                if PowerStatus is not None:
+                    SetHoymilesPowerStatus(i, PowerStatus)
+                if PowerStatus:
+                    if ResetToMinLimit:
+                        with DTU_COMMAND_LOCK:
+                            DTU.SetLimit(i, GetMinWatt(i))
+                            DTU.WaitForAck(i, SET_LIMIT_TIMEOUT_SECONDS)
+                    with CONTROLLER_LOCK:
+                        if ResetToMinLimit:
+                            SetLimit.LastLimit = -1
+                        HOY_BATTERY_GOOD_VOLTAGE[i] = True
 
                 if HOY_BATTERY_GOOD_VOLTAGE[i]:
                     result = True
@@ -393,6 +462,93 @@ def GetCheckBattery():
         logger.error("Exception at CheckBattery")
         raise
 
+def IsNight():
+    # all enabled inverters went offline without production
+    EnabledIds = [i for i in range(INVERTER_COUNT) if ENABLED[i]]
+    return len(EnabledIds) > 0 and all(AVAILABILITY.IsNight(i) for i in EnabledIds)
+
+def UpdateHoymilesAvailable():
+    # scheduled task, the main loop only regulates while inverters are available
+    global HOYMILES_AVAILABLE
+    HOYMILES_AVAILABLE = GetHoymilesAvailable()
+
+def UpdateCheckBattery():
+    # scheduled task, the main loop only regulates while a non-battery inverter is available or a battery is good
+    global BATTERY_GOOD
+    BATTERY_GOOD = GetCheckBattery()
+
+def GetCheckpointState():
+    return {
+        "version": __version__,
+        "serials": SERIAL_NUMBER,
+        "limit": SetLimit.LastLimit if hasattr(SetLimit, "LastLimit") else None,
+        "battery_good": BATTERY_GOOD,
+        "inverters": [{
+            "name": NAME[i],
+            "current_limit": CURRENT_LIMIT[i],
+            "max_watt": HOY_MAX_WATT[i],
+            "battery_good_voltage": HOY_BATTERY_GOOD_VOLTAGE[i],
+            "panel_min_voltage_history": HOY_PANEL_MIN_VOLTAGE_HISTORY_LIST[i]
+        } for i in range(INVERTER_COUNT)],
+        "compensation": COMPENSATION.GetState() if COMPENSATION is not None else None
+    }
+
+def SaveCheckpoint():
+    # scheduled task
+    if not HOYMILES_AVAILABLE or not hasattr(SetLimit, "LastLimit") or SetLimit.LastLimit < 0:
+        return
+    CHECKPOINT.Save(GetCheckpointState())
+
+def WarmStart():
+    # restores the last checkpoint and verifies it against the DTU (availability and limits of all inverters in one bulk read each).
+    # Returns False if a cold start is needed.
+    global HOYMILES_AVAILABLE, BATTERY_GOOD
+    State = CHECKPOINT.Load()
+    if State is None:
+        return False
+    Serials = State.get("serials", [])
+    # serial numbers not configured were read from the DTU
+    if len(Serials) != INVERTER_COUNT or any(SERIAL_NUMBER[i] not in ('', Serials[i]) for i in range(INVERTER_COUNT)) or State.get("limit") is None:
+        logger.info('Checkpoint: inverters changed, cold start')
+        return False
+    for i in range(INVERTER_COUNT):
+        SERIAL_NUMBER[i] = Serials[i]
+    EnabledIds = [i for i in range(INVERTER_COUNT) if ENABLED[i]]
+    Available = DTU.GetAvailableBulk(EnabledIds)
+    AvailableIds = [i for i in EnabledIds if i in Available and not isinstance(Available[i], Exception) and Available[i]]
+    if not AvailableIds:
+        logger.info('Checkpoint: no inverter available, cold start')
+        return False
+    Limits = DTU.GetActualLimitsBulk(AvailableIds)
+    for i in range(INVERTER_COUNT):
+        Inverter = State["inverters"][i]
+        NAME[i] = Inverter["name"]
+        CURRENT_LIMIT[i] = Inverter["current_limit"]
+        HOY_MAX_WATT[i] = Inverter["max_watt"]
+        HOY_BATTERY_GOOD_VOLTAGE[i] = Inverter["battery_good_voltage"]
+        HOY_PANEL_MIN_VOLTAGE_HISTORY_LIST[i] = Inverter["panel_min_voltage_history"]
+    if COMPENSATION is not None and State.get("compensation"):
+        COMPENSATION.SetState(State["compensation"])
+    SetLimit.LastLimit = State["limit"]
+    SetLimit.LastLimitAck = True
+    for i in EnabledIds:
+        if i not in AvailableIds:
+            AVAILABILITY.ReportUnavailable(i, pDtuReachable=not isinstance(Available.get(i), Exception))
+            continue
+        AVAILABLE[i] = True
+        AVAILABILITY.ReportAvailable(i)
+        DTULimitInW = Limits.get(i)
+        # same tolerance as CrossCheckLimit
+        LASTLIMITACKNOWLEDGED[i] = not isinstance(DTULimitInW, Exception) and abs(DTULimitInW - CURRENT_LIMIT[i]) < HOY_INVERTER_WATT[i] * 0.05
+        if not LASTLIMITACKNOWLEDGED[i]:
+            # sent again by the first SetLimit
+            SetLimit.LastLimitAck = False
+            logger.info('Checkpoint: Inverter "%s": DTU limit (%s) <> checkpoint (%s)', NAME[i], DTULimitInW, CURRENT_LIMIT[i])
+    HOYMILES_AVAILABLE = True
+    BATTERY_GOOD = State["battery_good"]
+    logger.info('Checkpoint: warm start with limit %s Watt, %s of %s inverters available', SetLimit.LastLimit, len(AvailableIds), len(EnabledIds))
+    return True
+
 def GetHoymilesTemperature():
     try:
         for i in range(INVERTER_COUNT):
@@ -406,10 +562,19 @@ def GetHoymilesTemperature():
 
 def GetHoymilesActualPower():
     try:
+        # several reads within PRODUCTION_ESTIMATE_MAX_AGE_IN_SECONDS share one measurement
+        if PRODUCTION.IsFresh():
+            Watts, Confidence = PRODUCTION.GetEstimate()
+            return Watts
         try:
             Watts = abs(INTERMEDIATE_POWERMETER.GetPowermeterWatts())
             logger.info(f"intermediate meter {INTERMEDIATE_POWERMETER.__class__.__name__}: {Watts} Watt")
-            return Watts
+            # the DTU reports every inverter itself, a separate meter only measures a single inverter
+            ActiveIds = [i for i in range(INVERTER_COUNT) if AVAILABLE[i] and HOY_BATTERY_GOOD_VOLTAGE[i]]
+            if COMPENSATION is not None and INTERMEDIATE_POWERMETER is not DTU and len(ActiveIds) == 1:
+                COMPENSATION.AddSample(ActiveIds[0], Watts)
+            # the DTU values lag behind the real output by several seconds
+            Watts, Confidence = PRODUCTION.Update(Watts, INTERMEDIATE_POWERMETER.__class__.__name__, 0.7 if INTERMEDIATE_POWERMETER is DTU else 1.0)
         except Exception as e:
             logger.error("Exception at GetHoymilesActualPower")
             if hasattr(e, 'message'):
@@ -419,42 +584,52 @@ def GetHoymilesActualPower():
             logger.error("try reading actual power from DTU:")
             Watts = DTU.GetPowermeterWatts()
             logger.info(f"intermediate meter {DTU.__class__.__name__}: {Watts} Watt")
+            Watts, Confidence = PRODUCTION.Update(Watts, DTU.__class__.__name__, 0.7)
+        if Confidence < 0.5:
+            logger.info('production estimate: %s Watt (limited by the last commanded limits)', Watts)
+        return Watts
     except:
         logger.error("Exception at GetHoymilesActualPower")
-        if SET_INVERTER_TO_MIN_ON_POWERMETER_ERROR:
-            SetLimit(0)
+        # runs on the METER_EXECUTOR in parallel to the grid powermeter read: a production read error is no powermeter error for the watchdog
         raise
 
 def GetPowermeterWatts():
     try:
+        CONTROLLER.ReportMeterReadStart()
         Watts = POWERMETER.GetPowermeterWatts()
-        logger.info(f"powermeter {POWERMETER.__class__.__name__}: {Watts} Watt")
+        if POWERMETER_FILTER is not None:
+            RawWatts = Watts
+            Watts = POWERMETER_FILTER.Apply(RawWatts)
+            logger.info(f"powermeter {POWERMETER.__class__.__name__}: {RawWatts} Watt (filtered: {Watts} Watt)")
+        else:
+            logger.info(f"powermeter {POWERMETER.__class__.__name__}: {Watts} Watt")
+        CONTROLLER.ReportMeterReading()
         return Watts
     except:
         logger.error("Exception at GetPowermeterWatts")
-        if SET_INVERTER_TO_MIN_ON_POWERMETER_ERROR:
-            SetLimit(0)
+        # the watchdog sets the safe limit (SET_INVERTER_TO_MIN_ON_POWERMETER_ERROR, WATCHDOG_TIMEOUT_IN_SECONDS)
+        CONTROLLER.ReportMeterError()
         raise
 
 def GetMinWatt(pInverter: int):
     min_watt_percent = CONFIG_PROVIDER.get_min_wattage_in_percent(pInverter)
     return int(HOY_INVERTER_WATT[pInverter] * min_watt_percent / 100)
 
-def CutLimitToProduction(pSetpoint):
-    if pSetpoint != GetMaxWattFromAllInverters():
-        ActualPower = GetHoymilesActualPower()
-        # prevent the setpoint from running away...
-        if pSetpoint > ActualPower + (GetMaxWattFromAllInverters() * MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER / 100):
-            pSetpoint = CastToInt(ActualPower + (GetMaxWattFromAllInverters() * MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER / 100))
-            logger.info('Cut limit to %s Watt, limit was higher than %s percent of live-production', CastToInt(pSetpoint), MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER)
-    return CastToInt(pSetpoint)
-
-def ApplyLimitsToSetpoint(pSetpoint):
-    if pSetpoint > GetMaxWattFromAllInverters():
-        pSetpoint = GetMaxWattFromAllInverters()
-    if pSetpoint < GetMinWattFromAllInverters():
-        pSetpoint = GetMinWattFromAllInverters()
-    return pSetpoint
+def ReadTimed(pFunction):
+    # returns the value and the time of the reading (middle of the request)
+    Start = time.monotonic()
+    Value = pFunction()
+    return Value, (Start + time.monotonic()) / 2
+
+def GetMeterSample(pReadProduction: bool):
+    # read the grid powermeter and (if needed) the output of the inverters at the same time, their latencies don't add up
+    Production = METER_EXECUTOR.submit(ReadTimed, GetHoymilesActualPower) if pReadProduction else None
+    Watts, Timestamp = ReadTimed(GetPowermeterWatts)
+    if Production is None:
+        return MeterSample(Watts, Timestamp)
+    ProductionWatts, ProductionTimestamp = Production.result()
+    # a cached production estimate is as old as its reading
+    return MeterSample(Watts, Timestamp, ProductionWatts, min(ProductionTimestamp, PRODUCTION.timestamp))
 
 def ApplyLimitsToSetpointInverter(pInverter, pSetpoint):
     if pSetpoint > HOY_MAX_WATT[pInverter]:
@@ -479,7 +654,8 @@ def CrossCheckLimit():
                 LimitMin = float(CURRENT_LIMIT[i] - HOY_INVERTER_WATT[i] * 0.05)
                 if not (min(LimitMax, LimitMin) < DTULimitInW < max(LimitMax, LimitMin)):
                     logger.info('CrossCheckLimit: DTU ( %s ) <> SetLimit ( %s ). Resend limit to DTU', "{:.1f}".format(DTULimitInW), "{:.1f}".format(CURRENT_LIMIT[i]))
-                    DTU.SetLimit(i, CURRENT_LIMIT[i])
+                    with DTU_COMMAND_LOCK:
+                        DTU.SetLimit(i, CURRENT_LIMIT[i])
     except:
         logger.error("Exception at CrossCheckLimit")
         raise
@@ -567,11 +743,850 @@ def PublishGlobalState(state_name, state_value):
         return
     MQTT.publish_state(state_name, state_value)
 
+def PublishSnapshot(pSetpoint, pPowermeterWatts, pCycleTime):
+    # serialized once per loop cycle, the HTTP API serves it from memory
+    if HTTP_API is None:
+        return
+    ProductionWatts, ProductionConfidence = PRODUCTION.GetEstimate()
+    HTTP_API.publish_snapshot({
+        "version": __version__,
+        "timestamp": time.time(),
+        "state": CONTROLLER.state,
+        "time_in_state": CONTROLLER.GetTimeInState(),
+        "setpoint": CastToInt(pSetpoint),
+        "powermeter_watts": pPowermeterWatts,
+        "powermeter_age_s": round(CONTROLLER.GetMeterAge(), 1),
+        "production_watts": ProductionWatts,
+        "production_confidence": ProductionConfidence,
+        "cycle_time_s": round(pCycleTime, 3),
+        "loop_interval_s": LOOP_INTERVAL_IN_SECONDS,
+        "poll_interval_s": POLL_INTERVAL_IN_SECONDS,
+        "limit_commands": {"sent": LIMIT_SHAPER.sent_count, "suppressed": LIMIT_SHAPER.suppressed_count},
+        "powermeter_filter": POWERMETER_FILTER.GetStatistics() if POWERMETER_FILTER is not None else None,
+        "powermeter_sources": POWERMETER.GetStatistics() if isinstance(POWERMETER, RedundantPowermeter) else None,
+        "inverters": [{
+            "name": NAME[i],
+            "serial": SERIAL_NUMBER[i],
+            "enabled": ENABLED[i],
+            "available": AVAILABLE[i],
+            "night": AVAILABILITY.IsNight(i),
+            "limit": CastToInt(CURRENT_LIMIT[i]),
+            "limit_acknowledged": LASTLIMITACKNOWLEDGED[i],
+            "max_watt": HOY_MAX_WATT[i],
+            "battery_good_voltage": HOY_BATTERY_GOOD_VOLTAGE[i],
+            "temperature": TEMPERATURE[i],
+            "compensation": COMPENSATION.GetStatistics(i) if COMPENSATION is not None else None
+        } for i in range(INVERTER_COUNT)],
+        "http": {Device.name: Device.GetStatistics() for Device in HTTP_DEVICES}
+    })
+
 def PublishInverterState(inverter_idx, state_name, state_value):
     if MQTT is None:
         return
     MQTT.publish_inverter_state(inverter_idx, state_name, state_value)
 
+class LimitCommandShaper:
+    """
+    Every limit command costs a set-and-ack round trip over the DTU radio. This stage sits between the limit allocation and the DTU:
+    - changes the DTU can't resolve (e.g. OpenDTU only sends whole percent of the inverter rating) are dropped
+    - changes smaller than min_step_watt are dropped, except to reach the min or max limit of the inverter
+    - within min_interval_in_s after the last command to an inverter a new limit is held back, a newer allocation replaces it
+    Shape gets the complete allocation, a held back limit is dropped when the inverter is already at its newer limit.
+    """
+    def __init__(self, inverter_count: int, min_step_watt: int, min_interval_in_s: float):
+        self.min_step_watt = min_step_watt
+        self.min_interval_in_s = min_interval_in_s
+        self.pending = {}
+        self.last_command = [None for i in range(inverter_count)]
+        self.sent_count = 0
+        self.suppressed_count = 0
+
+    def IsRelevant(self, pInverterId: int, pLimit: int):
+        CurrentLimit = CURRENT_LIMIT[pInverterId]
+        if CurrentLimit < 0 or not LASTLIMITACKNOWLEDGED[pInverterId]:
+            return True
+        # compensated limits are clamped to HOY_INVERTER_WATT (ApplyLimitsToMaxInverterLimits), not to HOY_MAX_WATT
+        return IsRelevantLimitChange(pLimit, CurrentLimit, DTU.GetLimitResolution(pInverterId), GetMinWatt(pInverterId), HOY_INVERTER_WATT[pInverterId], self.min_step_watt)
+
+    def Shape(self, pLimits: dict):
+        # the newer allocation replaces the held back limits
+        self.pending = {}
+        Commands = {}
+        Now = time.monotonic()
+        for i, Limit in pLimits.items():
+            if Limit == CastToInt(CURRENT_LIMIT[i]) and LASTLIMITACKNOWLEDGED[i]:
+                logger.info('Inverter "%s": Already at %s Watt', NAME[i], Limit)
+                continue
+            if not self.IsRelevant(i, Limit):
+                logger.info('Inverter "%s": limit change from %s Watt to %s Watt is too small, not sent', NAME[i], CastToInt(CURRENT_LIMIT[i]), Limit)
+                self.suppressed_count += 1
+                continue
+            if self.last_command[i] is not None and Now - self.last_command[i] < self.min_interval_in_s:
+                logger.info('Inverter "%s": limit %s Watt held back, last command was less than %s seconds ago', NAME[i], Limit, self.min_interval_in_s)
+                self.pending[i] = Limit
+                continue
+            Commands[i] = Limit
+            self.last_command[i] = Now
+            self.sent_count += 1
+        return Commands
+
+    def ReportCommand(self, pInverterId: int):
+        # a limit sent outside of Shape (safe limit of the watchdog)
+        self.pending.pop(pInverterId, None)
+        self.last_command[pInverterId] = time.monotonic()
+        self.sent_count += 1
+
+class ProductionEstimate:
+    """
+    Cached estimate of the current output of all inverters with timestamp and confidence.
+    Fuses the intermediate meter (or DTU AC power) with the limits commanded afterwards:
+    a lower limit sent after the measurement caps the estimate, the inverters are about to follow it.
+    """
+    def __init__(self, max_age_in_s: float):
+        self.max_age_in_s = max_age_in_s
+        self.watts = None
+        self.source = None
+        self.confidence = 0.0
+        self.timestamp = None
+        self.limit_sum = None
+        self.limit_timestamp = None
+
+    def Update(self, pWatts: int, pSource: str, pConfidence: float):
+        self.watts = pWatts
+        self.source = pSource
+        self.confidence = pConfidence
+        self.timestamp = time.monotonic()
+        return self.GetEstimate()
+
+    def ReportLimits(self, pLimitSum: int):
+        self.limit_sum = pLimitSum
+        self.limit_timestamp = time.monotonic()
+
+    def IsFresh(self):
+        return self.timestamp is not None and time.monotonic() - self.timestamp <= self.max_age_in_s
+
+    def GetEstimate(self):
+        if self.watts is None:
+            return None, 0.0
+        if self.limit_timestamp is not None and self.limit_timestamp > self.timestamp and self.limit_sum < self.watts:
+            return self.limit_sum, self.confidence / 2
+        return self.watts, self.confidence
+
+class CompensationEstimator:
+    """
+    Learns the relation between the limit sent to an inverter and its AC output (HOY_COMPENSATE_WATT_FACTOR) online:
+    output = offset + gain * limit / HOY_INVERTER_WATT, per inverter by recursive least squares with forgetting factor,
+    starting at the configured HOY_COMPENSATE_WATT_FACTOR. A sample is only used when the limit was acknowledged and
+    unchanged for settle_time_in_s and the output is within max_deviation_percent of the prediction, an output far
+    below the limit means not enough sun or battery power, not a wrong factor.
+    """
+    def __init__(self, forgetting_factor: float, min_samples: int, settle_time_in_s: float, max_deviation_percent: float):
+        self.forgetting_factor = forgetting_factor
+        self.min_samples = min_samples
+        self.settle_time_in_s = settle_time_in_s
+        self.max_deviation_percent = max_deviation_percent
+        self.theta = []
+        self.covariance = []
+        self.initial_covariance = []
+        self.samples = []
+        self.rejected = []
+        self.limit = []
+        self.limit_timestamp = []
+        for i in range(INVERTER_COUNT):
+            Gain = HOY_INVERTER_WATT[i] / HOY_COMPENSATE_WATT_FACTOR[i] if HOY_COMPENSATE_WATT_FACTOR[i] > 0 else HOY_INVERTER_WATT[i]
+            # assigned as a whole, the main loop reads it while the meter thread updates it
+            self.theta.append((0.0, Gain))
+            # prior uncertainty: offset +-50 Watt, gain +-30 %
+            self.initial_covariance.append([[50.0 ** 2, 0.0], [0.0, (Gain * 0.3) ** 2]])
+            self.covariance.append([row[:] for row in self.initial_covariance[i]])
+            self.samples.append(0)
+            self.rejected.append(0)
+            self.limit.append(None)
+            self.limit_timestamp.append(0)
+
+    def IsTrained(self, pInverterId: int):
+        return self.samples[pInverterId] >= self.min_samples and self.theta[pInverterId][1] > 0
+
+    def GetOutput(self, pInverterId: int, pLimit: float):
+        Offset, Gain = self.theta[pInverterId]
+        return Offset + Gain * pLimit / HOY_INVERTER_WATT[pInverterId]
+
+    def GetLimit(self, pInverterId: int, pWatts: float):
+        Offset, Gain = self.theta[pInverterId]
+        return (pWatts - Offset) / Gain * HOY_INVERTER_WATT[pInverterId]
+
+    def AddSample(self, pInverterId: int, pWatts: int):
+        Limit = CURRENT_LIMIT[pInverterId]
+        Now = time.monotonic()
+        if Limit != self.limit[pInverterId]:
+            self.limit[pInverterId] = Limit
+            self.limit_timestamp[pInverterId] = Now
+            return
+        if Limit <= 0 or not LASTLIMITACKNOWLEDGED[pInverterId] or Now - self.limit_timestamp[pInverterId] < self.settle_time_in_s:
+            return
+        Predicted = self.GetOutput(pInverterId, Limit)
+        if abs(pWatts - Predicted) > max(Predicted, GetMinWatt(pInverterId)) * self.max_deviation_percent / 100:
+            self.rejected[pInverterId] += 1
+            return
+        X = [1.0, Limit / HOY_INVERTER_WATT[pInverterId]]
+        P = self.covariance[pInverterId]
+        PX = [P[0][0] * X[0] + P[0][1] * X[1], P[1][0] * X[0] + P[1][1] * X[1]]
+        Denominator = self.forgetting_factor + X[0] * PX[0] + X[1] * PX[1]
+        K = [PX[0] / Denominator, PX[1] / Denominator]
+        Error = pWatts - Predicted
+        Offset, Gain = self.theta[pInverterId]
+        self.theta[pInverterId] = (Offset + K[0] * Error, Gain + K[1] * Error)
+        P = [[(P[r][c] - K[r] * PX[c]) / self.forgetting_factor for c in range(2)] for r in range(2)]
+        # without new information (constant limit) the forgetting factor would let the covariance grow without bound
+        Trace = P[0][0] + P[1][1]
+        InitialTrace = self.initial_covariance[pInverterId][0][0] + self.initial_covariance[pInverterId][1][1]
+        if Trace > InitialTrace:
+            P = [[value * InitialTrace / Trace for value in row] for row in P]
+        self.covariance[pInverterId] = P
+        self.samples[pInverterId] += 1
+        if self.samples[pInverterId] == self.min_samples:
+            logger.info('Inverter "%s": compensation learned, factor %s (configured %s)', NAME[pInverterId], self.GetFactor(pInverterId), HOY_COMPENSATE_WATT_FACTOR[pInverterId])
+
+    def GetFactor(self, pInverterId: int):
+        # limit / output at HOY_MAX_WATT output, comparable to HOY_COMPENSATE_WATT_FACTOR
+        return round(self.GetLimit(pInverterId, HOY_MAX_WATT[pInverterId]) / HOY_MAX_WATT[pInverterId], 3)
+
+    def GetStatistics(self, pInverterId: int):
+        return {
+            "trained": self.IsTrained(pInverterId),
+            "factor": self.GetFactor(pInverterId),
+            "offset_watt": round(self.theta[pInverterId][0], 1),
+            "samples": self.samples[pInverterId],
+            "rejected": self.rejected[pInverterId]
+        }
+
+    def GetState(self):
+        return [{"theta": list(self.theta[i]), "covariance": self.covariance[i], "samples": self.samples[i]} for i in range(INVERTER_COUNT)]
+
+    def SetState(self, pState: list):
+        for i, Inverter in enumerate(pState[:INVERTER_COUNT]):
+            self.theta[i] = tuple(Inverter["theta"])
+            self.covariance[i] = Inverter["covariance"]
+            self.samples[i] = Inverter["samples"]
+
+class MeterSample:
+    """
+    Time aligned pair of the grid powermeter and the output of the inverters, each with the (monotonic) time of its reading.
+    """
+    def __init__(self, grid_watts: int, grid_timestamp: float, production_watts: int = None, production_timestamp: float = None):
+        self.grid_watts = grid_watts
+        self.grid_timestamp = grid_timestamp
+        self.production_watts = production_watts
+        self.production_timestamp = production_timestamp
+
+    def GetSkew(self):
+        # time between the two readings in seconds
+        if self.production_timestamp is None:
+            return None
+        return abs(self.grid_timestamp - self.production_timestamp)
+
+class CircuitBreakerOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a device after too many consecutive failures.
+    After the reset time one trial request is let through, if it succeeds the circuit is closed again.
+    """
+    def __init__(self, name: str, failure_threshold: int, reset_timeout_in_s: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_in_s = reset_timeout_in_s
+        self.failure_count = 0
+        self.opened_at = None
+
+    def IsOpen(self):
+        if self.opened_at is None:
+            return False
+        # half-open: let the next request through as a trial
+        return time.monotonic() - self.opened_at < self.reset_timeout_in_s
+
+    def RecordSuccess(self):
+        if self.opened_at is not None:
+            logger.info('%s: connection recovered, circuit breaker closed', self.name)
+        self.failure_count = 0
+        self.opened_at = None
+
+    def RecordFailure(self):
+        self.failure_count += 1
+        if self.failure_threshold > 0 and self.failure_count >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error('%s: %s consecutive request errors, suspend requests for %s seconds', self.name, self.failure_count, self.reset_timeout_in_s)
+            self.opened_at = time.monotonic()
+
+    def Call(self, pFunction, *args, **kwargs):
+        if self.IsOpen():
+            raise CircuitBreakerOpenError(f"{self.name}: circuit breaker open, request suspended")
+        try:
+            result = pFunction(*args, **kwargs)
+        except Exception:
+            self.RecordFailure()
+            raise
+        self.RecordSuccess()
+        return result
+
+class SunPosition:
+    """
+    Offline sun position (no internet service needed), accurate to a few tenths of a degree:
+    the sun is "up" if its elevation at the configured location is above elevation_threshold.
+    """
+    def __init__(self, latitude: float, longitude: float, elevation_threshold: float):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.elevation_threshold = elevation_threshold
+
+    def GetElevation(self, pTimestamp: float = None):
+        if pTimestamp is None:
+            pTimestamp = time.time()
+        # days since J2000.0 (2000-01-01 12:00 UTC)
+        Days = (pTimestamp - 946728000) / 86400
+        MeanAnomaly = math.radians(357.529 + 0.98560028 * Days)
+        MeanLongitude = 280.459 + 0.98564736 * Days
+        EclipticLongitude = math.radians(MeanLongitude + 1.915 * math.sin(MeanAnomaly) + 0.020 * math.sin(2 * MeanAnomaly))
+        Obliquity = math.radians(23.439 - 0.00000036 * Days)
+        RightAscension = math.atan2(math.cos(Obliquity) * math.sin(EclipticLongitude), math.cos(EclipticLongitude))
+        Declination = math.asin(math.sin(Obliquity) * math.sin(EclipticLongitude))
+        SiderealTime = math.radians((280.46061837 + 360.98564736629 * Days + self.longitude) % 360)
+        HourAngle = SiderealTime - RightAscension
+        Latitude = math.radians(self.latitude)
+        return math.degrees(math.asin(math.sin(Latitude) * math.sin(Declination) + math.cos(Latitude) * math.cos(Declination) * math.cos(HourAngle)))
+
+    def IsUp(self, pTimestamp: float = None):
+        return self.GetElevation(pTimestamp) > self.elevation_threshold
+
+    def GetSecondsUntilUp(self):
+        # 5 minute steps are accurate enough for a probe schedule
+        Now = time.time()
+        for Seconds in range(0, 86400, 300):
+            if self.IsUp(Now + Seconds):
+                return Seconds
+        return 86400
+
+class InverterAvailability:
+    """
+    Health state of every inverter. Unreachable inverters are re-probed with exponential backoff,
+    inverters that went offline without production (sunset) are only probed every backoff_max_in_s.
+    With a location (sun) the night is also detected by the sun position, the inverters are not probed until sunrise
+    and then every backoff_min_in_s until they are back.
+    """
+    def __init__(self, inverter_count: int, backoff_min_in_s: float, backoff_max_in_s: float, sunset_power_threshold: int, sun: SunPosition = None):
+        self.backoff_min_in_s = backoff_min_in_s
+        self.backoff_max_in_s = backoff_max_in_s
+        self.sunset_power_threshold = sunset_power_threshold
+        self.sun = sun
+        # a wrong location or clock must not keep the inverters off all day
+        self.night_max_delay_in_s = 3600
+        self.failure_count = [0 for i in range(inverter_count)]
+        self.next_probe = [0.0 for i in range(inverter_count)]
+        self.night = [False for i in range(inverter_count)]
+        self.last_ac_power = [None for i in range(inverter_count)]
+
+    def GetNightProbeDelay(self):
+        if self.sun is None:
+            return self.backoff_max_in_s
+        if self.sun.IsUp():
+            # sunrise: wake up quickly
+            return self.backoff_min_in_s
+        return min(max(self.sun.GetSecondsUntilUp(), self.backoff_min_in_s), self.night_max_delay_in_s)
+
+    def IsProbeDue(self, pInverterId: int):
+        return time.monotonic() >= self.next_probe[pInverterId]
+
+    def IsNight(self, pInverterId: int):
+        return self.night[pInverterId]
+
+    def ReportACPower(self, pInverterId: int, pWatts: int):
+        self.last_ac_power[pInverterId] = pWatts
+
+    def ReportAvailable(self, pInverterId: int):
+        if self.night[pInverterId]:
+            logger.info('Inverter "%s": sunrise detected, inverter is available again', NAME[pInverterId])
+        elif self.failure_count[pInverterId] > 0:
+            logger.info('Inverter "%s": available again after %s failed probes', NAME[pInverterId], self.failure_count[pInverterId])
+        self.failure_count[pInverterId] = 0
+        self.next_probe[pInverterId] = 0.0
+        self.night[pInverterId] = False
+
+    def ReportUnavailable(self, pInverterId: int, pDtuReachable: bool):
+        self.failure_count[pInverterId] += 1
+        LastPower = self.last_ac_power[pInverterId]
+        # the DTU answered but the inverter is gone and it was not producing anymore: the sun went down
+        if pDtuReachable and not self.night[pInverterId] and LastPower is not None and LastPower <= self.sunset_power_threshold:
+            logger.info('Inverter "%s": sunset detected (last AC power %s Watt)', NAME[pInverterId], LastPower)
+            self.night[pInverterId] = True
+        elif pDtuReachable and not self.night[pInverterId] and self.sun is not None and not self.sun.IsUp():
+            logger.info('Inverter "%s": sunset detected (sun elevation %s degree)', NAME[pInverterId], round(self.sun.GetElevation(), 1))
+            self.night[pInverterId] = True
+        if self.night[pInverterId]:
+            Delay = self.GetNightProbeDelay()
+        else:
+            Delay = min(self.backoff_min_in_s * 2 ** (self.failure_count[pInverterId] - 1), self.backoff_max_in_s)
+        self.next_probe[pInverterId] = time.monotonic() + Delay
+        logger.info('Inverter "%s": not available, next probe in %s seconds', NAME[pInverterId], Delay)
+
+class PollTimer:
+    """
+    Fixed rate powermeter polling within one loop interval, based on the monotonic clock (no jumps by NTP).
+    The time a reading took is subtracted from the wait, so the poll rate doesn't drift with the read latency.
+    """
+    def __init__(self, poll_interval_in_s: float):
+        self.poll_interval_in_s = poll_interval_in_s
+        self.next_poll = 0.0
+        self.deadline = 0.0
+
+    def Start(self, pLoopIntervalInS: float):
+        Now = time.monotonic()
+        self.next_poll = Now + self.poll_interval_in_s
+        self.deadline = Now + pLoopIntervalInS
+
+    def SleepUntil(self, pTime: float):
+        Delay = pTime - time.monotonic()
+        if Delay > 0:
+            time.sleep(Delay)
+
+    def IsLastPoll(self):
+        # True if the loop interval is over before the next poll
+        return max(self.next_poll, time.monotonic()) >= self.deadline - 0.001
+
+    def WaitForNextPoll(self):
+        # returns False if the loop interval is over before the next poll
+        Now = time.monotonic()
+        if self.next_poll < Now:
+            # the reading took longer than the poll interval: poll again right away
+            self.next_poll = Now
+        if self.next_poll >= self.deadline - 0.001:
+            self.SleepUntil(self.deadline)
+            return False
+        self.SleepUntil(self.next_poll)
+        self.next_poll += self.poll_interval_in_s
+        return True
+
+    def WaitForLoopEnd(self):
+        self.SleepUntil(self.deadline)
+
+class ScheduledTask:
+    def __init__(self, name: str, period_in_s: float, function):
+        self.name = name
+        self.period_in_s = period_in_s
+        self.function = function
+        self.next_run = 0.0
+        self.run_count = 0
+        self.last_duration_in_s = 0.0
+
+class TaskScheduler:
+    """
+    Runs the slow periodic tasks (availability, battery voltage, temperature) in a background thread, every task at its own period.
+    The powermeter polling and limit setting of the main loop is never delayed by them.
+    The periods are varied by a random jitter, so tasks with the same period don't hit the DTU at the same time.
+    """
+    def __init__(self, jitter_in_percent: float):
+        self.jitter = max(0.0, jitter_in_percent) / 100
+        self.tasks = []
+        self.thread = None
+
+    def AddTask(self, pName: str, pPeriodInS: float, pFunction):
+        Task = ScheduledTask(pName, pPeriodInS, pFunction)
+        Task.next_run = self.GetNextRun(Task, time.monotonic())
+        self.tasks.append(Task)
+
+    def GetNextRun(self, pTask: ScheduledTask, pNow: float):
+        return pNow + pTask.period_in_s * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def Start(self):
+        if not self.tasks:
+            return
+        for Task in self.tasks:
+            logger.info('Scheduler: task "%s" every %s seconds', Task.name, Task.period_in_s)
+        self.thread = threading.Thread(target=self.Run, daemon=True)
+        self.thread.start()
+
+    def Run(self):
+        while True:
+            Task = min(self.tasks, key=lambda task: task.next_run)
+            Delay = Task.next_run - time.monotonic()
+            if Delay > 0:
+                time.sleep(Delay)
+            Start = time.monotonic()
+            try:
+                Task.function()
+            except Exception as e:
+                logger.error('Scheduler: exception at task "%s": %s', Task.name, e)
+            End = time.monotonic()
+            Task.run_count += 1
+            Task.last_duration_in_s = End - Start
+            Task.next_run = self.GetNextRun(Task, Task.next_run)
+            # a task that overran its period is not repeated back-to-back, its next run is based on the end of this run
+            if Task.next_run < End:
+                Task.next_run = self.GetNextRun(Task, End)
+
+class ControllerState:
+    """
+    State of the zero export controller:
+    INIT (starting), REGULATING (powermeter readings ok), DEGRADED (powermeter error, inverters or DTU not reachable),
+    SAFE (inverters forced to their min limit by the watchdog), NIGHT (all inverters offline after sunset).
+    The time spent in every state is accumulated.
+    """
+    INIT = "INIT"
+    REGULATING = "REGULATING"
+    DEGRADED = "DEGRADED"
+    SAFE = "SAFE"
+    NIGHT = "NIGHT"
+    STATES = [INIT, REGULATING, DEGRADED, SAFE, NIGHT]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = self.INIT
+        self.state_since = time.monotonic()
+        self.time_in_state = {state: 0.0 for state in self.STATES}
+        self.transition_count = 0
+        self.last_meter_reading = time.monotonic()
+        self.meter_error = False
+        # start of the powermeter read in progress (None = not reading)
+        self.meter_read_start = None
+
+    def SetState(self, pState: str, pReason: str):
+        with self.lock:
+            if pState == self.state:
+                return
+            Now = time.monotonic()
+            Duration = Now - self.state_since
+            self.time_in_state[self.state] += Duration
+            logger.info('Controller: %s -> %s (%s), %s seconds in %s', self.state, pState, pReason, round(Duration), self.state)
+            self.state = pState
+            self.state_since = Now
+            self.transition_count += 1
+        PublishGlobalState("state", pState)
+
+    def ReportMeterReadStart(self):
+        self.meter_read_start = time.monotonic()
+
+    def ReportMeterReading(self):
+        self.last_meter_reading = time.monotonic()
+        self.meter_read_start = None
+        self.meter_error = False
+        if self.state != self.REGULATING:
+            self.SetState(self.REGULATING, "powermeter reading ok")
+
+    def ReportMeterError(self):
+        self.meter_read_start = None
+        self.meter_error = True
+        if self.state == self.REGULATING:
+            self.SetState(self.DEGRADED, "powermeter error")
+
+    def GetMeterAge(self):
+        return time.monotonic() - self.last_meter_reading
+
+    def GetMeterReadDuration(self):
+        # how long the powermeter read in progress takes, 0 if the main thread is not reading
+        Start = self.meter_read_start
+        return time.monotonic() - Start if Start is not None else 0
+
+    def GetTimeInState(self):
+        with self.lock:
+            Result = dict(self.time_in_state)
+            Result[self.state] += time.monotonic() - self.state_since
+        return {state: round(seconds, 1) for state, seconds in Result.items()}
+
+class Watchdog:
+    """
+    Runs in its own thread, independent of what the main thread is blocked on:
+    if the powermeter failed or a powermeter read hangs for timeout_in_s while regulating (or at the first powermeter error
+    with SET_INVERTER_TO_MIN_ON_POWERMETER_ERROR), the inverters are set to their min limit. Recovery time is bounded by timeout_in_s + 1 second.
+    A main loop that doesn't read the powermeter (no inverter available, blocked in a DTU request) is no reason for the safe limit.
+    """
+    def __init__(self, controller: ControllerState, timeout_in_s: float, safe_on_meter_error: bool):
+        self.controller = controller
+        self.timeout_in_s = timeout_in_s
+        self.safe_on_meter_error = safe_on_meter_error
+        self.check_interval_in_s = 1
+        self.thread = None
+
+    def Start(self):
+        if self.timeout_in_s <= 0 and not self.safe_on_meter_error:
+            return
+        self.thread = threading.Thread(target=self.Run, daemon=True)
+        self.thread.start()
+
+    def Run(self):
+        while True:
+            time.sleep(self.check_interval_in_s)
+            try:
+                self.Check()
+            except Exception as e:
+                logger.error('Watchdog: %s', e)
+
+    def Check(self):
+        if self.controller.state not in (ControllerState.REGULATING, ControllerState.DEGRADED):
+            return
+        MeterAge = self.controller.GetMeterAge()
+        ReadDuration = self.controller.GetMeterReadDuration()
+        if self.timeout_in_s > 0 and ReadDuration > self.timeout_in_s:
+            Reason = f'powermeter read hangs for {round(ReadDuration)} seconds'
+        elif self.timeout_in_s > 0 and self.controller.meter_error and MeterAge > self.timeout_in_s:
+            Reason = f'no powermeter reading for {round(MeterAge)} seconds'
+        elif self.safe_on_meter_error and self.controller.meter_error:
+            Reason = 'powermeter error'
+        else:
+            return
+        if SetSafeLimit():
+            self.controller.SetState(ControllerState.SAFE, Reason)
+
+class ControllerCheckpoint:
+    """
+    Stores the controller state as JSON file for a warm start. The file is written atomically (temporary file, fsync,
+    rename), a crash while writing leaves the previous checkpoint intact. An unchanged state is only written again
+    when the file would become older than max_age_in_s / 2 (less wear of SD cards).
+    """
+    def __init__(self, path: str, max_age_in_s: float):
+        self.path = path
+        self.max_age_in_s = max_age_in_s
+        self.last_content = None
+        self.last_write = 0
+
+    def Save(self, pState: dict):
+        Content = json.dumps(pState, sort_keys=True).encode()
+        if Content == self.last_content and time.monotonic() - self.last_write < self.max_age_in_s / 2:
+            return False
+        TempPath = self.path + '.tmp'
+        with open(TempPath, 'wb') as f:
+            f.write(Content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(TempPath, self.path)
+        # persist the rename itself
+        if hasattr(os, 'O_DIRECTORY'):
+            DirFd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(DirFd)
+            finally:
+                os.close(DirFd)
+        self.last_content = Content
+        self.last_write = time.monotonic()
+        return True
+
+    def Load(self):
+        # returns the stored state or None if there is none or it is outdated
+        if not os.path.exists(self.path):
+            return None
+        Age = time.time() - os.path.getmtime(self.path)
+        if Age > self.max_age_in_s:
+            logger.info('Checkpoint: %s is %s seconds old (max. %s), cold start', self.path, round(Age), self.max_age_in_s)
+            return None
+        with open(self.path, 'rb') as f:
+            return json.loads(f.read())
+
+class KeepAliveAdapter(HTTPAdapter):
+    # TCP keepalive on all pooled connections, a dead peer is detected while the connection is idle
+    def init_poolmanager(self, *args, **kwargs):
+        SocketOptions = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            SocketOptions += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30), (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10), (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)]
+        kwargs['socket_options'] = SocketOptions
+        super().init_poolmanager(*args, **kwargs)
+
+class LatencySketch:
+    """
+    Streaming quantile estimate of latencies: the samples are counted in logarithmic buckets (relative error of a quantile
+    below relative_accuracy). Every decay_interval samples all counts are multiplied by decay, so old samples fade out
+    and the estimate follows a device that becomes slower or faster.
+    """
+    def __init__(self, relative_accuracy: float = 0.05, decay: float = 0.9, decay_interval: int = 100):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.decay = decay
+        self.decay_interval = decay_interval
+        self.buckets = {}
+        self.total = 0.0
+        self.count = 0
+
+    def Add(self, pValue: float):
+        Index = math.ceil(math.log(max(pValue, 0.0001)) / self.log_gamma)
+        self.buckets[Index] = self.buckets.get(Index, 0) + 1
+        self.total += 1
+        self.count += 1
+        if self.count % self.decay_interval == 0:
+            self.buckets = {index: count * self.decay for index, count in self.buckets.items() if count * self.decay >= 0.01}
+            self.total = sum(self.buckets.values())
+
+    def GetQuantile(self, pQuantile: float):
+        if not self.buckets:
+            return None
+        Rank = pQuantile * self.total
+        Cumulated = 0.0
+        for Index in sorted(self.buckets):
+            Cumulated += self.buckets[Index]
+            if Cumulated >= Rank:
+                break
+        # center of the bucket (gamma^(i-1), gamma^i]
+        return 2 * self.gamma ** Index / (self.gamma + 1)
+
+class EndpointLatency:
+    def __init__(self):
+        self.sketch = LatencySketch()
+        self.timeouts_in_row = 0
+
+    def GetBaseTimeout(self, pDefault: float):
+        # ADAPTIVE_TIMEOUT_FACTOR * p99, at least ADAPTIVE_TIMEOUT_MIN_IN_SECONDS and at most the default timeout.
+        # The default is used until enough requests are measured.
+        if ADAPTIVE_TIMEOUT_FACTOR <= 0 or self.sketch.count < ADAPTIVE_TIMEOUT_MIN_REQUESTS:
+            return pDefault
+        return min(pDefault, max(ADAPTIVE_TIMEOUT_MIN_IN_SECONDS, ADAPTIVE_TIMEOUT_FACTOR * self.sketch.GetQuantile(0.99)))
+
+    def GetTimeout(self, pDefault: float):
+        # a device that became slower: every timeout doubles the timeout (max. 8 times) until the estimate has caught up
+        return min(pDefault, self.GetBaseTimeout(pDefault) * 2 ** min(self.timeouts_in_row, 3))
+
+    def GetStatistics(self, pDefault: float):
+        P50 = self.sketch.GetQuantile(0.5)
+        P99 = self.sketch.GetQuantile(0.99)
+        return {
+            "requests": self.sketch.count,
+            "latency_p50_ms": round(P50 * 1000, 1) if P50 is not None else None,
+            "latency_p99_ms": round(P99 * 1000, 1) if P99 is not None else None,
+            "timeout_s": round(self.GetTimeout(pDefault), 3)
+        }
+
+class HttpDevice:
+    """
+    HTTP transport of one device (powermeter or DTU): own connection pool with persistent (keep-alive) connections,
+    so a regular poll doesn't pay for a TCP handshake. Auth and headers are set once.
+    A connection closed or reset by the device is reopened and the request repeated (MAX_RETRIES),
+    but a call including all retries never takes longer than REQUEST_DEADLINE_IN_SECONDS: a stuck device can't block the main loop.
+    The latency of every request is measured per endpoint (path). Connect and read timeout and the deadline of a call
+    are derived from the measured p99 latency (ADAPTIVE_TIMEOUT_FACTOR), so a device answering in 30 ms fails over
+    within a fraction of a second instead of REQUEST_DEADLINE_IN_SECONDS.
+    """
+    def __init__(self, name: str, auth=None, headers: dict = None, timeout: float = 10):
+        self.name = name
+        self.timeout = timeout
+        self.deadline_in_s = REQUEST_DEADLINE_IN_SECONDS
+        self.session = Session()
+        self.session.auth = auth
+        if headers:
+            self.session.headers.update(headers)
+        # retries are done by Request(), within the deadline
+        self.adapter = KeepAliveAdapter(max_retries=0, pool_connections=1, pool_maxsize=2)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.last_latency = None
+        # connect latency over all endpoints, read latency per endpoint
+        self.connect = EndpointLatency()
+        self.endpoints = {}
+        HTTP_DEVICES.append(self)
+
+    def GetEndpoint(self, pUrl: str):
+        UrlPath = urlsplit(pUrl).path
+        with self.lock:
+            Endpoint = self.endpoints.get(UrlPath)
+            if Endpoint is None:
+                Endpoint = self.endpoints[UrlPath] = EndpointLatency()
+        return Endpoint
+
+    def GetDeadline(self, pTimeout: float):
+        # all attempts with their backoff have to fit, but never more than REQUEST_DEADLINE_IN_SECONDS
+        return min(self.deadline_in_s, (MAX_RETRIES + 1) * pTimeout + sum(self.GetBackoff(attempt) for attempt in range(1, MAX_RETRIES + 1)))
+
+    def Request(self, pMethod: str, pUrl: str, **kwargs):
+        Endpoint = self.GetEndpoint(pUrl)
+        # the retry budget is based on the usual latency, a stuck device fails within a fraction of REQUEST_DEADLINE_IN_SECONDS
+        Deadline = time.monotonic() + self.GetDeadline(max(Endpoint.GetBaseTimeout(self.timeout), self.connect.GetBaseTimeout(self.timeout)))
+        Attempt = 0
+        while True:
+            # every attempt only gets the time left until the deadline
+            Left = max(0.001, Deadline - time.monotonic())
+            kwargs['timeout'] = (min(self.connect.GetTimeout(self.timeout), Left), min(Endpoint.GetTimeout(self.timeout), Left))
+            Start = time.monotonic()
+            try:
+                r = self.session.request(pMethod, pUrl, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.RecordRequest(time.monotonic() - Start, False)
+                self.RecordTimeout(Endpoint, e)
+                if not self.IsRetryPossible(Attempt, Deadline):
+                    raise
+            else:
+                RetryStatus = r.status_code in RETRY_STATUS_CODE_LIST
+                self.RecordRequest(time.monotonic() - Start, not RetryStatus)
+                self.RecordLatency(Endpoint, r.elapsed.total_seconds())
+                if not RetryStatus or not self.IsRetryPossible(Attempt, Deadline):
+                    return r
+            Attempt += 1
+            time.sleep(self.GetBackoff(Attempt))
+
+    def RecordLatency(self, pEndpoint: EndpointLatency, pLatency: float):
+        # elapsed: time until the response headers arrived, including a new connection. The handshake can't be measured
+        # separately, so the connect estimate uses all requests (upper bound).
+        with self.lock:
+            pEndpoint.sketch.Add(pLatency)
+            pEndpoint.timeouts_in_row = max(0, pEndpoint.timeouts_in_row - 1)
+            self.connect.sketch.Add(pLatency)
+            self.connect.timeouts_in_row = max(0, self.connect.timeouts_in_row - 1)
+
+    def RecordTimeout(self, pEndpoint: EndpointLatency, pError: Exception):
+        # a timed out request is not a latency sample (only a lower bound), an outage must not spoil the estimate
+        with self.lock:
+            if isinstance(pError, requests.exceptions.ConnectTimeout):
+                self.connect.timeouts_in_row += 1
+            elif isinstance(pError, requests.exceptions.ReadTimeout):
+                pEndpoint.timeouts_in_row += 1
+
+    def GetBackoff(self, pAttempt: int):
+        return RETRY_BACKOFF_FACTOR * (2 ** (pAttempt - 1))
+
+    def IsRetryPossible(self, pAttempt: int, pDeadline: float):
+        return pAttempt < MAX_RETRIES and time.monotonic() + self.GetBackoff(pAttempt + 1) < pDeadline
+
+    def Get(self, pUrl: str, **kwargs):
+        return self.Request('GET', pUrl, **kwargs)
+
+    def Post(self, pUrl: str, **kwargs):
+        return self.Request('POST', pUrl, **kwargs)
+
+    def RecordRequest(self, pLatency: float, pSuccess: bool):
+        with self.lock:
+            self.request_count += 1
+            if not pSuccess:
+                self.error_count += 1
+            self.latency_sum += pLatency
+            self.latency_max = max(self.latency_max, pLatency)
+            self.last_latency = pLatency
+
+    def GetConnectionCount(self):
+        # number of TCP connections opened so far (handshakes)
+        Pools = self.adapter.poolmanager.pools
+        return sum(Pools[key].num_connections for key in Pools.keys())
+
+    def GetStatistics(self):
+        with self.lock:
+            return {
+                "requests": self.request_count,
+                "errors": self.error_count,
+                "connections": self.GetConnectionCount(),
+                "latency_avg_ms": round(self.latency_sum / self.request_count * 1000, 1) if self.request_count else None,
+                "latency_max_ms": round(self.latency_max * 1000, 1),
+                "latency_last_ms": round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+                "connect_timeout_s": round(self.connect.GetTimeout(self.timeout), 3),
+                "endpoints": {path: endpoint.GetStatistics(self.timeout) for path, endpoint in self.endpoints.items()}
+            }
+
+def LogHttpStatistics():
+    for Device in HTTP_DEVICES:
+        Stats = Device.GetStatistics()
+        logger.info('HTTP "%s": %s requests (%s errors) on %s connections, latency avg %s ms / max %s ms / last %s ms',
+                    Device.name, Stats["requests"], Stats["errors"], Stats["connections"], Stats["latency_avg_ms"], Stats["latency_max_ms"], Stats["latency_last_ms"])
+        for UrlPath, Endpoint in Stats["endpoints"].items():
+            logger.info('HTTP "%s" %s: latency p50 %s ms / p99 %s ms, timeout %s s',
+                        Device.name, UrlPath, Endpoint["latency_p50_ms"], Endpoint["latency_p99_ms"], Endpoint["timeout_s"])
+
 class Powermeter:
     def GetPowermeterWatts(self) -> int:
         raise NotImplementedError()
@@ -587,10 +1602,11 @@ class Tasmota(Powermeter):
         self.json_power_input_mqtt_label = json_power_input_mqtt_label
         self.json_power_output_mqtt_label = json_power_output_mqtt_label
         self.json_power_calculate = json_power_calculate
+        self.http = HttpDevice(f'Tasmota {ip}')
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
@@ -606,27 +1622,137 @@ class Tasmota(Powermeter):
             ouput = ParsedData[self.json_status][self.json_payload_mqtt_prefix][self.json_power_output_mqtt_label]
             return CastToInt(input - ouput)
 
+class ShellyRpcWebsocket:
+    """
+    Keeps the RPC websocket of a Shelly "Generation 2" device open and stores the status of every component (e.g. "em:0")
+    pushed by NotifyStatus in memory. Authenticates with the digest challenge of the device and reconnects automatically.
+    Readers get None if there is no status or it is older than max_age_in_s and have to poll instead.
+    """
+    def __init__(self, url: str, user: str, password: str, max_age_in_s: float):
+        import websocket
+        self.url = url
+        self.user = user
+        self.password = password
+        self.max_age_in_s = max_age_in_s
+        self.source = f'hoymileszeroexport-{os.getpid()}'
+        self.request_id = 0
+        self.auth_sent = False
+        self.components = {}
+        self.ws = websocket.WebSocketApp(url, on_open=self.on_open, on_message=self.on_message, on_error=self.on_error, on_close=self.on_close)
+        self.thread = threading.Thread(target=self.ws.run_forever, kwargs={'ping_interval': 30, 'reconnect': 5}, daemon=True)
+        self.thread.start()
+
+    def SendRequest(self, ws, pMethod: str, pAuth: dict = None):
+        # every request with "src" subscribes this connection to the notifications of the device
+        self.request_id += 1
+        request = {'id': self.request_id, 'src': self.source, 'method': pMethod}
+        if pAuth is not None:
+            request['auth'] = pAuth
+        ws.send(json.dumps(request))
+
+    def GetAuth(self, pChallenge: dict):
+        # digest authentication of the Shelly RPC protocol (SHA-256, "dummy_method:dummy_uri" as second part)
+        def sha256(pText):
+            return hashlib.sha256(pText.encode()).hexdigest()
+        cnonce = random.getrandbits(32)
+        ha1 = sha256(f'{self.user}:{pChallenge["realm"]}:{self.password}')
+        ha2 = sha256('dummy_method:dummy_uri')
+        response = sha256(f'{ha1}:{pChallenge["nonce"]}:{pChallenge.get("nc", 1)}:{cnonce}:auth:{ha2}')
+        return {'realm': pChallenge['realm'], 'username': self.user, 'nonce': pChallenge['nonce'], 'cnonce': cnonce, 'response': response, 'algorithm': 'SHA-256'}
+
+    def on_open(self, ws):
+        logger.info('Websocket %s: connected', self.url)
+        self.auth_sent = False
+        self.SendRequest(ws, 'Shelly.GetStatus')
+
+    def Disconnected(self):
+        # notifications are missed until the next Shelly.GetStatus, the stored status is not valid anymore
+        self.components = {}
+
+    def on_close(self, ws, close_status_code, close_msg):
+        self.Disconnected()
+        logger.info('Websocket %s: closed (%s)', self.url, close_status_code)
+
+    def on_error(self, ws, error):
+        # websocket-client reconnects without calling on_close
+        self.Disconnected()
+        logger.error('Websocket %s: %s', self.url, error)
+
+    def UpdateComponents(self, pStatus: dict):
+        now = time.monotonic()
+        for name, status in pStatus.items():
+            if not isinstance(status, dict):
+                continue
+            # notifications only contain the changed fields of a component
+            previous = self.components.get(name)
+            merged = dict(previous[1]) if previous is not None else {}
+            merged.update(status)
+            self.components[name] = (now, merged)
+
+    def on_message(self, ws, message):
+        try:
+            data = json.loads(message)
+            if 'error' in data:
+                # a second challenge means the password is wrong, answering it again would flood the device
+                if data['error'].get('code') == 401 and self.password and not self.auth_sent:
+                    self.auth_sent = True
+                    self.SendRequest(ws, 'Shelly.GetStatus', self.GetAuth(json.loads(data['error']['message'])))
+                elif data['error'].get('code') == 401:
+                    logger.error('Websocket %s: authentication failed, check user and password', self.url)
+                else:
+                    logger.error('Websocket %s: %s', self.url, data['error'].get('message'))
+            elif 'result' in data:
+                self.UpdateComponents(data['result'])
+            elif data.get('method') in ('NotifyStatus', 'NotifyFullStatus'):
+                self.UpdateComponents(data.get('params', {}))
+        except Exception as e:
+            logger.error('Websocket %s: invalid message: %s', self.url, e)
+
+    def GetStatus(self, pComponent: str):
+        entry = self.components.get(pComponent)
+        if entry is None or time.monotonic() - entry[0] > self.max_age_in_s:
+            return None
+        return entry[1]
+
 class Shelly(Powermeter):
-    def __init__(self, ip: str, user: str, password: str, emeterindex: str):
+    # status component pushed over the RPC websocket, only available for "Generation 2" devices
+    rpc_component = None
+
+    def __init__(self, ip: str, user: str, password: str, emeterindex: str, use_websocket: bool = False, websocket_max_age: float = 30):
         self.ip = ip
         self.user = user
         self.password = password
         self.emeterindex = emeterindex
+        self.http = HttpDevice(f'Shelly {ip}', headers={"content-type": "application/json"})
+        self.basic_auth = HTTPBasicAuth(self.user, self.password)
+        # the digest auth object keeps the nonce of the device, following requests don't need a 401 round trip
+        self.digest_auth = HTTPDigestAuth(self.user, self.password)
+        self.websocket = None
+        if use_websocket:
+            if self.rpc_component is None:
+                logger.warning('Shelly %s: websocket is only supported by "Generation 2" devices, polling instead', ip)
+            else:
+                self.websocket = ShellyRpcWebsocket(f'ws://{self.ip}/rpc', self.user or 'admin', self.password, websocket_max_age)
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
-        headers = {"content-type": "application/json"}
-        r = session.get(url, headers=headers, auth=(self.user, self.password), timeout=10)
+        r = self.http.Get(url, auth=self.basic_auth)
         r.raise_for_status()
         return r.json()
 
     def GetRpcJson(self, path):
         url = f'http://{self.ip}/rpc{path}'
-        headers = {"content-type": "application/json"}
-        r = session.get(url, headers=headers, auth=HTTPDigestAuth(self.user, self.password), timeout=10)
+        r = self.http.Get(url, auth=self.digest_auth)
         r.raise_for_status()
         return r.json()
 
+    def GetRpcStatus(self, path):
+        if self.websocket is not None:
+            status = self.websocket.GetStatus(self.rpc_component)
+            if status is not None:
+                return status
+        return self.GetRpcJson(path)
+
     def GetPowermeterWatts(self) -> int:
         raise NotImplementedError()
 
@@ -635,8 +1761,10 @@ class Shelly1PM(Shelly):
         return CastToInt(self.GetJson('/status')['meters'][0]['power'])
 
 class ShellyPlus1PM(Shelly):
+    rpc_component = 'switch:0'
+
     def GetPowermeterWatts(self):
-        return CastToInt(self.GetRpcJson('/Switch.GetStatus?id=0')['apower'])
+        return CastToInt(self.GetRpcStatus('/Switch.GetStatus?id=0')['apower'])
 
 class ShellyEM(Shelly):
     def GetPowermeterWatts(self):
@@ -650,23 +1778,118 @@ class Shelly3EM(Shelly):
         return CastToInt(self.GetJson('/status')['total_power'])
 
 class Shelly3EMPro(Shelly):
+    rpc_component = 'em:0'
+
     def GetPowermeterWatts(self):
-        return CastToInt(self.GetRpcJson('/EM.GetStatus?id=0')['total_act_power'])
+        return CastToInt(self.GetRpcStatus('/EM.GetStatus?id=0')['total_act_power'])
+
+class ServerSentEvents:
+    """
+    Keeps a Server-Sent Events stream (text/event-stream) open and calls on_event(event, data) for every received event.
+    The stream is parsed line by line as it arrives. Reconnects automatically if the connection fails or nothing
+    (not even a keep-alive) was received for read_timeout_in_s.
+    """
+    def __init__(self, host: str, port: int, path: str, on_event, read_timeout_in_s: float = 30, reconnect_delay_in_s: float = 5):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.on_event = on_event
+        self.read_timeout_in_s = read_timeout_in_s
+        self.reconnect_delay_in_s = reconnect_delay_in_s
+        self.connected = False
+        self.thread = threading.Thread(target=self.Run, daemon=True)
+        self.thread.start()
+
+    def Run(self):
+        url = f'http://{self.host}:{self.port}{self.path}'
+        while True:
+            try:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.read_timeout_in_s)
+                try:
+                    connection.request('GET', self.path, headers={'Accept': 'text/event-stream', 'Cache-Control': 'no-cache'})
+                    response = connection.getresponse()
+                    if response.status != 200:
+                        raise Exception(f"Error: HTTP status {response.status}")
+                    logger.info('Event stream %s: connected', url)
+                    self.connected = True
+                    self.ReadEvents(response)
+                    logger.info('Event stream %s: closed', url)
+                finally:
+                    self.connected = False
+                    connection.close()
+            except Exception as e:
+                logger.error('Event stream %s: %s', url, e)
+            time.sleep(self.reconnect_delay_in_s)
+
+    def ReadEvents(self, pResponse):
+        event = 'message'
+        data = []
+        while True:
+            line = pResponse.readline()
+            if not line:
+                return
+            line = line.decode('utf-8').rstrip('\r\n')
+            if not line:
+                # an empty line dispatches the event
+                if data:
+                    try:
+                        self.on_event(event, '\n'.join(data))
+                    except Exception as e:
+                        logger.error('Event stream %s: invalid event: %s', self.host, e)
+                event = 'message'
+                data = []
+                continue
+            if line.startswith(':'):
+                continue
+            field, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'event':
+                event = value
+            elif field == 'data':
+                data.append(value)
+            elif field == 'retry' and value.isdigit():
+                self.reconnect_delay_in_s = int(value) / 1000
 
 class ESPHome(Powermeter):
-    def __init__(self, ip: str, port: str, domain: str, id: str):
+    def __init__(self, ip: str, port: str, domain: str, id: str, use_events: bool = False, events_max_age: float = 30):
         self.ip = ip
         self.port = port
         self.domain = domain
         self.id = id
+        self.http = HttpDevice(f'ESPHome {ip}')
+        self.events_max_age = events_max_age
+        self.values = {}
+        self.events = None
+        if use_events:
+            self.events = ServerSentEvents(self.ip, int(self.port), '/events', self.on_event)
+
+    def on_event(self, event, data):
+        if event != 'state':
+            return
+        state = json.loads(data)
+        if 'value' in state:
+            self.values[state['id']] = (time.monotonic(), state['value'])
+
+    def GetEventValue(self):
+        # the entity id of the events is "<domain>-<id>", newer web server versions use "<domain>/<id>"
+        for entity_id in (f'{self.domain}-{self.id}', f'{self.domain}/{self.id}'):
+            entry = self.values.get(entity_id)
+            if entry is not None and self.events.connected and time.monotonic() - entry[0] <= self.events_max_age:
+                return entry[1]
+        return None
 
     def GetJson(self, path):
         url = f'http://{self.ip}:{self.port}{path}'
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
     def GetPowermeterWatts(self):
+        if self.events is not None:
+            value = self.GetEventValue()
+            if value is not None:
+                return CastToInt(value)
         ParsedData = self.GetJson(f'/{self.domain}/{self.id}')
         return CastToInt(ParsedData['value'])
 
@@ -675,10 +1898,11 @@ class Shrdzm(Powermeter):
         self.ip = ip
         self.user = user
         self.password = password
+        self.http = HttpDevice(f'Shrdzm {ip}')
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
@@ -691,10 +1915,11 @@ class Emlog(Powermeter):
         self.ip = ip
         self.meterindex = meterindex
         self.json_power_calculate = json_power_calculate
+        self.http = HttpDevice(f'Emlog {ip}')
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
@@ -715,10 +1940,11 @@ class IoBroker(Powermeter):
         self.power_calculate = power_calculate
         self.power_input_alias = power_input_alias
         self.power_output_alias = power_output_alias
+        self.http = HttpDevice(f'ioBroker {ip}')
 
     def GetJson(self, path):
         url = f'http://{self.ip}:{self.port}{path}'
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
@@ -737,8 +1963,78 @@ class IoBroker(Powermeter):
                     output = CastToInt(item['val'])
             return CastToInt(input - output)
 
+class HomeAssistantWebsocket:
+    """
+    Keeps the websocket API of Home Assistant open, authenticates once and subscribes to the given entities ("subscribe_entities").
+    Every pushed state is stored in memory with its receive time. Reconnects automatically.
+    Readers get None while the websocket is not subscribed, for unknown entities or if the state is older than max_age_in_s (0 = no limit), and have to poll instead.
+    """
+    def __init__(self, url: str, access_token: str, entity_ids: list, max_age_in_s: float):
+        import websocket
+        self.url = url
+        self.access_token = access_token
+        self.entity_ids = entity_ids
+        self.max_age_in_s = max_age_in_s
+        self.subscribed = False
+        self.entities = {}
+        self.ws = websocket.WebSocketApp(url, on_open=self.on_open, on_message=self.on_message, on_error=self.on_error, on_close=self.on_close)
+        self.thread = threading.Thread(target=self.ws.run_forever, kwargs={'ping_interval': 30, 'reconnect': 5}, daemon=True)
+        self.thread.start()
+
+    def on_open(self, ws):
+        logger.info('Websocket %s: connected', self.url)
+
+    def Unsubscribed(self):
+        # without the subscription state changes are missed, the stored states are not valid anymore
+        self.subscribed = False
+        self.entities = {}
+
+    def on_close(self, ws, close_status_code, close_msg):
+        self.Unsubscribed()
+        logger.info('Websocket %s: closed (%s)', self.url, close_status_code)
+
+    def on_error(self, ws, error):
+        # a lost connection is only reported here when reconnecting
+        self.Unsubscribed()
+        logger.error('Websocket %s: %s', self.url, error)
+
+    def on_message(self, ws, message):
+        try:
+            data = json.loads(message)
+            if data['type'] == 'auth_required':
+                ws.send(json.dumps({'type': 'auth', 'access_token': self.access_token}))
+            elif data['type'] == 'auth_ok':
+                ws.send(json.dumps({'id': 1, 'type': 'subscribe_entities', 'entity_ids': self.entity_ids}))
+            elif data['type'] == 'auth_invalid':
+                logger.error('Websocket %s: authentication failed: %s', self.url, data.get('message'))
+            elif data['type'] == 'result':
+                if not data.get('success'):
+                    logger.error('Websocket %s: subscription failed: %s', self.url, data.get('error'))
+            elif data['type'] == 'event':
+                now = time.monotonic()
+                event = data['event']
+                # "a": complete states of new entities, "c": changes ("+" = added/changed fields), "r": removed entities
+                for entity_id, state in event.get('a', {}).items():
+                    self.entities[entity_id] = (now, state['s'])
+                for entity_id, change in event.get('c', {}).items():
+                    if 's' in change.get('+', {}):
+                        self.entities[entity_id] = (now, change['+']['s'])
+                for entity_id in event.get('r', []):
+                    self.entities.pop(entity_id, None)
+                self.subscribed = True
+        except Exception as e:
+            logger.error('Websocket %s: invalid message: %s', self.url, e)
+
+    def GetState(self, pEntityId: str):
+        entry = self.entities.get(pEntityId)
+        if not self.subscribed or entry is None:
+            return None
+        if self.max_age_in_s and time.monotonic() - entry[0] > self.max_age_in_s:
+            return None
+        return entry[1]
+
 class HomeAssistant(Powermeter):
-    def __init__(self, ip: str, port: str, use_https: bool, access_token: str, current_power_entity: str, power_calculate: bool, power_input_alias: str, power_output_alias: str):
+    def __init__(self, ip: str, port: str, use_https: bool, access_token: str, current_power_entity: str, power_calculate: bool, power_input_alias: str, power_output_alias: str, use_websocket: bool = False, websocket_max_age: float = 0):
         self.ip = ip
         self.port = port
         self.use_https = use_https
@@ -747,26 +2043,38 @@ class HomeAssistant(Powermeter):
         self.power_calculate = power_calculate
         self.power_input_alias = power_input_alias
         self.power_output_alias = power_output_alias
+        self.http = HttpDevice(f'HomeAssistant {ip}', headers={"Authorization": "Bearer " + self.access_token, "content-type": "application/json"})
+        self.websocket = None
+        if use_websocket:
+            if self.power_calculate:
+                entity_ids = [self.power_input_alias, self.power_output_alias]
+            else:
+                entity_ids = [self.current_power_entity]
+            scheme = 'wss' if self.use_https else 'ws'
+            self.websocket = HomeAssistantWebsocket(f'{scheme}://{self.ip}:{self.port}/api/websocket', self.access_token, entity_ids, websocket_max_age)
 
     def GetJson(self, path):
         if self.use_https:
             url = f"https://{self.ip}:{self.port}{path}"
         else:
             url = f"http://{self.ip}:{self.port}{path}"
-        headers = {"Authorization": "Bearer " + self.access_token, "content-type": "application/json"}
-        r = session.get(url, headers=headers, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
+    def GetState(self, pEntityId):
+        if self.websocket is not None:
+            state = self.websocket.GetState(pEntityId)
+            if state is not None:
+                return state
+        return self.GetJson(f"/api/states/{pEntityId}")['state']
+
     def GetPowermeterWatts(self):
         if not self.power_calculate:
-            ParsedData = self.GetJson(f"/api/states/{self.current_power_entity}")
-            return CastToInt(ParsedData['state'])
+            return CastToInt(self.GetState(self.current_power_entity))
         else:
-            ParsedData = self.GetJson(f"/api/states/{self.power_input_alias}")
-            input = CastToInt(ParsedData['state'])
-            ParsedData = self.GetJson(f"/api/states/{self.power_output_alias}")
-            output = CastToInt(ParsedData['state'])
+            input = CastToInt(self.GetState(self.power_input_alias))
+            output = CastToInt(self.GetState(self.power_output_alias))
             return CastToInt(input - output)
 
 class VZLogger(Powermeter):
@@ -774,10 +2082,11 @@ class VZLogger(Powermeter):
         self.ip = ip
         self.port = port
         self.uuid = uuid
+        self.http = HttpDevice(f'VZLogger {ip}')
 
     def GetJson(self):
         url = f"http://{self.ip}:{self.port}/{self.uuid}"
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
@@ -787,10 +2096,11 @@ class VZLogger(Powermeter):
 class AmisReader(Powermeter):
     def __init__(self, ip: str):
         self.ip = ip
+        self.http = HttpDevice(f'AmisReader {ip}')
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
-        r = session.get(url, timeout=10)
+        r = self.http.Get(url)
         r.raise_for_status()
         return r.json()
 
@@ -803,7 +2113,7 @@ class ModbusTCP(Powermeter):
         self.register = register;
         self.register_type = register_type;
         self.register_scale = register_scale;
-        self.modbusClient = ModbusClient(ip, 502, unit_id, auto_open=True)
+        self.modbusClient = ModbusClient(ip, 502, unit_id, timeout=REQUEST_DEADLINE_IN_SECONDS, auto_open=True)
 
     def GetPowermeterWatts(self):
         regCount = 2 if self.register_type == "int32" else 1
@@ -818,19 +2128,181 @@ class ModbusTCP(Powermeter):
         logger.info("powermeter ModbusTCP: %s %s", Watts, " Watt")
         return CastToInt(Watts)
 
+class PowermeterSource:
+    def __init__(self, powermeter: Powermeter):
+        self.powermeter = powermeter
+        self.name = powermeter.__class__.__name__
+        self.future = None
+        self.failures = 0
+        self.demoted_until = 0
+        self.read_count = 0
+        self.used_count = 0
+        self.error_count = 0
+        self.timeout_count = 0
+        self.deviation_count = 0
+        self.last_latency = None
+
+    def IsDemoted(self, pNow: float):
+        return self.demoted_until > pNow
+
+    def IsBusy(self):
+        return self.future is not None and not self.future.done()
+
+class RedundantPowermeter(Powermeter):
+    """
+    Reads several powermeters measuring the same point concurrently and returns the first valid reading within deadline_in_s
+    (with 3 or more readings at that time their median). When all readings of a round are in, they are cross-checked:
+    with 3 or more powermeters a reading deviating more than max_deviation from the median is outvoted, with 2 powermeters
+    a deviation is only logged. A powermeter failing max_failures times in a row (error, too slow or outvoted) is not used
+    for demotion_time_in_s.
+    """
+    def __init__(self, powermeters: list, deadline_in_s: float, max_deviation: int, max_failures: int, demotion_time_in_s: float):
+        self.sources = [PowermeterSource(powermeter) for powermeter in powermeters]
+        self.deadline_in_s = deadline_in_s
+        self.max_deviation = max_deviation
+        self.max_failures = max_failures
+        self.demotion_time_in_s = demotion_time_in_s
+        self.lock = threading.Lock()
+        self.disagree = False
+        self.executor = ThreadPoolExecutor(len(self.sources), thread_name_prefix='powermeter')
+        logger.info('redundant powermeters: %s', ', '.join(source.name for source in self.sources))
+
+    def ReadSource(self, pSource: PowermeterSource):
+        Start = time.monotonic()
+        Watts = pSource.powermeter.GetPowermeterWatts()
+        return Watts, time.monotonic() - Start
+
+    def RecordFailure(self, pSource: PowermeterSource, pReason: str):
+        # called with self.lock held
+        pSource.failures += 1
+        if pSource.failures >= self.max_failures and not pSource.IsDemoted(time.monotonic()):
+            pSource.demoted_until = time.monotonic() + self.demotion_time_in_s
+            # after the demotion one more failure demotes it again
+            pSource.failures = self.max_failures - 1
+            logger.warning('powermeter %s: %s, not used for %s seconds', pSource.name, pReason, self.demotion_time_in_s)
+
+    def CrossCheck(self, pRound: dict):
+        Values = {source: result[0] for source, result in pRound.items() if result is not None and result[1] <= self.deadline_in_s}
+        with self.lock:
+            for source, result in pRound.items():
+                if result is None:
+                    source.error_count += 1
+                    self.RecordFailure(source, 'read error')
+                elif result[1] > self.deadline_in_s:
+                    source.timeout_count += 1
+                    self.RecordFailure(source, f'no reading within {self.deadline_in_s} seconds')
+            if not Values:
+                return
+            Median = statistics.median(Values.values())
+            Disagree = False
+            for source, value in Values.items():
+                if abs(value - Median) <= self.max_deviation:
+                    source.failures = 0
+                    continue
+                Disagree = True
+                source.deviation_count += 1
+                if len(Values) >= 3:
+                    self.RecordFailure(source, f'reading {value} Watt deviates from the median {Median} Watt')
+            if Disagree and len(Values) < 3 and not self.disagree:
+                logger.warning('powermeters disagree: %s', ', '.join(f'{source.name} {value} Watt' for source, value in Values.items()))
+            self.disagree = Disagree
+
+    def GetPowermeterWatts(self):
+        Now = time.monotonic()
+        Sources = [source for source in self.sources if not source.IsBusy() and not source.IsDemoted(Now)]
+        if not Sources:
+            # all demoted: better any reading than none
+            Sources = [source for source in self.sources if not source.IsBusy()]
+        if not Sources:
+            raise Exception("Error: all powermeters are still busy with the previous reading")
+        Round = {}
+        Remaining = [len(Sources)]
+
+        def Done(pSource, pFuture):
+            try:
+                Round[pSource] = pFuture.result()
+                pSource.last_latency = Round[pSource][1]
+            except Exception as e:
+                logger.error('powermeter %s: %s', pSource.name, e)
+                Round[pSource] = None
+            with self.lock:
+                Remaining[0] -= 1
+                Complete = Remaining[0] == 0
+            if Complete:
+                self.CrossCheck(Round)
+
+        Futures = {}
+        for source in Sources:
+            source.read_count += 1
+            source.future = self.executor.submit(self.ReadSource, source)
+            Futures[source.future] = source
+        Deadline = Now + self.deadline_in_s
+        Pending = set(Futures)
+        Values = {}
+        while Pending and not Values:
+            Finished, Pending = concurrent.futures.wait(Pending, timeout=max(0, Deadline - time.monotonic()), return_when=concurrent.futures.FIRST_COMPLETED)
+            if not Finished:
+                break
+            for future in Finished:
+                if future.exception() is None:
+                    Values[Futures[future]] = future.result()[0]
+        # the readings still running are cross-checked (and counted as too slow) when they are done
+        for future, source in Futures.items():
+            future.add_done_callback(lambda f, source=source: Done(source, f))
+        if not Values:
+            raise Exception(f"Error: no powermeter delivered a valid reading within {self.deadline_in_s} seconds")
+        if len(Values) >= 3:
+            for source in Values:
+                source.used_count += 1
+            return CastToInt(statistics.median(Values.values()))
+        Source = next(source for source in Sources if source in Values)
+        Source.used_count += 1
+        return Values[Source]
+
+    def GetStatistics(self):
+        Now = time.monotonic()
+        return {source.name: {
+            "reads": source.read_count,
+            "used": source.used_count,
+            "errors": source.error_count,
+            "timeouts": source.timeout_count,
+            "deviations": source.deviation_count,
+            "demoted": source.IsDemoted(Now),
+            "last_latency_s": round(source.last_latency, 3) if source.last_latency is not None else None
+        } for source in self.sources}
+
 class DebugReader(Powermeter):
     def GetPowermeterWatts(self):
         return CastToInt(input("Enter Powermeter Watts: "))
 
 class DTU(Powermeter):
-    def __init__(self, inverter_count: int):
+    def __init__(self, inverter_count: int, inverter_ids: list = None):
         self.inverter_count = inverter_count
+        # global inverter ids handled by this DTU, the position in this list is the id of the inverter on the DTU
+        self.inverter_ids = list(range(inverter_count)) if inverter_ids is None else inverter_ids
+        self.circuit_breaker = CircuitBreaker(self.__class__.__name__, DTU_CIRCUIT_BREAKER_THRESHOLD, DTU_CIRCUIT_BREAKER_RESET_SECONDS)
+
+    def GetDtuInverterId(self, pInverterId: int):
+        return self.inverter_ids.index(pInverterId)
+
+    def GetLimitResolution(self, pInverterId: int):
+        # smallest limit step in Watt the DTU can send to the inverter
+        return 1
 
     def GetACPower(self, pInverterId: int):
         raise NotImplementedError()
 
     def GetPowermeterWatts(self):
-        return sum(self.GetACPower(pInverterId) for pInverterId in range(self.inverter_count) if AVAILABLE[pInverterId] and HOY_BATTERY_GOOD_VOLTAGE[pInverterId])
+        Watts = 0
+        for pInverterId in self.inverter_ids:
+            if not (AVAILABLE[pInverterId] and HOY_BATTERY_GOOD_VOLTAGE[pInverterId]):
+                continue
+            ACPower = self.GetACPower(pInverterId)
+            AVAILABILITY.ReportACPower(pInverterId, ACPower)
+            if COMPENSATION is not None:
+                COMPENSATION.AddSample(pInverterId, ACPower)
+            Watts += ACPower
+        return Watts
 
     def CheckMinVersion(self):
         raise NotImplementedError()
@@ -859,12 +2331,57 @@ class DTU(Powermeter):
     def SetPowerStatus(self, pInverterId: int, pActive: bool):
         raise NotImplementedError()
 
+    def GetAvailableBulk(self, pInverterIds: list):
+        # returns {inverter id: available or the exception raised while reading it}
+        Result = {}
+        for pInverterId in pInverterIds:
+            try:
+                Result[pInverterId] = self.GetAvailable(pInverterId)
+            except Exception as e:
+                Result[pInverterId] = e
+        return Result
+
+    def GetACPowerBulk(self, pInverterIds: list):
+        # returns {inverter id: AC power in W or the exception raised while reading it}
+        Result = {}
+        for pInverterId in pInverterIds:
+            try:
+                Result[pInverterId] = self.GetACPower(pInverterId)
+            except Exception as e:
+                Result[pInverterId] = e
+        return Result
+
+    def GetActualLimitsBulk(self, pInverterIds: list):
+        # returns {inverter id: limit in W or the exception raised while reading it}
+        Result = {}
+        for pInverterId in pInverterIds:
+            try:
+                Result[pInverterId] = self.GetActualLimitInW(pInverterId)
+            except Exception as e:
+                Result[pInverterId] = e
+        return Result
+
+    def SetLimits(self, pLimits: dict, pTimeoutInS: int):
+        # sends {inverter id: limit} and waits for the acknowledgements, returns {inverter id: ack}
+        # a failed inverter is not acknowledged, the other inverters are still sent
+        Acks = {}
+        for pInverterId, pLimit in pLimits.items():
+            try:
+                self.SetLimit(pInverterId, pLimit)
+                Acks[pInverterId] = self.WaitForAck(pInverterId, pTimeoutInS)
+            except Exception as e:
+                logger.error('Inverter "%s": limit %s Watt not set: %s', NAME[pInverterId], pLimit, e)
+                Acks[pInverterId] = False
+        return Acks
+
 class AhoyDTU(DTU):
-    def __init__(self, inverter_count: int, ip: str, password: str):
-        super().__init__(inverter_count)
+    def __init__(self, inverter_count: int, ip: str, password: str, inverter_ids: list = None):
+        super().__init__(inverter_count, inverter_ids)
         self.ip = ip
         self.password = password
         self.Token = ''
+        self.FieldIndex = {}
+        self.http = HttpDevice(f'AhoyDTU {ip}')
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
@@ -872,20 +2389,32 @@ class AhoyDTU(DTU):
         data = None
         retry_count = 3
         while retry_count > 0 and data is None:
-            data = session.get(url, timeout=10).json()
+            data = self.circuit_breaker.Call(self.http.Get, url).json()
             retry_count -= 1
         return data
 
     def GetResponseJson(self, path, obj):
         url = f'http://{self.ip}{path}'
-        r = session.post(url, json = obj, timeout=10)
+        r = self.circuit_breaker.Call(self.http.Post, url, json = obj)
         r.raise_for_status()
         return r.json()
 
+    def GetFieldIndex(self, pFieldGroup: str, pFieldName: str):
+        # the field order of /api/live does not change at runtime, so it is only downloaded once
+        if not self.FieldIndex:
+            ParsedData = self.GetJson('/api/live')
+            self.FieldIndex = {
+                "ch0_fld_names": {name: index for index, name in enumerate(ParsedData["ch0_fld_names"])},
+                "fld_names": {name: index for index, name in enumerate(ParsedData["fld_names"])},
+            }
+        return self.FieldIndex[pFieldGroup][pFieldName]
+
+    def GetInverterData(self, pInverterId: int):
+        return self.GetJson(f'/api/inverter/id/{self.GetDtuInverterId(pInverterId)}')
+
     def GetACPower(self, pInverterId):
-        ParsedData = self.GetJson('/api/live')
-        ActualPower_index = ParsedData["ch0_fld_names"].index("P_AC")
-        ParsedData = self.GetJson(f'/api/inverter/id/{pInverterId}')
+        ActualPower_index = self.GetFieldIndex("ch0_fld_names", "P_AC")
+        ParsedData = self.GetInverterData(pInverterId)
         return CastToInt(ParsedData["ch"][0][ActualPower_index])
 
     def CheckMinVersion(self):
@@ -902,44 +2431,38 @@ class AhoyDTU(DTU):
 
     def GetAvailable(self, pInverterId: int):
         ParsedData = self.GetJson('/api/index')
-        Available = bool(ParsedData["inverter"][pInverterId]["is_avail"])
+        Available = bool(ParsedData["inverter"][self.GetDtuInverterId(pInverterId)]["is_avail"])
         logger.info('Ahoy: Inverter "%s" Available: %s',NAME[pInverterId], Available)
         return Available
 
     def GetActualLimitInW(self, pInverterId: int):
-        ParsedData = self.GetJson(f'/api/inverter/id/{pInverterId}')
+        ParsedData = self.GetInverterData(pInverterId)
         LimitInPercent = float(ParsedData['power_limit_read'])
         LimitInW = HOY_INVERTER_WATT[pInverterId] * LimitInPercent / 100
         return LimitInW
 
     def GetInfo(self, pInverterId: int):
-        ParsedData = self.GetJson('/api/live')
-        temp_index = ParsedData["ch0_fld_names"].index("Temp")
-
-        ParsedData = self.GetJson(f'/api/inverter/id/{pInverterId}')
+        temp_index = self.GetFieldIndex("ch0_fld_names", "Temp")
+        ParsedData = self.GetInverterData(pInverterId)
         SERIAL_NUMBER[pInverterId] = str(ParsedData['serial'])
         NAME[pInverterId] = str(ParsedData['name'])
         TEMPERATURE[pInverterId] = str(ParsedData["ch"][0][temp_index]) + ' degC'
         logger.info('Ahoy: Inverter "%s" / serial number "%s" / temperature %s',NAME[pInverterId],SERIAL_NUMBER[pInverterId],TEMPERATURE[pInverterId])
 
     def GetTemperature(self, pInverterId: int):
-        ParsedData = self.GetJson('/api/live')
-        temp_index = ParsedData["ch0_fld_names"].index("Temp")
-
-        ParsedData = self.GetJson(f'/api/inverter/id/{pInverterId}')
+        temp_index = self.GetFieldIndex("ch0_fld_names", "Temp")
+        ParsedData = self.GetInverterData(pInverterId)
         TEMPERATURE[pInverterId] = str(ParsedData["ch"][0][temp_index]) + ' degC'
         logger.info('Ahoy: Inverter "%s" temperature: %s',NAME[pInverterId],TEMPERATURE[pInverterId])
 
     def GetPanelMinVoltage(self, pInverterId: int):
-        ParsedData = self.GetJson('/api/live')
-        PanelVDC_index = ParsedData["fld_names"].index("U_DC")
-
-        ParsedData = self.GetJson(f'/api/inverter/id/{pInverterId}')
+        PanelVDC_index = self.GetFieldIndex("fld_names", "U_DC")
+        Channels = self.GetInverterData(pInverterId)['ch']
         PanelVDC = []
         ExcludedPanels = GetNumberArray(HOY_BATTERY_IGNORE_PANELS[pInverterId])
-        for i in range(1, len(ParsedData['ch']), 1):
+        for i in range(1, len(Channels), 1):
             if i not in ExcludedPanels:
-                PanelVDC.append(float(ParsedData['ch'][i][PanelVDC_index]))
+                PanelVDC.append(float(Channels[i][PanelVDC_index]))
         minVdc = float('inf')
         for i in range(len(PanelVDC)):
             if (minVdc > PanelVDC[i]) and (PanelVDC[i] > 5):
@@ -962,10 +2485,10 @@ class AhoyDTU(DTU):
     def WaitForAck(self, pInverterId: int, pTimeoutInS: int):
         try:
             timeout = pTimeoutInS
-            timeout_start = time.time()
-            while time.time() < timeout_start + timeout:
+            timeout_start = time.monotonic()
+            while time.monotonic() < timeout_start + timeout:
                 time.sleep(0.5)
-                ParsedData = self.GetJson(f'/api/inverter/id/{pInverterId}')
+                ParsedData = self.GetInverterData(pInverterId)
                 ack = bool(ParsedData['power_limit_ack'])
                 if ack:
                     break
@@ -983,7 +2506,7 @@ class AhoyDTU(DTU):
 
     def SetLimit(self, pInverterId: int, pLimit: int):
         logger.info('Ahoy: Inverter "%s": setting new limit from %s Watt to %s Watt',NAME[pInverterId],CastToInt(CURRENT_LIMIT[pInverterId]),CastToInt(pLimit))
-        myobj = {'cmd': 'limit_nonpersistent_absolute', 'val': pLimit, "id": pInverterId, "token": self.Token}
+        myobj = {'cmd': 'limit_nonpersistent_absolute', 'val': pLimit, "id": self.GetDtuInverterId(pInverterId), "token": self.Token}
         response = self.GetResponseJson('/api/ctrl', myobj)
         if response["success"] == False and response["error"] == "ERR_PROTECTED":
             self.Authenticate()
@@ -998,7 +2521,7 @@ class AhoyDTU(DTU):
             logger.info('Ahoy: Inverter "%s": Turn on',NAME[pInverterId])
         else:
             logger.info('Ahoy: Inverter "%s": Turn off',NAME[pInverterId])
-        myobj = {'cmd': 'power', 'val': CastToInt(pActive == True), "id": pInverterId, "token": self.Token}
+        myobj = {'cmd': 'power', 'val': CastToInt(pActive == True), "id": self.GetDtuInverterId(pInverterId), "token": self.Token}
         response = self.GetResponseJson('/api/ctrl', myobj)
         if response["success"] == False and response["error"] == "ERR_PROTECTED":
             self.Authenticate()
@@ -1016,29 +2539,88 @@ class AhoyDTU(DTU):
         self.Token = response["token"]
         logger.info('Ahoy: Authenticating successful, received Token: %s', self.Token)
 
+class LiveDataWebsocket:
+    """
+    Keeps a websocket to the DTU open and stores the pushed live data of every inverter (by serial number) in memory.
+    Reconnects automatically. Readers get None if there is no data or it is older than max_age_in_s and have to poll instead.
+    """
+    def __init__(self, url: str, header: list, max_age_in_s: float):
+        import websocket
+        self.url = url
+        self.max_age_in_s = max_age_in_s
+        self.inverters = {}
+        self.ws = websocket.WebSocketApp(url, header=header, on_open=self.on_open, on_message=self.on_message, on_error=self.on_error, on_close=self.on_close)
+        self.thread = threading.Thread(target=self.ws.run_forever, kwargs={'ping_interval': 30, 'reconnect': 5}, daemon=True)
+        self.thread.start()
+
+    def on_open(self, ws):
+        logger.info('Websocket %s: connected', self.url)
+
+    def Disconnected(self):
+        # pushed updates are missed, the stored live data is not valid anymore
+        self.inverters = {}
+
+    def on_close(self, ws, close_status_code, close_msg):
+        self.Disconnected()
+        logger.info('Websocket %s: closed (%s)', self.url, close_status_code)
+
+    def on_error(self, ws, error):
+        # websocket-client reconnects without calling on_close
+        self.Disconnected()
+        logger.error('Websocket %s: %s', self.url, error)
+
+    def on_message(self, ws, message):
+        try:
+            data = json.loads(message)
+            for inverter in data.get('inverters', []):
+                self.inverters[str(inverter['serial'])] = (time.monotonic(), inverter)
+        except Exception as e:
+            logger.error('Websocket %s: invalid message: %s', self.url, e)
+
+    def GetInverter(self, pSerial: str):
+        entry = self.inverters.get(pSerial)
+        if entry is None or time.monotonic() - entry[0] > self.max_age_in_s:
+            return None
+        return entry[1]
+
 class OpenDTU(DTU):
-    def __init__(self, inverter_count: int, ip: str, user: str, password: str):
-        super().__init__(inverter_count)
+    def __init__(self, inverter_count: int, ip: str, user: str, password: str, inverter_ids: list = None, use_websocket: bool = False, websocket_max_age: float = 30):
+        super().__init__(inverter_count, inverter_ids)
         self.ip = ip
         self.user = user
         self.password = password
+        self.http = HttpDevice(f'OpenDTU {ip}', auth=HTTPBasicAuth(self.user, self.password))
+        self.websocket = None
+        if use_websocket:
+            header = []
+            if self.user:
+                header.append('Authorization: Basic ' + base64.b64encode(f'{self.user}:{self.password}'.encode()).decode())
+            self.websocket = LiveDataWebsocket(f'ws://{self.ip}/livedata', header, websocket_max_age)
 
     def GetJson(self, path):
         url = f'http://{self.ip}{path}'
-        r = session.get(url, auth=HTTPBasicAuth(self.user, self.password), timeout=10)
+        r = self.circuit_breaker.Call(self.http.Get, url)
         r.raise_for_status()
         return r.json()
 
     def GetResponseJson(self, path, sendStr):
         url = f'http://{self.ip}{path}'
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        r = session.post(url=url, headers=headers, data=sendStr, auth=HTTPBasicAuth(self.user, self.password), timeout=10)
+        r = self.circuit_breaker.Call(self.http.Post, url, headers=headers, data=sendStr)
         r.raise_for_status()
         return r.json()
 
+    def GetLiveData(self, pInverterId: int, *pKeys):
+        # live data of one inverter, from the websocket if it contains pKeys (push messages can be incomplete), otherwise over REST
+        if self.websocket is not None:
+            inverter = self.websocket.GetInverter(SERIAL_NUMBER[pInverterId])
+            if inverter is not None and all(key in inverter for key in pKeys):
+                return inverter
+        return self.GetJson(f'/api/livedata/status?inv={SERIAL_NUMBER[pInverterId]}')['inverters'][0]
+
     def GetACPower(self, pInverterId):
-        ParsedData = self.GetJson(f'/api/livedata/status?inv={SERIAL_NUMBER[pInverterId]}')
-        return CastToInt(ParsedData['inverters'][0]['AC']['0']['Power']['v'])
+        ParsedData = self.GetLiveData(pInverterId, 'AC')
+        return CastToInt(ParsedData["AC"]["0"]["Power"]["v"])
 
     def CheckMinVersion(self):
         MinVersion = 'v24.2.12'
@@ -1052,8 +2634,8 @@ class OpenDTU(DTU):
             quit()
 
     def GetAvailable(self, pInverterId: int):
-        ParsedData = self.GetJson(f'/api/livedata/status?inv={SERIAL_NUMBER[pInverterId]}')
-        Reachable = bool(ParsedData['inverters'][0]["reachable"])
+        ParsedData = self.GetLiveData(pInverterId, 'reachable')
+        Reachable = bool(ParsedData['reachable'])
         logger.info('OpenDTU: Inverter "%s" reachable: %s',NAME[pInverterId],Reachable)
         return Reachable
 
@@ -1063,28 +2645,39 @@ class OpenDTU(DTU):
         LimitInW = HOY_INVERTER_WATT[pInverterId] * limit_relative / 100
         return LimitInW
 
+    def GetActualLimitsBulk(self, pInverterIds: list):
+        # /api/limit/status contains all inverters
+        ParsedData = self.GetJson('/api/limit/status')
+        Result = {}
+        for pInverterId in pInverterIds:
+            try:
+                Result[pInverterId] = HOY_INVERTER_WATT[pInverterId] * float(ParsedData[SERIAL_NUMBER[pInverterId]]['limit_relative']) / 100
+            except Exception as e:
+                Result[pInverterId] = e
+        return Result
+
     def GetInfo(self, pInverterId: int):
         if SERIAL_NUMBER[pInverterId] == '':
             ParsedData = self.GetJson('/api/livedata/status')
-            SERIAL_NUMBER[pInverterId] = str(ParsedData['inverters'][pInverterId]['serial'])
+            SERIAL_NUMBER[pInverterId] = str(ParsedData['inverters'][self.GetDtuInverterId(pInverterId)]['serial'])
 
-        ParsedData = self.GetJson(f'/api/livedata/status?inv={SERIAL_NUMBER[pInverterId]}')
-        TEMPERATURE[pInverterId] = str(round(float((ParsedData['inverters'][0]['INV']['0']['Temperature']['v'])),1)) + ' degC'
-        NAME[pInverterId] = str(ParsedData['inverters'][0]['name'])
+        ParsedData = self.GetLiveData(pInverterId, 'INV', 'name')
+        TEMPERATURE[pInverterId] = str(round(float(ParsedData["INV"]["0"]["Temperature"]["v"]),1)) + ' degC'
+        NAME[pInverterId] = str(ParsedData['name'])
         logger.info('OpenDTU: Inverter "%s" / serial number "%s" / temperature %s',NAME[pInverterId],SERIAL_NUMBER[pInverterId],TEMPERATURE[pInverterId])
 
     def GetTemperature(self, pInverterId: int):
-        ParsedData = self.GetJson(f'/api/livedata/status?inv={SERIAL_NUMBER[pInverterId]}')
-        TEMPERATURE[pInverterId] = str(round(float((ParsedData['inverters'][0]['INV']['0']['Temperature']['v'])),1)) + ' degC'
+        ParsedData = self.GetLiveData(pInverterId, 'INV')
+        TEMPERATURE[pInverterId] = str(round(float(ParsedData["INV"]["0"]["Temperature"]["v"]),1)) + ' degC'
         logger.info('OpenDTU: Inverter "%s" temperature: %s',NAME[pInverterId],TEMPERATURE[pInverterId])
 
     def GetPanelMinVoltage(self, pInverterId: int):
-        ParsedData = self.GetJson(f'/api/livedata/status?inv={SERIAL_NUMBER[pInverterId]}')
+        DC = self.GetLiveData(pInverterId, 'DC')['DC']
         PanelVDC = []
         ExcludedPanels = GetNumberArray(HOY_BATTERY_IGNORE_PANELS[pInverterId])
-        for i in range(len(ParsedData['inverters'][0]['DC'])):
+        for i in range(len(DC)):
             if i not in ExcludedPanels:
-                PanelVDC.append(float(ParsedData['inverters'][0]['DC'][str(i)]['Voltage']['v']))
+                PanelVDC.append(float(DC[str(i)]['Voltage']['v']))
         minVdc = float('inf')
         for i in range(len(PanelVDC)):
             if (minVdc > PanelVDC[i]) and (PanelVDC[i] > 5):
@@ -1106,8 +2699,8 @@ class OpenDTU(DTU):
     def WaitForAck(self, pInverterId: int, pTimeoutInS: int):
         try:
             timeout = pTimeoutInS
-            timeout_start = time.time()
-            while time.time() < timeout_start + timeout:
+            timeout_start = time.monotonic()
+            while time.monotonic() < timeout_start + timeout:
                 time.sleep(0.5)
                 ParsedData = self.GetJson('/api/limit/status')
                 ack = (ParsedData[SERIAL_NUMBER[pInverterId]]['limit_set_status'] == 'Ok')
@@ -1125,6 +2718,10 @@ class OpenDTU(DTU):
                 logger.error('OpenDTU: Inverter "%s" WaitForAck: "%s"', NAME[pInverterId], e)
             return False
 
+    def GetLimitResolution(self, pInverterId: int):
+        # the limit is sent in whole percent of the inverter rating
+        return max(1, HOY_INVERTER_WATT[pInverterId] / 100)
+
     def SetLimit(self, pInverterId: int, pLimit: int):
         logger.info('OpenDTU: Inverter "%s": setting new limit from %s Watt to %s Watt',NAME[pInverterId],CastToInt(CURRENT_LIMIT[pInverterId]),CastToInt(pLimit))
         relLimit = CastToInt(pLimit / HOY_INVERTER_WATT[pInverterId] * 100)
@@ -1145,8 +2742,8 @@ class OpenDTU(DTU):
             raise Exception(f"Error: SetPowerStatus error: {response['message']}")
 
 class DebugDTU(DTU):
-    def __init__(self, inverter_count: int):
-        super().__init__(inverter_count)
+    def __init__(self, inverter_count: int, inverter_ids: list = None):
+        super().__init__(inverter_count, inverter_ids)
 
     def GetACPower(self, pInverterId):
         return CastToInt(input("Current AC-Power: "))
@@ -1193,6 +2790,120 @@ class DebugDTU(DTU):
         self.Token = '12345'
         logger.info('Debug: Authenticating successful, received Token: %s', self.Token)
 
+class MultiDTU(DTU):
+    """
+    Combines several DTUs (e.g. if one DTU radio can't handle all inverters).
+    Every inverter is handled by the DTU it is connected to, the DTUs are queried and commanded in parallel.
+    """
+    def __init__(self, inverter_count: int, dtus: list):
+        super().__init__(inverter_count)
+        self.dtus = dtus
+        # one pool per calling thread (main loop, meter executor, scheduler): a slow availability probe of the scheduler
+        # must not queue the limit dispatch or the production read behind it
+        self.executors = threading.local()
+
+    def GetExecutor(self) -> ThreadPoolExecutor:
+        if not hasattr(self.executors, 'executor'):
+            self.executors.executor = ThreadPoolExecutor(max_workers=len(self.dtus), thread_name_prefix='dtu-' + threading.current_thread().name)
+        return self.executors.executor
+
+    def GetDTU(self, pInverterId: int) -> DTU:
+        for dtu in self.dtus:
+            if pInverterId in dtu.inverter_ids:
+                return dtu
+        raise Exception(f"Error: no DTU defined for inverter {pInverterId}")
+
+    def RunParallel(self, pFunction, pArgsPerDTU: dict):
+        # run pFunction(dtu, args) for every DTU at once, so a cycle takes as long as the slowest DTU
+        # returns {dtu: result or the exception raised}, the results of the other DTUs are kept
+        Executor = self.GetExecutor()
+        futures = {dtu: Executor.submit(pFunction, dtu, args) for dtu, args in pArgsPerDTU.items()}
+        results = {}
+        for dtu, future in futures.items():
+            try:
+                results[dtu] = future.result()
+            except Exception as e:
+                logger.error('DTU %s (%s): %s', self.dtus.index(dtu) + 1, dtu.__class__.__name__, e)
+                results[dtu] = e
+        return results
+
+    def RunParallelPerInverter(self, pFunction, pArgsPerDTU: dict, pInverterIdsPerDTU: dict):
+        # merges the {inverter id: result} of every DTU, the inverters of a failed DTU get its exception
+        Result = {}
+        for dtu, dtuResult in self.RunParallel(pFunction, pArgsPerDTU).items():
+            if isinstance(dtuResult, Exception):
+                Result.update({pInverterId: dtuResult for pInverterId in pInverterIdsPerDTU[dtu]})
+            else:
+                Result.update(dtuResult)
+        return Result
+
+    def GroupByDTU(self, pInverterIds):
+        groups = {dtu: [] for dtu in self.dtus}
+        for pInverterId in pInverterIds:
+            groups[self.GetDTU(pInverterId)].append(pInverterId)
+        return {dtu: ids for dtu, ids in groups.items() if ids}
+
+    def GetACPower(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetACPower(pInverterId)
+
+    def GetPowermeterWatts(self):
+        Results = self.RunParallel(lambda dtu, args: dtu.GetPowermeterWatts(), {dtu: None for dtu in self.dtus}).values()
+        # the sum is only valid if every DTU answered
+        for Result in Results:
+            if isinstance(Result, Exception):
+                raise Result
+        return sum(Results)
+
+    def CheckMinVersion(self):
+        for dtu in self.dtus:
+            dtu.CheckMinVersion()
+
+    def GetAvailable(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetAvailable(pInverterId)
+
+    def GetAvailableBulk(self, pInverterIds: list):
+        Groups = self.GroupByDTU(pInverterIds)
+        return self.RunParallelPerInverter(lambda dtu, ids: dtu.GetAvailableBulk(ids), Groups, Groups)
+
+    def GetACPowerBulk(self, pInverterIds: list):
+        Groups = self.GroupByDTU(pInverterIds)
+        return self.RunParallelPerInverter(lambda dtu, ids: dtu.GetACPowerBulk(ids), Groups, Groups)
+
+    def GetActualLimitInW(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetActualLimitInW(pInverterId)
+
+    def GetActualLimitsBulk(self, pInverterIds: list):
+        Groups = self.GroupByDTU(pInverterIds)
+        return self.RunParallelPerInverter(lambda dtu, ids: dtu.GetActualLimitsBulk(ids), Groups, Groups)
+
+    def GetInfo(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetInfo(pInverterId)
+
+    def GetTemperature(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetTemperature(pInverterId)
+
+    def GetPanelMinVoltage(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetPanelMinVoltage(pInverterId)
+
+    def WaitForAck(self, pInverterId: int, pTimeoutInS: int):
+        return self.GetDTU(pInverterId).WaitForAck(pInverterId, pTimeoutInS)
+
+    def GetLimitResolution(self, pInverterId: int):
+        return self.GetDTU(pInverterId).GetLimitResolution(pInverterId)
+
+    def SetLimit(self, pInverterId: int, pLimit: int):
+        return self.GetDTU(pInverterId).SetLimit(pInverterId, pLimit)
+
+    def SetLimits(self, pLimits: dict, pTimeoutInS: int):
+        Groups = self.GroupByDTU(pLimits.keys())
+        LimitsPerDTU = {dtu: {i: pLimits[i] for i in ids} for dtu, ids in Groups.items()}
+        Acks = self.RunParallelPerInverter(lambda dtu, limits: dtu.SetLimits(limits, pTimeoutInS), LimitsPerDTU, Groups)
+        # the inverters of a failed DTU are not acknowledged, the limits applied by the other DTUs are kept
+        return {i: ack if not isinstance(ack, Exception) else False for i, ack in Acks.items()}
+
+    def SetPowerStatus(self, pInverterId: int, pActive: bool):
+        return self.GetDTU(pInverterId).SetPowerStatus(pInverterId, pActive)
+
 class Script(Powermeter):
     def __init__(self, file: str, ip: str, user: str, password: str):
         self.file = file
@@ -1201,7 +2912,7 @@ class Script(Powermeter):
         self.password = password
 
     def GetPowermeterWatts(self):
-        power = subprocess.check_output([self.file, self.ip, self.user, self.password])
+        power = subprocess.check_output([self.file, self.ip, self.user, self.password], timeout=REQUEST_DEADLINE_IN_SECONDS)
         return CastToInt(power)
 
 def extract_json_value(data, path):
@@ -1213,7 +2924,42 @@ def extract_json_value(data, path):
     else:
         raise ValueError("No match found for the JSON path")
 
+class SampleBuffer:
+    """
+    Ring buffer of (monotonic timestamp, value) samples. Written by the MQTT thread, read by the main loop without a lock:
+    appending to a deque with maxlen and copying it are atomic in CPython.
+    """
+    def __init__(self, size: int = 256):
+        self.samples = deque(maxlen=size)
+
+    def Add(self, pValue: int):
+        self.samples.append((time.monotonic(), pValue))
+
+    def IsEmpty(self):
+        return len(self.samples) == 0
+
+    def GetLast(self):
+        return self.samples[-1]
+
+    def GetSince(self, pTimestamp: float):
+        return [sample for sample in self.samples.copy() if sample[0] > pTimestamp]
+
+    def GetValueAt(self, pTimestamp: float):
+        # the value that was valid at pTimestamp: the last sample before it (or the first sample if there is none)
+        Samples = self.samples.copy()
+        Result = Samples[0][1]
+        for Timestamp, Value in Samples:
+            if Timestamp > pTimestamp:
+                break
+            Result = Value
+        return Result
+
 class MqttPowermeter(Powermeter):
+    """
+    Every message is kept with its receive time in a SampleBuffer per topic.
+    A reading fails if the last message is older than max_age_in_s (0 = disabled). Incoming and outgoing power are aligned
+    by time, all samples since the last reading are aggregated (last, mean or peak), so no sample is thrown away.
+    """
     def __init__(
         self,
         broker: str,
@@ -1224,6 +2970,8 @@ class MqttPowermeter(Powermeter):
         json_path_outgoing: str = None,
         username: str = None,
         password: str = None,
+        max_age_in_s: float = 0,
+        aggregation: str = "last",
     ):
         self.broker = broker
         self.port = port
@@ -1233,8 +2981,13 @@ class MqttPowermeter(Powermeter):
         self.json_path_outgoing = json_path_outgoing
         self.username = username
         self.password = password
-        self.value_incoming = None
-        self.value_outgoing = None
+        self.max_age_in_s = max_age_in_s
+        if aggregation not in ("last", "mean", "peak"):
+            raise Exception("Error: MQTT_AGGREGATION must be last, mean or peak")
+        self.aggregation = aggregation
+        self.samples_incoming = SampleBuffer()
+        self.samples_outgoing = SampleBuffer()
+        self.last_read = time.monotonic()
 
         # Initialize MQTT client
         import paho.mqtt.client as mqtt
@@ -1261,42 +3014,59 @@ class MqttPowermeter(Powermeter):
         payload = msg.payload.decode()
         try:
             data = json.loads(payload)
+            # incoming and outgoing power may be published on the same topic
             if msg.topic == self.topic_incoming:
-                self.value_incoming = extract_json_value(data, self.json_path_incoming) if self.json_path_incoming else int(float(payload))
-                logger.info('MQTT: Incoming power: %s Watt', self.value_incoming)
-            elif msg.topic == self.topic_outgoing:
-                self.value_outgoing = extract_json_value(data, self.json_path_outgoing) if self.json_path_outgoing else int(float(payload))
-                logger.info('MQTT: Outgoing power: %s Watt', self.value_outgoing)
+                value_incoming = extract_json_value(data, self.json_path_incoming) if self.json_path_incoming else int(float(payload))
+                self.samples_incoming.Add(value_incoming)
+                logger.info('MQTT: Incoming power: %s Watt', value_incoming)
+            if msg.topic == self.topic_outgoing:
+                value_outgoing = extract_json_value(data, self.json_path_outgoing) if self.json_path_outgoing else int(float(payload))
+                self.samples_outgoing.Add(value_outgoing)
+                logger.info('MQTT: Outgoing power: %s Watt', value_outgoing)
         except json.JSONDecodeError:
             print("Failed to decode JSON")
 
     def GetPowermeterWatts(self):
-        if self.value_incoming is None:
-            self.wait_for_message("incoming")
-        if self.topic_outgoing and self.value_outgoing is None:
-            self.wait_for_message("outgoing")
-
-        return self.value_incoming - (self.value_outgoing if self.value_outgoing is not None else 0)
-
-    def wait_for_message(self, message_type, timeout=5):
-        start_time = time.time()
-        while (message_type == "incoming" and self.value_incoming is None) or (message_type == "outgoing" and self.value_outgoing is None):
-            if time.time() - start_time > timeout:
+        self.wait_for_message("incoming", self.samples_incoming)
+        if self.topic_outgoing:
+            self.wait_for_message("outgoing", self.samples_outgoing)
+
+        Samples = self.samples_incoming.GetSince(self.last_read)
+        if not Samples or self.aggregation == "last":
+            Samples = [self.samples_incoming.GetLast()]
+        self.last_read = Samples[-1][0]
+        # grid power of every incoming sample, with the outgoing power that was valid at the same time
+        Values = [value - (self.samples_outgoing.GetValueAt(timestamp) if self.topic_outgoing else 0) for timestamp, value in Samples]
+        if self.aggregation == "mean":
+            return CastToInt(sum(Values) / len(Values))
+        if self.aggregation == "peak":
+            return max(Values)
+        return Values[-1]
+
+    def wait_for_message(self, message_type, samples: SampleBuffer, timeout=5):
+        start_time = time.monotonic()
+        while samples.IsEmpty():
+            if time.monotonic() - start_time > timeout:
                 raise TimeoutError(f"Timeout waiting for MQTT {message_type} message")
-            time.sleep(1)
+            time.sleep(0.1)
+        Age = time.monotonic() - samples.GetLast()[0]
+        if self.max_age_in_s > 0 and Age > self.max_age_in_s:
+            raise TimeoutError(f"MQTT: last {message_type} message is {round(Age, 1)} seconds old (max. {self.max_age_in_s})")
 
-def CreatePowermeter() -> Powermeter:
+def CreatePowermeterOfType(pType: str) -> Powermeter:
     shelly_ip = config.get('SHELLY', 'SHELLY_IP')
     shelly_user = config.get('SHELLY', 'SHELLY_USER')
     shelly_pass = config.get('SHELLY', 'SHELLY_PASS')
     shelly_emeterindex = config.get('SHELLY', 'EMETER_INDEX')
-    if config.getboolean('SELECT_POWERMETER', 'USE_SHELLY_EM'):
-        return ShellyEM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
-    elif config.getboolean('SELECT_POWERMETER', 'USE_SHELLY_3EM'):
-        return Shelly3EM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
-    elif config.getboolean('SELECT_POWERMETER', 'USE_SHELLY_3EM_PRO'):
-        return Shelly3EMPro(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
-    elif config.getboolean('SELECT_POWERMETER', 'USE_TASMOTA'):
+    shelly_use_websocket = config.getboolean('SHELLY', 'SHELLY_USE_WEBSOCKET', fallback=False)
+    shelly_websocket_max_age = config.getfloat('SHELLY', 'SHELLY_WEBSOCKET_MAX_AGE_SECONDS', fallback=30)
+    if pType == 'USE_SHELLY_EM':
+        return ShellyEM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
+    elif pType == 'USE_SHELLY_3EM':
+        return Shelly3EM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
+    elif pType == 'USE_SHELLY_3EM_PRO':
+        return Shelly3EMPro(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
+    elif pType == 'USE_TASMOTA':
         return Tasmota(
             config.get('TASMOTA', 'TASMOTA_IP'),
             config.get('TASMOTA', 'TASMOTA_USER'),
@@ -1308,19 +3078,19 @@ def CreatePowermeter() -> Powermeter:
             config.get('TASMOTA', 'TASMOTA_JSON_POWER_OUTPUT_MQTT_LABEL'),
             config.getboolean('TASMOTA', 'TASMOTA_JSON_POWER_CALCULATE', fallback=False)
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_SHRDZM'):
+    elif pType == 'USE_SHRDZM':
         return Shrdzm(
             config.get('SHRDZM', 'SHRDZM_IP'),
             config.get('SHRDZM', 'SHRDZM_USER'),
             config.get('SHRDZM', 'SHRDZM_PASS')
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_EMLOG'):
+    elif pType == 'USE_EMLOG':
         return Emlog(
             config.get('EMLOG', 'EMLOG_IP'),
             config.get('EMLOG', 'EMLOG_METERINDEX'),
             config.getboolean('EMLOG', 'EMLOG_JSON_POWER_CALCULATE', fallback=False)
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_IOBROKER'):
+    elif pType == 'USE_IOBROKER':
         return IoBroker(
             config.get('IOBROKER', 'IOBROKER_IP'),
             config.get('IOBROKER', 'IOBROKER_PORT'),
@@ -1329,7 +3099,7 @@ def CreatePowermeter() -> Powermeter:
             config.get('IOBROKER', 'IOBROKER_POWER_INPUT_ALIAS'),
             config.get('IOBROKER', 'IOBROKER_POWER_OUTPUT_ALIAS')
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_HOMEASSISTANT'):
+    elif pType == 'USE_HOMEASSISTANT':
         return HomeAssistant(
             config.get('HOMEASSISTANT', 'HA_IP'),
             config.get('HOMEASSISTANT', 'HA_PORT'),
@@ -1338,26 +3108,28 @@ def CreatePowermeter() -> Powermeter:
             config.get('HOMEASSISTANT', 'HA_CURRENT_POWER_ENTITY'),
             config.getboolean('HOMEASSISTANT', 'HA_POWER_CALCULATE'),
             config.get('HOMEASSISTANT', 'HA_POWER_INPUT_ALIAS'),
-            config.get('HOMEASSISTANT', 'HA_POWER_OUTPUT_ALIAS')
+            config.get('HOMEASSISTANT', 'HA_POWER_OUTPUT_ALIAS'),
+            config.getboolean('HOMEASSISTANT', 'HA_USE_WEBSOCKET', fallback=False),
+            config.getfloat('HOMEASSISTANT', 'HA_WEBSOCKET_MAX_AGE_SECONDS', fallback=0)
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_VZLOGGER'):
+    elif pType == 'USE_VZLOGGER':
         return VZLogger(
             config.get('VZLOGGER', 'VZL_IP'),
             config.get('VZLOGGER', 'VZL_PORT'),
             config.get('VZLOGGER', 'VZL_UUID')
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_SCRIPT'):
+    elif pType == 'USE_SCRIPT':
         return Script(
             config.get('SCRIPT', 'SCRIPT_FILE'),
             config.get('SCRIPT', 'SCRIPT_IP'),
             config.get('SCRIPT', 'SCRIPT_USER'),
             config.get('SCRIPT', 'SCRIPT_PASS')
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_AMIS_READER'):
+    elif pType == 'USE_AMIS_READER':
         return AmisReader(
             config.get('AMIS_READER', 'AMIS_READER_IP')
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_MQTT'):
+    elif pType == 'USE_MQTT':
         return MqttPowermeter(
             config.get('MQTT_POWERMETER', 'MQTT_BROKER', fallback=config.get("MQTT_CONFIG", "MQTT_BROKER", fallback=None)),
             config.getint('MQTT_POWERMETER', 'MQTT_PORT', fallback=config.getint("MQTT_CONFIG", "MQTT_PORT", fallback=1883)),
@@ -1366,9 +3138,11 @@ def CreatePowermeter() -> Powermeter:
             config.get('MQTT_POWERMETER', 'MQTT_TOPIC_OUTGOING', fallback=None),
             config.get('MQTT_POWERMETER', 'MQTT_JSON_PATH_OUTGOING', fallback=None),
             config.get('MQTT_POWERMETER', 'MQTT_USERNAME', fallback=config.get('MQTT_CONFIG', 'MQTT_USERNAME', fallback=None)),
-            config.get('MQTT_POWERMETER', 'MQTT_PASSWORD', fallback=config.get('MQTT_CONFIG', 'MQTT_PASSWORD', fallback=None))
+            config.get('MQTT_POWERMETER', 'MQTT_PASSWORD', fallback=config.get('MQTT_CONFIG', 'MQTT_PASSWORD', fallback=None)),
+            config.getfloat('MQTT_POWERMETER', 'MQTT_MAX_AGE_IN_SECONDS', fallback=0),
+            config.get('MQTT_POWERMETER', 'MQTT_AGGREGATION', fallback='last')
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_MODBUS_TCP'):
+    elif pType == 'USE_MODBUS_TCP':
         return ModbusTCP(
             config.get("MODBUS_TCP", "MODBUS_TCP_IP"),
             config.getint("MODBUS_TCP", "MODBUS_TCP_UNIT_ID"),
@@ -1376,16 +3150,49 @@ def CreatePowermeter() -> Powermeter:
             config.get("MODBUS_TCP", "MODBUS_TCP_REGISTER_TYPE"),
             config.getfloat("MODBUS_TCP", "MODBUS_TCP_REGISTER_SCALE")
         )
-    elif config.getboolean('SELECT_POWERMETER', 'USE_DEBUG_READER'):
+    elif pType == 'USE_DEBUG_READER':
         return DebugReader()
     else:
+        raise Exception(f"Error: unknown powermeter {pType}")
+
+POWERMETER_TYPES = [
+    'USE_SHELLY_EM',
+    'USE_SHELLY_3EM',
+    'USE_SHELLY_3EM_PRO',
+    'USE_TASMOTA',
+    'USE_SHRDZM',
+    'USE_EMLOG',
+    'USE_IOBROKER',
+    'USE_HOMEASSISTANT',
+    'USE_VZLOGGER',
+    'USE_SCRIPT',
+    'USE_AMIS_READER',
+    'USE_MQTT',
+    'USE_MODBUS_TCP',
+    'USE_DEBUG_READER'
+]
+
+def CreatePowermeter() -> Powermeter:
+    selected = [pType for pType in POWERMETER_TYPES if config.getboolean('SELECT_POWERMETER', pType, fallback=False)]
+    if not selected:
         raise Exception("Error: no powermeter defined!")
+    if len(selected) == 1 or not config.getboolean('REDUNDANT_POWERMETER', 'USE_REDUNDANT_POWERMETERS', fallback=False):
+        return CreatePowermeterOfType(selected[0])
+    return RedundantPowermeter(
+        [CreatePowermeterOfType(pType) for pType in selected],
+        config.getfloat('REDUNDANT_POWERMETER', 'DEADLINE_IN_SECONDS', fallback=1),
+        config.getint('REDUNDANT_POWERMETER', 'MAX_DEVIATION_WATT', fallback=100),
+        config.getint('REDUNDANT_POWERMETER', 'MAX_FAILURES', fallback=3),
+        config.getfloat('REDUNDANT_POWERMETER', 'DEMOTION_TIME_IN_SECONDS', fallback=300)
+    )
 
 def CreateIntermediatePowermeter(dtu: DTU) -> Powermeter:
     shelly_ip = config.get('INTERMEDIATE_SHELLY', 'SHELLY_IP_INTERMEDIATE')
     shelly_user = config.get('INTERMEDIATE_SHELLY', 'SHELLY_USER_INTERMEDIATE')
     shelly_pass = config.get('INTERMEDIATE_SHELLY', 'SHELLY_PASS_INTERMEDIATE')
     shelly_emeterindex = config.get('INTERMEDIATE_SHELLY', 'EMETER_INDEX')
+    shelly_use_websocket = config.getboolean('INTERMEDIATE_SHELLY', 'SHELLY_USE_WEBSOCKET_INTERMEDIATE', fallback=False)
+    shelly_websocket_max_age = config.getfloat('INTERMEDIATE_SHELLY', 'SHELLY_WEBSOCKET_MAX_AGE_SECONDS_INTERMEDIATE', fallback=30)
     if config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_TASMOTA_INTERMEDIATE'):
         return Tasmota(
             config.get('INTERMEDIATE_TASMOTA', 'TASMOTA_IP_INTERMEDIATE'),
@@ -1399,21 +3206,23 @@ def CreateIntermediatePowermeter(dtu: DTU) -> Powermeter:
             config.getboolean('INTERMEDIATE_TASMOTA', 'TASMOTA_JSON_POWER_CALCULATE_INTERMEDIATE', fallback=False)
         )
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_SHELLY_EM_INTERMEDIATE'):
-        return ShellyEM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
+        return ShellyEM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_SHELLY_3EM_INTERMEDIATE'):
-        return Shelly3EM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
+        return Shelly3EM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_SHELLY_3EM_PRO_INTERMEDIATE'):
-        return Shelly3EMPro(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
+        return Shelly3EMPro(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_SHELLY_1PM_INTERMEDIATE'):
-        return Shelly1PM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
+        return Shelly1PM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_SHELLY_PLUS_1PM_INTERMEDIATE'):
-        return ShellyPlus1PM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex)
+        return ShellyPlus1PM(shelly_ip, shelly_user, shelly_pass, shelly_emeterindex, shelly_use_websocket, shelly_websocket_max_age)
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_ESPHOME_INTERMEDIATE'):
         return ESPHome(
             config.get('INTERMEDIATE_ESPHOME', 'ESPHOME_IP_INTERMEDIATE'),
             config.get('INTERMEDIATE_ESPHOME', 'ESPHOME_PORT_INTERMEDIATE', fallback='80'),
             config.get('INTERMEDIATE_ESPHOME', 'ESPHOME_DOMAIN_INTERMEDIATE'),
-            config.get('INTERMEDIATE_ESPHOME', 'ESPHOME_ID_INTERMEDIATE')
+            config.get('INTERMEDIATE_ESPHOME', 'ESPHOME_ID_INTERMEDIATE'),
+            config.getboolean('INTERMEDIATE_ESPHOME', 'ESPHOME_USE_EVENTS_INTERMEDIATE', fallback=False),
+            config.getfloat('INTERMEDIATE_ESPHOME', 'ESPHOME_EVENTS_MAX_AGE_SECONDS_INTERMEDIATE', fallback=30)
         )
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_SHRDZM_INTERMEDIATE'):
         return Shrdzm(
@@ -1445,7 +3254,9 @@ def CreateIntermediatePowermeter(dtu: DTU) -> Powermeter:
             config.get('INTERMEDIATE_HOMEASSISTANT', 'HA_CURRENT_POWER_ENTITY_INTERMEDIATE'),
             config.getboolean('INTERMEDIATE_HOMEASSISTANT', 'HA_POWER_CALCULATE_INTERMEDIATE', fallback=False),
             config.get('INTERMEDIATE_HOMEASSISTANT', 'HA_POWER_INPUT_ALIAS_INTERMEDIATE', fallback=None),
-            config.get('INTERMEDIATE_HOMEASSISTANT', 'HA_POWER_OUTPUT_ALIAS_INTERMEDIATE', fallback=None)
+            config.get('INTERMEDIATE_HOMEASSISTANT', 'HA_POWER_OUTPUT_ALIAS_INTERMEDIATE', fallback=None),
+            config.getboolean('INTERMEDIATE_HOMEASSISTANT', 'HA_USE_WEBSOCKET_INTERMEDIATE', fallback=False),
+            config.getfloat('INTERMEDIATE_HOMEASSISTANT', 'HA_WEBSOCKET_MAX_AGE_SECONDS_INTERMEDIATE', fallback=0)
         )
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_VZLOGGER_INTERMEDIATE'):
         return VZLogger(
@@ -1469,7 +3280,9 @@ def CreateIntermediatePowermeter(dtu: DTU) -> Powermeter:
             config.get('INTERMEDIATE_MQTT', 'MQTT_TOPIC_OUTGOING', fallback=None),
             config.get('INTERMEDIATE_MQTT', 'MQTT_JSON_PATH_OUTGOING', fallback=None),
             config.get('INTERMEDIATE_MQTT', 'MQTT_USERNAME', fallback=config.get("MQTT_CONFIG", "MQTT_USERNAME", fallback=None)),
-            config.get('INTERMEDIATE_MQTT', 'MQTT_PASSWORD', fallback=config.get("MQTT_CONFIG", "MQTT_PASSWORD", fallback=None))
+            config.get('INTERMEDIATE_MQTT', 'MQTT_PASSWORD', fallback=config.get("MQTT_CONFIG", "MQTT_PASSWORD", fallback=None)),
+            config.getfloat('INTERMEDIATE_MQTT', 'MQTT_MAX_AGE_IN_SECONDS', fallback=0),
+            config.get('INTERMEDIATE_MQTT', 'MQTT_AGGREGATION', fallback='last')
         )
     elif config.getboolean('SELECT_INTERMEDIATE_METER', 'USE_AMIS_READER_INTERMEDIATE'):
         return AmisReader(
@@ -1480,28 +3293,81 @@ def CreateIntermediatePowermeter(dtu: DTU) -> Powermeter:
     else:
         return dtu
 
-def CreateDTU() -> DTU:
-    inverter_count = config.getint('COMMON', 'INVERTER_COUNT')
+def CreateMainDTU(inverter_count: int, inverter_ids: list) -> DTU:
     if config.getboolean('SELECT_DTU', 'USE_AHOY'):
         return AhoyDTU(
             inverter_count,
             config.get('AHOY_DTU', 'AHOY_IP'),
-            config.get('AHOY_DTU', 'AHOY_PASS', fallback='')
+            config.get('AHOY_DTU', 'AHOY_PASS', fallback=''),
+            inverter_ids
         )
     elif config.getboolean('SELECT_DTU', 'USE_OPENDTU'):
         return OpenDTU(
             inverter_count,
             config.get('OPEN_DTU', 'OPENDTU_IP'),
             config.get('OPEN_DTU', 'OPENDTU_USER'),
-            config.get('OPEN_DTU', 'OPENDTU_PASS')
+            config.get('OPEN_DTU', 'OPENDTU_PASS'),
+            inverter_ids,
+            config.getboolean('OPEN_DTU', 'OPENDTU_USE_WEBSOCKET', fallback=False),
+            config.getint('OPEN_DTU', 'OPENDTU_WEBSOCKET_MAX_AGE_SECONDS', fallback=30)
         )
     elif config.getboolean('SELECT_DTU', 'USE_DEBUG'):
         return DebugDTU(
-            inverter_count
+            inverter_count,
+            inverter_ids
         )
     else:
         raise Exception("Error: no DTU defined!")
 
+def CreateAdditionalDTU(inverter_count: int, inverter_ids: list, section: str) -> DTU:
+    if config.getboolean(section, 'USE_AHOY', fallback=False):
+        return AhoyDTU(
+            inverter_count,
+            config.get(section, 'IP'),
+            config.get(section, 'PASS', fallback=''),
+            inverter_ids
+        )
+    elif config.getboolean(section, 'USE_OPENDTU', fallback=False):
+        return OpenDTU(
+            inverter_count,
+            config.get(section, 'IP'),
+            config.get(section, 'USER', fallback=''),
+            config.get(section, 'PASS', fallback=''),
+            inverter_ids,
+            config.getboolean(section, 'USE_WEBSOCKET', fallback=False),
+            config.getint(section, 'WEBSOCKET_MAX_AGE_SECONDS', fallback=30)
+        )
+    elif config.getboolean(section, 'USE_DEBUG', fallback=False):
+        return DebugDTU(
+            inverter_count,
+            inverter_ids
+        )
+    else:
+        raise Exception(f"Error: no DTU defined in section [{section}]!")
+
+def CreateSunPosition() -> SunPosition:
+    latitude = config.get('COMMON', 'LOCATION_LATITUDE', fallback='')
+    longitude = config.get('COMMON', 'LOCATION_LONGITUDE', fallback='')
+    if not latitude or not longitude:
+        return None
+    return SunPosition(float(latitude), float(longitude), config.getfloat('COMMON', 'SUNRISE_SUN_ELEVATION', fallback=-3))
+
+def CreateDTU() -> DTU:
+    inverter_count = config.getint('COMMON', 'INVERTER_COUNT')
+    inverter_dtu = [config.getint('INVERTER_' + str(i + 1), 'DTU', fallback=1) for i in range(inverter_count)]
+    dtu_numbers = sorted(set(inverter_dtu))
+    if dtu_numbers == [1]:
+        return CreateMainDTU(inverter_count, None)
+    dtus = []
+    for dtu_number in dtu_numbers:
+        inverter_ids = [i for i in range(inverter_count) if inverter_dtu[i] == dtu_number]
+        if dtu_number == 1:
+            dtus.append(CreateMainDTU(inverter_count, inverter_ids))
+        else:
+            dtus.append(CreateAdditionalDTU(inverter_count, inverter_ids, 'DTU_' + str(dtu_number)))
+        logger.info('DTU %s: %s, inverters %s', dtu_number, dtus[-1].__class__.__name__, [i + 1 for i in inverter_ids])
+    return MultiDTU(inverter_count, dtus)
+
 # ----- START -----
 logger.info("Author: %s / Script Version: %s",__author__, __version__)
 
@@ -1516,13 +3382,11 @@ logger.info("Config file V %s", VERSION)
 MAX_RETRIES = config.getint('COMMON', 'MAX_RETRIES', fallback=3)
 RETRY_STATUS_CODES = config.get('COMMON', 'RETRY_STATUS_CODES', fallback='500,502,503,504')
 RETRY_BACKOFF_FACTOR = config.getfloat('COMMON', 'RETRY_BACKOFF_FACTOR', fallback=0.1)
-retry = Retry(total=MAX_RETRIES,
-              backoff_factor=RETRY_BACKOFF_FACTOR,
-              status_forcelist=[int(status_code) for status_code in RETRY_STATUS_CODES.split(',')],
-              allowed_methods={"GET", "POST"})
-adapter = HTTPAdapter(max_retries=retry)
-session.mount('http://', adapter)
-session.mount('https://', adapter)
+RETRY_STATUS_CODE_LIST = [int(status_code) for status_code in RETRY_STATUS_CODES.split(',')]
+REQUEST_DEADLINE_IN_SECONDS = config.getfloat('COMMON', 'REQUEST_DEADLINE_IN_SECONDS', fallback=10)
+ADAPTIVE_TIMEOUT_FACTOR = config.getfloat('COMMON', 'ADAPTIVE_TIMEOUT_FACTOR', fallback=3)
+ADAPTIVE_TIMEOUT_MIN_IN_SECONDS = config.getfloat('COMMON', 'ADAPTIVE_TIMEOUT_MIN_IN_SECONDS', fallback=0.5)
+ADAPTIVE_TIMEOUT_MIN_REQUESTS = config.getint('COMMON', 'ADAPTIVE_TIMEOUT_MIN_REQUESTS', fallback=20)
 
 USE_AHOY = config.getboolean('SELECT_DTU', 'USE_AHOY')
 USE_OPENDTU = config.getboolean('SELECT_DTU', 'USE_OPENDTU')
@@ -1530,14 +3394,25 @@ AHOY_IP = config.get('AHOY_DTU', 'AHOY_IP')
 OPENDTU_IP = config.get('OPEN_DTU', 'OPENDTU_IP')
 OPENDTU_USER = config.get('OPEN_DTU', 'OPENDTU_USER')
 OPENDTU_PASS = config.get('OPEN_DTU', 'OPENDTU_PASS')
+DTU_CIRCUIT_BREAKER_THRESHOLD = config.getint('COMMON', 'DTU_CIRCUIT_BREAKER_THRESHOLD', fallback=5)
+DTU_CIRCUIT_BREAKER_RESET_SECONDS = config.getint('COMMON', 'DTU_CIRCUIT_BREAKER_RESET_SECONDS', fallback=60)
 DTU = CreateDTU()
 POWERMETER = CreatePowermeter()
+POWERMETER_FILTER = CreatePowermeterFilter(config)
 INTERMEDIATE_POWERMETER = CreateIntermediatePowermeter(DTU)
 INVERTER_COUNT = config.getint('COMMON', 'INVERTER_COUNT')
-LOOP_INTERVAL_IN_SECONDS = config.getint('COMMON', 'LOOP_INTERVAL_IN_SECONDS')
+AVAILABILITY = InverterAvailability(
+    INVERTER_COUNT,
+    config.getint('COMMON', 'AVAILABILITY_BACKOFF_MIN_SECONDS', fallback=10),
+    config.getint('COMMON', 'AVAILABILITY_BACKOFF_MAX_SECONDS', fallback=300),
+    config.getint('COMMON', 'AVAILABILITY_SUNSET_POWER_THRESHOLD', fallback=5),
+    CreateSunPosition()
+)
+LOOP_INTERVAL_IN_SECONDS = config.getfloat('COMMON', 'LOOP_INTERVAL_IN_SECONDS')
 SET_LIMIT_TIMEOUT_SECONDS = config.getint('COMMON', 'SET_LIMIT_TIMEOUT_SECONDS')
 SET_POWER_STATUS_DELAY_IN_SECONDS = config.getint('COMMON', 'SET_POWER_STATUS_DELAY_IN_SECONDS')
-POLL_INTERVAL_IN_SECONDS = config.getint('COMMON', 'POLL_INTERVAL_IN_SECONDS')
+POLL_INTERVAL_IN_SECONDS = config.getfloat('COMMON', 'POLL_INTERVAL_IN_SECONDS')
+POLL_TIMER = PollTimer(POLL_INTERVAL_IN_SECONDS)
 MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER = config.getint('COMMON', 'MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER')
 SET_POWERSTATUS_CNT = config.getint('COMMON', 'SET_POWERSTATUS_CNT')
 SLOW_APPROX_FACTOR_IN_PERCENT = config.getint('COMMON', 'SLOW_APPROX_FACTOR_IN_PERCENT')
@@ -1590,7 +3465,43 @@ for i in range(INVERTER_COUNT):
     HOY_PANEL_VOLTAGE_LIST.append([])
     HOY_PANEL_MIN_VOLTAGE_HISTORY_LIST.append([])
     HOY_BATTERY_AVERAGE_CNT.append(config.getint('INVERTER_' + str(i + 1), 'HOY_BATTERY_AVERAGE_CNT', fallback=1))
+COMPENSATION = None
+if config.getboolean('COMPENSATION', 'LEARN_COMPENSATION', fallback=False):
+    COMPENSATION = CompensationEstimator(
+        config.getfloat('COMPENSATION', 'FORGETTING_FACTOR', fallback=0.99),
+        config.getint('COMPENSATION', 'MIN_SAMPLES', fallback=10),
+        config.getfloat('COMPENSATION', 'SETTLE_TIME_IN_SECONDS', fallback=10),
+        config.getfloat('COMPENSATION', 'MAX_DEVIATION_IN_PERCENT', fallback=25)
+    )
 SLOW_APPROX_LIMIT = CastToInt(GetMaxWattFromAllInverters() * config.getint('COMMON', 'SLOW_APPROX_LIMIT_IN_PERCENT') / 100)
+LIMIT_SHAPER = LimitCommandShaper(
+    INVERTER_COUNT,
+    config.getint('COMMON', 'LIMIT_MIN_STEP_WATT', fallback=0),
+    config.getfloat('COMMON', 'LIMIT_MIN_INTERVAL_IN_SECONDS', fallback=0)
+)
+PRODUCTION = ProductionEstimate(config.getfloat('COMMON', 'PRODUCTION_ESTIMATE_MAX_AGE_IN_SECONDS', fallback=2))
+# reads the output of the inverters while the main loop reads the powermeter
+METER_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# limit and power status commands are sent from the main loop and the scheduler thread
+DTU_COMMAND_LOCK = threading.RLock()
+# state of the inverters (availability, max watt, limits) changed by the scheduler thread and used by SetLimit
+CONTROLLER_LOCK = threading.RLock()
+HOYMILES_AVAILABLE = False
+CONTROLLER = ControllerState()
+WATCHDOG = Watchdog(CONTROLLER, config.getfloat('COMMON', 'WATCHDOG_TIMEOUT_IN_SECONDS', fallback=60), SET_INVERTER_TO_MIN_ON_POWERMETER_ERROR)
+BATTERY_GOOD = False
+SCHEDULER = TaskScheduler(config.getfloat('COMMON', 'SCHEDULER_JITTER_IN_PERCENT', fallback=10))
+SCHEDULER.AddTask("availability", config.getfloat('COMMON', 'AVAILABILITY_INTERVAL_IN_SECONDS', fallback=60), UpdateHoymilesAvailable)
+SCHEDULER.AddTask("battery", config.getfloat('COMMON', 'BATTERY_INTERVAL_IN_SECONDS', fallback=30), UpdateCheckBattery)
+HTTP_STATISTICS_INTERVAL_IN_SECONDS = config.getfloat('COMMON', 'HTTP_STATISTICS_INTERVAL_IN_SECONDS', fallback=3600)
+if HTTP_STATISTICS_INTERVAL_IN_SECONDS > 0 and HTTP_DEVICES:
+    SCHEDULER.AddTask("http statistics", HTTP_STATISTICS_INTERVAL_IN_SECONDS, LogHttpStatistics)
+CHECKPOINT = None
+if config.get('COMMON', 'CHECKPOINT_FILE', fallback=''):
+    CHECKPOINT = ControllerCheckpoint(config.get('COMMON', 'CHECKPOINT_FILE'), config.getfloat('COMMON', 'CHECKPOINT_MAX_AGE_IN_SECONDS', fallback=600))
+    SCHEDULER.AddTask("checkpoint", config.getfloat('COMMON', 'CHECKPOINT_INTERVAL_IN_SECONDS', fallback=30), SaveCheckpoint)
+if LOG_TEMPERATURE:
+    SCHEDULER.AddTask("temperature", config.getfloat('COMMON', 'TEMPERATURE_INTERVAL_IN_SECONDS', fallback=300), GetHoymilesTemperature)
 
 CONFIG_PROVIDER = ConfigFileConfigProvider(config)
 MQTT = None
@@ -1614,17 +3525,37 @@ if config.has_section("MQTT_CONFIG"):
 
     CONFIG_PROVIDER = ConfigProviderChain([MQTT, CONFIG_PROVIDER])
 
+HTTP_API = None
+if config.has_section("HTTP_API"):
+    HTTP_API = HttpApiHandler(
+        config.get("HTTP_API", "HTTP_API_BIND_ADDRESS", fallback="127.0.0.1"),
+        config.getint("HTTP_API", "HTTP_API_PORT", fallback=8080),
+        config.get("HTTP_API", "HTTP_API_TOKEN", fallback="")
+    )
+    CONFIG_PROVIDER = ConfigProviderChain([HTTP_API, CONFIG_PROVIDER])
+
 try:
     logger.info("---Init---")
     newLimitSetpoint = 0
     DTU.CheckMinVersion()
-    if GetHoymilesAvailable():
-        for i in range(INVERTER_COUNT):
-            SetHoymilesPowerStatus(i, True)
-        newLimitSetpoint = GetMinWattFromAllInverters()
-        SetLimit(newLimitSetpoint)
-        GetHoymilesActualPower()
-        GetCheckBattery()
+    WarmStarted = False
+    if CHECKPOINT is not None:
+        try:
+            WarmStarted = WarmStart()
+        except Exception as e:
+            logger.error('Checkpoint: warm start failed, cold start: %s', e)
+    if WarmStarted:
+        # the inverters keep their power status and limit, regulation continues from the last limit
+        newLimitSetpoint = SetLimit.LastLimit
+    else:
+        UpdateHoymilesAvailable()
+        if HOYMILES_AVAILABLE:
+            for i in range(INVERTER_COUNT):
+                SetHoymilesPowerStatus(i, True)
+            newLimitSetpoint = GetMinWattFromAllInverters()
+            SetLimit(newLimitSetpoint)
+            GetHoymilesActualPower()
+            UpdateCheckBattery()
     GetPowermeterWatts()
 except Exception as e:
     if hasattr(e, 'message'):
@@ -1633,8 +3564,16 @@ except Exception as e:
         logger.error(e)
     time.sleep(LOOP_INTERVAL_IN_SECONDS)
 logger.info("---Start Zero Export---")
+powermeterWatts = None
+hoymilesActualPower = None
+CycleStart = time.monotonic()
+SCHEDULER.Start()
+WATCHDOG.Start()
 
 while True:
+    CycleTime = time.monotonic() - CycleStart
+    CycleStart = time.monotonic()
+    PublishSnapshot(newLimitSetpoint, powermeterWatts, CycleTime)
     CONFIG_PROVIDER.update()
     PublishConfigState()
     on_grid_usage_jump_to_limit_percent = CONFIG_PROVIDER.on_grid_usage_jump_to_limit_percent()
@@ -1643,45 +3582,33 @@ while True:
     powermeter_max_point = CONFIG_PROVIDER.get_powermeter_max_point()
     powermeter_min_point = CONFIG_PROVIDER.get_powermeter_min_point()
     powermeter_tolerance = CONFIG_PROVIDER.get_powermeter_tolerance()
-    if powermeter_max_point < (powermeter_target_point + powermeter_tolerance):
-        powermeter_max_point = powermeter_target_point + powermeter_tolerance + 50
-        logger.info(
-            'Warning: POWERMETER_MAX_POINT < POWERMETER_TARGET_POINT + POWERMETER_TOLERANCE. Setting POWERMETER_MAX_POINT to ' + str(
-                powermeter_max_point))
+    powermeter_max_point = GetPowermeterMaxPoint(powermeter_max_point, powermeter_target_point, powermeter_tolerance)
 
     try:
         PreviousLimitSetpoint = newLimitSetpoint
-        if GetHoymilesAvailable() and GetCheckBattery():
-            if LOG_TEMPERATURE:
-                GetHoymilesTemperature()
-            for x in range(CastToInt(LOOP_INTERVAL_IN_SECONDS / POLL_INTERVAL_IN_SECONDS)):
-                powermeterWatts = GetPowermeterWatts()
-                if powermeterWatts > powermeter_max_point:
-                    if on_grid_usage_jump_to_limit_percent > 0:
-                        newLimitSetpoint = CastToInt(GetMaxInverterWattFromAllInverters() * on_grid_usage_jump_to_limit_percent / 100)
-                        if (newLimitSetpoint <= PreviousLimitSetpoint) and (on_grid_usage_jump_to_limit_percent != 100):
-                            newLimitSetpoint = PreviousLimitSetpoint + powermeterWatts - powermeter_target_point
-                    else:
-                        newLimitSetpoint = PreviousLimitSetpoint + powermeterWatts - powermeter_target_point
-                    newLimitSetpoint = ApplyLimitsToSetpoint(newLimitSetpoint)
-                    SetLimit(newLimitSetpoint)
-                    RemainingDelay = CastToInt((LOOP_INTERVAL_IN_SECONDS / POLL_INTERVAL_IN_SECONDS - x) * POLL_INTERVAL_IN_SECONDS)
-                    if RemainingDelay > 0:
-                        time.sleep(RemainingDelay)
-                        break
-                elif (powermeterWatts < powermeter_min_point) and on_grid_feed_fast_limit_decrease:
-                    newLimitSetpoint = PreviousLimitSetpoint + powermeterWatts - powermeter_target_point
-                    newLimitSetpoint = ApplyLimitsToSetpoint(newLimitSetpoint)
+        if HOYMILES_AVAILABLE and BATTERY_GOOD:
+            # the output of the inverters is needed below: it is read at the same time as the last powermeter poll
+            ReadProduction = (MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER != 100) or (PreviousLimitSetpoint >= GetMaxWattFromAllInverters())
+            POLL_TIMER.Start(LOOP_INTERVAL_IN_SECONDS)
+            while True:
+                Sample = GetMeterSample(ReadProduction and POLL_TIMER.IsLastPoll())
+                powermeterWatts = Sample.grid_watts
+                Triggered, PollSetpoint = GetPollSetpoint(powermeterWatts, PreviousLimitSetpoint, powermeter_target_point, powermeter_max_point, powermeter_min_point,
+                                                          on_grid_usage_jump_to_limit_percent, on_grid_feed_fast_limit_decrease, GetMaxInverterWattFromAllInverters())
+                if Triggered:
+                    newLimitSetpoint = ApplyLimitsToSetpoint(PollSetpoint, GetMinWattFromAllInverters(), GetMaxWattFromAllInverters())
                     SetLimit(newLimitSetpoint)
-                    RemainingDelay = CastToInt((LOOP_INTERVAL_IN_SECONDS / POLL_INTERVAL_IN_SECONDS - x) * POLL_INTERVAL_IN_SECONDS)
-                    if RemainingDelay > 0:
-                        time.sleep(RemainingDelay)
-                        break
-                else:
-                    time.sleep(POLL_INTERVAL_IN_SECONDS)
+                    POLL_TIMER.WaitForLoopEnd()
+                    break
+                elif not POLL_TIMER.WaitForNextPoll():
+                    break
+
+            if ReadProduction:
+                # regulate on the last powermeter poll, the output of the inverters is read separately if the loop interval ended early (fast limit change, slow reading)
+                hoymilesActualPower = Sample.production_watts if Sample.production_watts is not None else GetHoymilesActualPower()
 
             if MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER != 100:
-                CutLimit = CutLimitToProduction(newLimitSetpoint)
+                CutLimit = CutLimitToProduction(newLimitSetpoint, hoymilesActualPower, GetMaxWattFromAllInverters(), MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER)
                 if CutLimit != newLimitSetpoint:
                     newLimitSetpoint = CutLimit
                     PreviousLimitSetpoint = newLimitSetpoint
@@ -1689,40 +3616,19 @@ while True:
             if powermeterWatts > powermeter_max_point:
                 continue
 
-            # producing too much power: reduce limit
-            if powermeterWatts < (powermeter_target_point - powermeter_tolerance):
-                if PreviousLimitSetpoint >= GetMaxWattFromAllInverters():
-                    hoymilesActualPower = GetHoymilesActualPower()
-                    newLimitSetpoint = hoymilesActualPower + powermeterWatts - powermeter_target_point
-                    LimitDifference = abs(hoymilesActualPower - newLimitSetpoint)
-                    if LimitDifference > SLOW_APPROX_LIMIT:
-                        newLimitSetpoint = newLimitSetpoint + (LimitDifference * SLOW_APPROX_FACTOR_IN_PERCENT / 100)
-                    if newLimitSetpoint > hoymilesActualPower:
-                        newLimitSetpoint = hoymilesActualPower
-                    logger.info("overproducing: reduce limit based on actual power")
-                else:
-                    newLimitSetpoint = PreviousLimitSetpoint + powermeterWatts - powermeter_target_point
-                    # check if it is necessary to approximate to the setpoint with some more passes. this reduce overshoot
-                    LimitDifference = abs(PreviousLimitSetpoint - newLimitSetpoint)
-                    if LimitDifference > SLOW_APPROX_LIMIT:
-                        logger.info("overproducing: reduce limit based on previous limit setpoint by approximation")
-                        newLimitSetpoint = newLimitSetpoint + (LimitDifference * SLOW_APPROX_FACTOR_IN_PERCENT / 100)
-                    else:
-                        logger.info("overproducing: reduce limit based on previous limit setpoint")
-
-            # producing too little power: increase limit
-            elif powermeterWatts > (powermeter_target_point + powermeter_tolerance):
-                if PreviousLimitSetpoint < GetMaxWattFromAllInverters():
-                    newLimitSetpoint = PreviousLimitSetpoint + powermeterWatts - powermeter_target_point
-                    logger.info("Not enough energy producing: increasing limit")
-                else:
-                    logger.info("Not enough energy producing: limit already at maximum")
-
+            newLimitSetpoint = GetSetpoint(powermeterWatts, hoymilesActualPower, PreviousLimitSetpoint, newLimitSetpoint, powermeter_target_point, powermeter_tolerance,
+                                           GetMaxWattFromAllInverters(), SLOW_APPROX_LIMIT, SLOW_APPROX_FACTOR_IN_PERCENT)
             # check for upper and lower limits
-            newLimitSetpoint = ApplyLimitsToSetpoint(newLimitSetpoint)
+            newLimitSetpoint = ApplyLimitsToSetpoint(newLimitSetpoint, GetMinWattFromAllInverters(), GetMaxWattFromAllInverters())
             # set new limit to inverter
             SetLimit(newLimitSetpoint)
         else:
+            if IsNight():
+                CONTROLLER.SetState(ControllerState.NIGHT, "all inverters offline after sunset")
+            elif not HOYMILES_AVAILABLE:
+                CONTROLLER.SetState(ControllerState.DEGRADED, "no inverter available")
+            else:
+                CONTROLLER.SetState(ControllerState.DEGRADED, "battery voltage too low")
             if hasattr(SetLimit, "LastLimit"):
                 SetLimit.LastLimit = -1
             time.sleep(LOOP_INTERVAL_IN_SECONDS)
@@ -1732,4 +3638,6 @@ while True:
             logger.error(e.message)
         else:
             logger.error(e)
+        if CONTROLLER.state == ControllerState.REGULATING:
+            CONTROLLER.SetState(ControllerState.DEGRADED, "exception in main loop")
         time.sleep(LOOP_INTERVAL_IN_SECONDS)
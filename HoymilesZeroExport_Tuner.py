@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+# HoymilesZeroExport - https://github.com/reserve85/HoymilesZeroExport
+# Copyright (C) 2023, Tobias Kraft
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline tuning of the control parameters of HoymilesZeroExport.
+
+Replays recorded traces (CSV with the columns "time" in seconds, "grid_watts", "production_watts" and optional
+"available_watts" = power the panels/battery could deliver) through the regulation logic of HoymilesZeroExport.py
+(regulation.py: powermeter filters, setpoint calculation, limit command shaping) and a model of the inverters, for every
+combination of a parameter grid. Prints the Pareto front of exported energy, imported energy and number of limit
+commands and writes the chosen parameters as config file for "--config".
+
+Example:
+    python3 HoymilesZeroExport_Tuner.py trace.csv --grid POWERMETER_TARGET_POINT=-100,-50,0 --output tuned.ini
+    python3 HoymilesZeroExport.py --config tuned.ini
+"""
+
+__author__ = "Tobias Kraft"
+
+import argparse
+import csv
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+from configparser import ConfigParser
+from pathlib import Path
+from regulation import numpy, IsArray, Where, ToInt, CreatePowermeterFilter, GetPowermeterMaxPoint, GetPollSetpoint, CutLimitToProduction, GetSetpoint, ApplyLimitsToSetpoint, IsRelevantLimitChange
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger()
+
+# tuned parameters: config section and default grid
+PARAMETERS = {
+    'POWERMETER_TARGET_POINT': ('CONTROL', [-100, -75, -50, -25, 0]),
+    'POWERMETER_TOLERANCE': ('CONTROL', [10, 25, 50]),
+    'SLOW_APPROX_LIMIT_IN_PERCENT': ('COMMON', [10, 20, 40]),
+    'SLOW_APPROX_FACTOR_IN_PERCENT': ('COMMON', [0, 20, 40]),
+    'ON_GRID_USAGE_JUMP_TO_LIMIT_PERCENT': ('COMMON', [0, 50, 100]),
+}
+
+class Plant:
+    """
+    Fixed part of the simulation, read from the config: inverters, loop timing, POWERMETER_MAX_POINT / POWERMETER_MIN_POINT,
+    limit command shaping, powermeter filters and the time constant of the inverter output after a new limit.
+    All enabled inverters are simulated as one inverter (sum of their limits), the output follows the limit as intended by
+    HOY_COMPENSATE_WATT_FACTOR or the learned compensation.
+    """
+    def __init__(self, config: ConfigParser, response_time_in_s: float):
+        self.max_watt = 0
+        self.inverter_watt = 0
+        self.min_watt = 0
+        for i in range(config.getint('COMMON', 'INVERTER_COUNT')):
+            section = 'INVERTER_' + str(i + 1)
+            if not config.getboolean(section, 'ENABLED', fallback=True):
+                continue
+            max_watt = config.getint(section, 'HOY_MAX_WATT')
+            inverter_watt = config.getint(section, 'HOY_INVERTER_WATT') if config.get(section, 'HOY_INVERTER_WATT', fallback='') != '' else max_watt
+            self.max_watt += max_watt
+            self.inverter_watt += inverter_watt
+            self.min_watt += int(inverter_watt * config.getint(section, 'HOY_MIN_WATT_IN_PERCENT') / 100)
+        self.loop_interval_in_s = config.getfloat('COMMON', 'LOOP_INTERVAL_IN_SECONDS')
+        self.poll_interval_in_s = min(config.getfloat('COMMON', 'POLL_INTERVAL_IN_SECONDS', fallback=self.loop_interval_in_s), self.loop_interval_in_s)
+        self.polls_per_loop = max(1, round(self.loop_interval_in_s / self.poll_interval_in_s))
+        self.max_point = config.getint('CONTROL', 'POWERMETER_MAX_POINT')
+        self.min_point = config.getint('CONTROL', 'POWERMETER_MIN_POINT')
+        self.fast_limit_decrease = config.getboolean('COMMON', 'ON_GRID_FEED_FAST_LIMIT_DECREASE')
+        self.max_difference = config.getint('COMMON', 'MAX_DIFFERENCE_BETWEEN_LIMIT_AND_OUTPUTPOWER')
+        self.limit_min_step_watt = config.getint('COMMON', 'LIMIT_MIN_STEP_WATT', fallback=0)
+        self.limit_min_interval_in_s = config.getfloat('COMMON', 'LIMIT_MIN_INTERVAL_IN_SECONDS', fallback=0)
+        # a new filter pipeline for every simulation
+        self.config = config
+        self.has_filter = CreatePowermeterFilter(config) is not None
+        # fraction of the difference between limit and output closed within one poll interval
+        self.response = 1 - math.exp(-self.poll_interval_in_s / response_time_in_s) if response_time_in_s > 0 else 1
+
+def LoadTrace(pPath: str, pStep: float):
+    # returns (consumption, available) sampled every pStep seconds (last value before each step)
+    Rows = []
+    with open(pPath, newline='') as f:
+        for row in csv.DictReader(f):
+            Available = row.get('available_watts')
+            Rows.append((float(row['time']), float(row['grid_watts']) + float(row['production_watts']),
+                         float(Available) if Available not in (None, '') else math.inf))
+    if len(Rows) < 2:
+        raise Exception(f"Error: trace {pPath} has less than 2 rows")
+    Rows.sort()
+    Consumption = []
+    Available = []
+    Index = 0
+    Time = Rows[0][0]
+    while Time <= Rows[-1][0]:
+        while Index + 1 < len(Rows) and Rows[Index + 1][0] <= Time:
+            Index += 1
+        Consumption.append(Rows[Index][1])
+        Available.append(Rows[Index][2])
+        Time += pStep
+    return Consumption, Available
+
+class SimulatedInverter:
+    """
+    Limit setting of HoymilesZeroExport.py (SetLimit, LimitCommandShaper) and the output of the inverters.
+    All values are numpy arrays (one element per parameter combination) or single values.
+    """
+    def __init__(self, pPlant: Plant, pFull):
+        self.plant = pPlant
+        self.last_limit = pFull(-1)
+        self.limit = pFull(pPlant.min_watt)
+        self.pending = pFull(pPlant.min_watt)
+        self.has_pending = pFull(False)
+        self.last_command = pFull(-math.inf)
+        self.commands = pFull(0)
+        self.output = pFull(0.0)
+
+    def SetLimit(self, pLimit, pTime: float, pActive):
+        Plant = self.plant
+        Limit = ToInt(pLimit)
+        # an already accepted limit only sends the held back limit
+        Send = pActive & Where(Limit == self.last_limit, self.has_pending, True)
+        self.last_limit = Where(pActive, Limit, self.last_limit)
+        Limit = Where(Limit < Plant.min_watt, Plant.min_watt, Limit)
+        Relevant = Send & IsRelevantLimitChange(Limit, self.limit, 1, Plant.min_watt, Plant.max_watt, Plant.limit_min_step_watt)
+        Due = pTime - self.last_command >= Plant.limit_min_interval_in_s
+        Hold = Where(Due, False, Relevant)
+        Sent = Where(Due, Relevant, False)
+        self.pending = Where(Hold, Limit, self.pending)
+        self.has_pending = Where(Send, Hold, self.has_pending)
+        self.limit = Where(Sent, Limit, self.limit)
+        self.last_command = Where(Sent, pTime, self.last_command)
+        self.commands = self.commands + Sent
+
+    def Step(self, pAvailable: float):
+        self.output = self.output + (Where(self.limit < pAvailable, self.limit, pAvailable) - self.output) * self.plant.response
+
+def Simulate(pParameters: dict, pPlant: Plant, pTrace: tuple):
+    """
+    Runs the main loop of HoymilesZeroExport.py with the functions of regulation.py against the trace.
+    The parameters are numpy arrays (all combinations at once) or single values.
+    Returns exported Wh, imported Wh and the number of limit commands.
+    The powermeter filters keep one history for all combinations, so they are only simulated with single values.
+    """
+    Consumption, Available = pTrace
+    Target = pParameters['POWERMETER_TARGET_POINT']
+    Tolerance = pParameters['POWERMETER_TOLERANCE']
+    SlowApproxLimit = ToInt(pPlant.max_watt * pParameters['SLOW_APPROX_LIMIT_IN_PERCENT'] / 100)
+    MaxPoint = GetPowermeterMaxPoint(pPlant.max_point, Target, Tolerance)
+    Filter = CreatePowermeterFilter(pPlant.config)
+
+    def Full(pValue):
+        # a value for every parameter combination
+        return numpy.full(len(Target), pValue) if IsArray(Target) else pValue
+
+    Inverter = SimulatedInverter(pPlant, Full)
+    Exported = Full(0.0)
+    Imported = Full(0.0)
+    Hours = pPlant.poll_interval_in_s / 3600
+    Step = 0
+
+    Setpoint = Full(pPlant.min_watt)
+    PowermeterWatts = Full(0)
+    Inverter.SetLimit(Setpoint, 0, True)
+    while Step + pPlant.polls_per_loop <= len(Consumption):
+        PreviousSetpoint = Setpoint
+        Triggered = Full(False)
+        for _ in range(pPlant.polls_per_loop):
+            if IsArray(Triggered) or not Triggered:
+                Watts = ToInt(Consumption[Step] - Inverter.output)
+                if Filter is not None:
+                    Watts = Filter.Apply(Watts)
+                # a triggered combination keeps the reading of its fast limit change until the end of the loop interval
+                PowermeterWatts = Where(Triggered, PowermeterWatts, Watts)
+                PollTriggered, PollSetpoint = GetPollSetpoint(PowermeterWatts, PreviousSetpoint, Target, MaxPoint, pPlant.min_point,
+                                                              pParameters['ON_GRID_USAGE_JUMP_TO_LIMIT_PERCENT'], pPlant.fast_limit_decrease, pPlant.inverter_watt)
+                PollTriggered = Where(Triggered, False, PollTriggered)
+                Setpoint = Where(PollTriggered, ApplyLimitsToSetpoint(PollSetpoint, pPlant.min_watt, pPlant.max_watt), Setpoint)
+                Inverter.SetLimit(Setpoint, Step * pPlant.poll_interval_in_s, PollTriggered)
+                Triggered = Triggered | PollTriggered
+            # energy of this poll interval (unfiltered), then the output follows the limit
+            Grid = Consumption[Step] - Inverter.output
+            Exported = Exported + Where(Grid < 0, -Grid, 0) * Hours
+            Imported = Imported + Where(Grid > 0, Grid, 0) * Hours
+            Inverter.Step(Available[Step])
+            Step += 1
+
+        # the regulation uses the last powermeter poll
+        ActualPower = ToInt(Inverter.output)
+        if pPlant.max_difference != 100:
+            CutLimit = CutLimitToProduction(Setpoint, ActualPower, pPlant.max_watt, pPlant.max_difference)
+            PreviousSetpoint = Where(CutLimit != Setpoint, CutLimit, PreviousSetpoint)
+            Setpoint = CutLimit
+        Regulate = PowermeterWatts <= MaxPoint
+        NewSetpoint = GetSetpoint(PowermeterWatts, ActualPower, PreviousSetpoint, Setpoint, Target, Tolerance,
+                                  pPlant.max_watt, SlowApproxLimit, pParameters['SLOW_APPROX_FACTOR_IN_PERCENT'])
+        Setpoint = Where(Regulate, ApplyLimitsToSetpoint(NewSetpoint, pPlant.min_watt, pPlant.max_watt), Setpoint)
+        Inverter.SetLimit(Setpoint, Step * pPlant.poll_interval_in_s, Regulate)
+    return Exported, Imported, Inverter.commands
+
+def RunCombinations(pArgs):
+    # worker process: all combinations of one chunk, at once if numpy is installed and no powermeter filter is configured
+    Combinations, Plant, Traces = pArgs
+    # the regulation logs every decision of a single simulation
+    logger.setLevel(logging.WARNING)
+    Names = list(PARAMETERS)
+    if numpy is not None and not Plant.has_filter:
+        Columns = numpy.array(Combinations).T
+        Total = [0, 0, 0]
+        for Trace in Traces:
+            for index, value in enumerate(Simulate(dict(zip(Names, Columns)), Plant, Trace)):
+                Total[index] = Total[index] + value
+        return [(combination, (float(Total[0][index]), float(Total[1][index]), int(Total[2][index]))) for index, combination in enumerate(Combinations)]
+    Results = []
+    for combination in Combinations:
+        Total = [0.0, 0.0, 0]
+        for Trace in Traces:
+            for index, value in enumerate(Simulate(dict(zip(Names, combination)), Plant, Trace)):
+                Total[index] += value
+        Results.append((combination, tuple(Total)))
+    return Results
+
+def GetParetoFront(pResults: list):
+    # results not dominated by any other (lower or equal in all objectives and lower in one)
+    Front = []
+    for combination, objectives in sorted(pResults, key=lambda result: result[1]):
+        if any(all(a <= b for a, b in zip(other, objectives)) and other != objectives for _, other in Front):
+            continue
+        Front.append((combination, objectives))
+    return Front
+
+def SelectBalanced(pFront: list):
+    # smallest sum of the objectives, each scaled to 0...1 over the front
+    Lows = [min(objectives[i] for _, objectives in pFront) for i in range(3)]
+    Highs = [max(objectives[i] for _, objectives in pFront) for i in range(3)]
+    def Score(pObjectives):
+        return sum((pObjectives[i] - Lows[i]) / (Highs[i] - Lows[i]) if Highs[i] > Lows[i] else 0 for i in range(3))
+    return min(range(len(pFront)), key=lambda index: Score(pFront[index][1]))
+
+def WriteOverride(pPath: str, pCombination: tuple, pObjectives: tuple):
+    Override = ConfigParser()
+    Override.optionxform = str
+    for name, value in zip(PARAMETERS, pCombination):
+        Section = PARAMETERS[name][0]
+        if not Override.has_section(Section):
+            Override.add_section(Section)
+        Override.set(Section, name, str(int(value)))
+    with open(pPath, 'w') as f:
+        f.write(f'# written by HoymilesZeroExport_Tuner.py: exported {pObjectives[0]:.1f} Wh, imported {pObjectives[1]:.1f} Wh, {pObjectives[2]} limit commands\n')
+        Override.write(f)
+
+def ParseGrid(pValues: list):
+    Grid = {name: list(values) for name, (section, values) in PARAMETERS.items()}
+    for value in pValues or []:
+        name, _, numbers = value.partition('=')
+        name = name.strip().upper()
+        if name not in Grid:
+            raise Exception(f"Error: unknown parameter {name}, possible: {', '.join(Grid)}")
+        Grid[name] = [int(number) for number in numbers.split(',') if number.strip()]
+    return Grid
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline tuning of the control parameters with recorded traces')
+    parser.add_argument('traces', nargs='+', help='CSV files with the columns time, grid_watts, production_watts [, available_watts]')
+    parser.add_argument('-c', '--config', help='Override configuration file path (inverters and fixed parameters)')
+    parser.add_argument('--grid', action='append', help='values of a parameter, e.g. POWERMETER_TARGET_POINT=-100,-50,0 (can be repeated)')
+    parser.add_argument('--response-time', type=float, default=5, help='time constant of the inverter output after a new limit in seconds (default: 5)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of worker processes (default: all cores)')
+    parser.add_argument('--select', type=int, help='index of the Pareto front entry to write (default: balanced)')
+    parser.add_argument('--output', help='write the selected parameters to this config file, usable with --config')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    baseconfig = str(Path.joinpath(Path(__file__).parent.resolve(), "HoymilesZeroExport_Config.ini"))
+    config.read([baseconfig, args.config] if args.config else baseconfig)
+
+    plant = Plant(config, args.response_time)
+    traces = [LoadTrace(path, plant.poll_interval_in_s) for path in args.traces]
+    grid = ParseGrid(args.grid)
+    combinations = list(itertools.product(*grid.values()))
+    processes = max(1, min(args.processes, len(combinations)))
+    logger.info('%s combinations, %s poll steps, %s processes, vectorized: %s', len(combinations), sum(len(trace[0]) for trace in traces), processes, numpy is not None and not plant.has_filter)
+
+    chunks = [(combinations[i::processes], plant, traces) for i in range(processes)]
+    with multiprocessing.Pool(processes) as pool:
+        results = [result for chunk in pool.map(RunCombinations, chunks) for result in chunk]
+
+    front = GetParetoFront(results)
+    print(f"{'#':>3} " + ' '.join(name for name in grid) + f" {'export Wh':>10} {'import Wh':>10} {'commands':>9}")
+    for index, (combination, objectives) in enumerate(front):
+        print(f'{index:>3} ' + ' '.join(f'{int(value):>{len(name)}}' for name, value in zip(grid, combination)) + f' {objectives[0]:>10.1f} {objectives[1]:>10.1f} {objectives[2]:>9}')
+
+    selected = args.select if args.select is not None else SelectBalanced(front)
+    combination, objectives = front[selected]
+    logger.info('selected #%s: %s', selected, ', '.join(f'{name} = {int(value)}' for name, value in zip(grid, combination)))
+    if args.output:
+        WriteOverride(args.output, combination, objectives)
+        logger.info('written to %s, use it with: python3 HoymilesZeroExport.py --config %s', args.output, args.output)
+
+if __name__ == '__main__':
+    main()
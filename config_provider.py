@@ -1,6 +1,9 @@
+import ipaddress
 import json
 import logging
+import threading
 from configparser import ConfigParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 logger = logging.getLogger()
 
@@ -175,6 +178,10 @@ class OverridingConfigProvider(ConfigProvider):
             if key in ['powermeter_target_point', 'powermeter_max_point', 'powermeter_min_point', 'powermeter_tolerance', 'on_grid_usage_jump_to_limit_percent']:
                 return int(value)
             elif key in ['on_grid_feed_fast_limit_decrease']:
+                if isinstance(value, bytes):
+                    value = value.decode()
+                if isinstance(value, str):
+                    return value.strip().lower() in ['true', '1', 'on', 'yes']
                 return bool(value)
             else:
                 logger.error(f"Unknown common key {key}")
@@ -201,6 +208,28 @@ class OverridingConfigProvider(ConfigProvider):
             self.inverter_config[inverter_idx][name] = cast_value
             logger.info(f"Set inverter {inverter_idx} config value {name} to {cast_value}")
 
+    def set_value_by_path(self, path: str, value):
+        """
+        Sets (or resets with value None) a config value by its path: "<key>" or "inverter/<inverter_idx>/<key>".
+        Returns False if the path or key is unknown.
+        """
+        if path.startswith("inverter/"):
+            inverter_path = path[len("inverter/"):]
+            index_config_start_pos = inverter_path.find("/")
+            if index_config_start_pos == -1:
+                logger.error(f"Invalid inverter config path {path}")
+                return False
+            inverter_idx = int(inverter_path[:index_config_start_pos])
+            key = inverter_path[index_config_start_pos + 1:]
+            if value is not None and self.cast_value(True, key, value) is None:
+                return False
+            self.set_inverter_value(inverter_idx, key, value)
+        else:
+            if value is not None and self.cast_value(False, path, value) is None:
+                return False
+            self.set_common_value(path, value)
+        return True
+
     def get_powermeter_target_point(self):
         return self.common_config.get('powermeter_target_point')
 
@@ -289,39 +318,13 @@ class MqttHandler(OverridingConfigProvider):
         if msg.topic.startswith(self.set_topic):
             topic_suffix = msg.topic[len(self.set_topic) + 1:]
             logger.info(f"Received set message for config value {topic_suffix} with payload {msg.payload}")
-
-            def set_common_value(name):
-                self.set_common_value(name, msg.payload)
-
-            def set_inverter_value(inverter_idx, name):
-                self.set_inverter_value(inverter_idx, name, msg.payload)
-
+            self.set_value_by_path(topic_suffix, msg.payload)
         elif msg.topic.startswith(self.reset_topic):
             topic_suffix = msg.topic[len(self.reset_topic) + 1:]
             logger.info(f"Received reset message for config value {topic_suffix}")
-
-            def set_common_value(name):
-                self.set_common_value(name, None)
-
-            def set_inverter_value(inverter_idx, name):
-                self.set_inverter_value(inverter_idx, name, None)
+            self.set_value_by_path(topic_suffix, None)
         else:
             logger.error(f"Invalid topic {msg.topic}")
-            return
-
-        if topic_suffix.startswith("inverter/"):
-            inverter_topic_suffix = topic_suffix[len("inverter/"):]
-
-            index_config_start_pos = inverter_topic_suffix.index("/")
-            if index_config_start_pos == -1:
-                logger.error(f"Invalid inverter config topic {msg.topic}")
-                return
-
-            inverter = int(inverter_topic_suffix[:index_config_start_pos])
-            key = inverter_topic_suffix[index_config_start_pos + 1:]
-            set_inverter_value(inverter, key)
-        else:
-            set_common_value(topic_suffix)
 
     def cast_value_for_publish(self, value):
         if type(value) == bool:
@@ -355,3 +358,83 @@ class MqttHandler(OverridingConfigProvider):
     def __del__(self):
         logger.info("Disconnecting MQTT client")
         self.mqtt_client.disconnect()
+
+
+class HttpApiHandler(OverridingConfigProvider):
+    """
+    Config provider with a small HTTP API running in its own thread (python standard library only).
+
+    GET  /status                              the last controller snapshot (JSON). It is serialized once per loop cycle
+                                              by publish_snapshot() and served from memory, polling it costs no control loop time.
+    POST /set/<key>                           override a config value, the value is the request body (same keys as MQTT)
+    POST /set/inverter/<inverter_idx>/<key>
+    POST /reset/<key>                         remove an override
+    POST /reset/inverter/<inverter_idx>/<key>
+
+    If a token is configured, POST requests need the header "Authorization: Bearer <token>".
+    Without a token, POST requests are only accepted from the local host.
+    """
+    def __init__(self, host: str, port: int, token: str):
+        super().__init__()
+        self.token = token
+        self.snapshot = b'{}'
+        self.server = ThreadingHTTPServer((host, port), self.create_request_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f"HTTP API listening on {host}:{port}")
+
+    def publish_snapshot(self, snapshot: dict):
+        # replacing the reference is atomic, the request threads always see a complete snapshot
+        self.snapshot = json.dumps(snapshot).encode()
+
+    def create_request_handler(self):
+        api = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def send_json(self, status, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/status":
+                    self.send_json(200, api.snapshot)
+                else:
+                    self.send_json(404, b'{"error": "not found"}')
+
+            def is_authorized(self):
+                if api.token:
+                    return self.headers.get("Authorization") == f"Bearer {api.token}"
+                return ipaddress.ip_address(self.client_address[0]).is_loopback
+
+            def do_POST(self):
+                if not self.is_authorized():
+                    self.send_json(401, b'{"error": "unauthorized"}')
+                    return
+                path = self.path.strip("/")
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    value = self.rfile.read(length).decode().strip()
+                    if path.startswith("set/") and value:
+                        logger.info(f"HTTP API: set config value {path[len('set/'):]} to {value}")
+                        ok = api.set_value_by_path(path[len("set/"):], value)
+                    elif path.startswith("reset/"):
+                        logger.info(f"HTTP API: reset config value {path[len('reset/'):]}")
+                        ok = api.set_value_by_path(path[len("reset/"):], None)
+                    else:
+                        ok = False
+                except (ValueError, UnicodeDecodeError) as e:
+                    logger.error(f"HTTP API: invalid value for {path}: {e}")
+                    ok = False
+                if ok:
+                    self.send_json(200, b'{"result": "ok"}')
+                else:
+                    self.send_json(400, b'{"error": "invalid key or value"}')
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
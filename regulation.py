@@ -0,0 +1,249 @@
+import logging
+import statistics
+import time
+from collections import deque
+from configparser import ConfigParser
+try:
+    # optional, the offline tuner simulates all parameter combinations at once
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger()
+
+# Regulation logic without I/O, used by HoymilesZeroExport.py and the offline tuner (HoymilesZeroExport_Tuner.py).
+# All values can also be numpy arrays (one element per simulated parameter combination), the functions only log for single values.
+
+def IsArray(pValue):
+    return numpy is not None and isinstance(pValue, numpy.ndarray)
+
+def Where(pCondition, pTrue, pFalse):
+    if IsArray(pCondition):
+        return numpy.where(pCondition, pTrue, pFalse)
+    return pTrue if pCondition else pFalse
+
+def ToInt(pValue):
+    if IsArray(pValue):
+        return pValue.astype(numpy.int64)
+    return int(float(pValue))
+
+def Median(pValues):
+    if IsArray(pValues[0]):
+        return numpy.median(numpy.stack(pValues), axis=0)
+    return statistics.median(pValues)
+
+class PowermeterFilter:
+    def Apply(self, pValue: float) -> float:
+        raise NotImplementedError()
+
+class MedianFilter(PowermeterFilter):
+    # median of the last window readings: removes spikes shorter than window/2 readings, delays steps by window/2 readings
+    def __init__(self, window: int):
+        self.values = deque(maxlen=window)
+
+    def Apply(self, pValue):
+        self.values.append(pValue)
+        return Median(self.values)
+
+class HampelFilter(PowermeterFilter):
+    # replaces a reading by the median of the last window readings if it deviates more than threshold * sigma (estimated by the MAD).
+    # Normal readings pass without delay
+    def __init__(self, window: int, threshold: float, min_deviation: float):
+        self.values = deque(maxlen=window)
+        self.threshold = threshold
+        self.min_deviation = min_deviation
+
+    def Apply(self, pValue):
+        self.values.append(pValue)
+        if len(self.values) < 3:
+            return pValue
+        Center = Median(self.values)
+        Sigma = 1.4826 * Median([abs(value - Center) for value in self.values])
+        Outlier = abs(pValue - Center) > Where(self.threshold * Sigma > self.min_deviation, self.threshold * Sigma, self.min_deviation)
+        if not IsArray(Outlier) and Outlier:
+            logger.info('powermeter filter: outlier %s Watt replaced by %s Watt', pValue, Center)
+        return Where(Outlier, Center, pValue)
+
+class EmaFilter(PowermeterFilter):
+    # exponential moving average, alpha = 1: no filtering
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.value = None
+
+    def Apply(self, pValue):
+        self.value = pValue if self.value is None else self.value + self.alpha * (pValue - self.value)
+        return self.value
+
+class KalmanFilter(PowermeterFilter):
+    # one-dimensional Kalman filter (constant power model): a high process noise follows changes faster, a high measurement noise smoothes more
+    def __init__(self, process_noise: float, measurement_noise: float):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.value = None
+        self.variance = 0.0
+
+    def Apply(self, pValue):
+        if self.value is None:
+            self.value = pValue
+            self.variance = self.measurement_noise
+            return pValue
+        self.variance += self.process_noise
+        Gain = self.variance / (self.variance + self.measurement_noise)
+        self.value += Gain * (pValue - self.value)
+        self.variance *= (1 - Gain)
+        return self.value
+
+class FilterPipeline:
+    """
+    Filter stages between the powermeter and the controller, applied in the configured order.
+    The computing time of every stage is measured.
+    """
+    def __init__(self, stages: list):
+        self.stages = stages
+        self.stage_count = [0 for stage in stages]
+        self.stage_time_ns = [0 for stage in stages]
+
+    def Apply(self, pValue: int) -> int:
+        Value = pValue
+        for index, (name, stage) in enumerate(self.stages):
+            Start = time.perf_counter_ns()
+            Value = stage.Apply(Value)
+            self.stage_time_ns[index] += time.perf_counter_ns() - Start
+            self.stage_count[index] += 1
+        return ToInt(Value)
+
+    def GetStatistics(self):
+        return {name: {"count": self.stage_count[index], "avg_us": round(self.stage_time_ns[index] / self.stage_count[index] / 1000, 1) if self.stage_count[index] else None}
+                for index, (name, stage) in enumerate(self.stages)}
+
+def CreatePowermeterFilter(config: ConfigParser) -> FilterPipeline:
+    names = [name.strip().lower() for name in config.get('POWERMETER_FILTER', 'FILTERS', fallback='').split(',') if name.strip()]
+    if not names:
+        return None
+    window = config.getint('POWERMETER_FILTER', 'WINDOW', fallback=5)
+    stages = []
+    for name in names:
+        if name == 'median':
+            stages.append((name, MedianFilter(window)))
+        elif name == 'hampel':
+            stages.append((name, HampelFilter(window, config.getfloat('POWERMETER_FILTER', 'HAMPEL_THRESHOLD', fallback=3), config.getfloat('POWERMETER_FILTER', 'HAMPEL_MIN_DEVIATION_WATT', fallback=50))))
+        elif name == 'ema':
+            stages.append((name, EmaFilter(config.getfloat('POWERMETER_FILTER', 'EMA_ALPHA', fallback=0.5))))
+        elif name == 'kalman':
+            stages.append((name, KalmanFilter(config.getfloat('POWERMETER_FILTER', 'KALMAN_PROCESS_NOISE', fallback=2500), config.getfloat('POWERMETER_FILTER', 'KALMAN_MEASUREMENT_NOISE', fallback=2500))))
+        else:
+            raise Exception(f"Error: unknown powermeter filter {name}")
+    logger.info("powermeter filter: %s", " -> ".join(names))
+    return FilterPipeline(stages)
+
+def GetPowermeterMaxPoint(pMaxPoint: int, pTargetPoint: int, pTolerance: int):
+    TooLow = pMaxPoint < (pTargetPoint + pTolerance)
+    if not IsArray(TooLow) and TooLow:
+        logger.info('Warning: POWERMETER_MAX_POINT < POWERMETER_TARGET_POINT + POWERMETER_TOLERANCE. Setting POWERMETER_MAX_POINT to ' + str(pTargetPoint + pTolerance + 50))
+    return Where(TooLow, pTargetPoint + pTolerance + 50, pMaxPoint)
+
+def GetPollSetpoint(pPowermeterWatts: int, pPreviousSetpoint: int, pTargetPoint: int, pMaxPoint: int, pMinPoint: int,
+                    pJumpToLimitPercent: int, pFastLimitDecrease: bool, pMaxInverterWatt: int):
+    """
+    Immediate reaction within the loop interval: returns (triggered, setpoint). Triggered if the powermeter reading is above pMaxPoint
+    (jump to ON_GRID_USAGE_JUMP_TO_LIMIT_PERCENT of the inverter rating) or below pMinPoint with ON_GRID_FEED_FAST_LIMIT_DECREASE.
+    """
+    Jump = pPowermeterWatts > pMaxPoint
+    FastDecrease = (pPowermeterWatts < pMinPoint) & pFastLimitDecrease
+    Setpoint = pPreviousSetpoint + pPowermeterWatts - pTargetPoint
+    JumpSetpoint = ToInt(pMaxInverterWatt * pJumpToLimitPercent / 100)
+    JumpSetpoint = Where((JumpSetpoint <= pPreviousSetpoint) & (pJumpToLimitPercent != 100), Setpoint, JumpSetpoint)
+    return Jump | FastDecrease, Where(Jump & (pJumpToLimitPercent > 0), JumpSetpoint, Setpoint)
+
+def CutLimitToProduction(pSetpoint, pActualPower, pMaxWatt: int, pMaxDifferencePercent: int):
+    # prevent the setpoint from running away...
+    Cut = (pSetpoint != pMaxWatt) & (pSetpoint > pActualPower + (pMaxWatt * pMaxDifferencePercent / 100))
+    if not IsArray(Cut) and Cut:
+        logger.info('Cut limit to %s Watt, limit was higher than %s percent of live-production', int(pActualPower + (pMaxWatt * pMaxDifferencePercent / 100)), pMaxDifferencePercent)
+    return ToInt(Where(Cut, pActualPower + (pMaxWatt * pMaxDifferencePercent / 100), pSetpoint))
+
+def GetSetpoint(pPowermeterWatts: int, pActualPower: int, pPreviousSetpoint: int, pSetpoint: int, pTargetPoint: int, pTolerance: int,
+                pMaxWatt: int, pSlowApproxLimit: int, pSlowApproxFactorInPercent: int):
+    """
+    Regulation at the end of the loop interval, returns the new setpoint (not yet limited to the min / max watt of the inverters).
+    pActualPower is only used when the previous setpoint is at pMaxWatt, otherwise it can be None.
+    """
+    OverProducing = pPowermeterWatts < (pTargetPoint - pTolerance)
+    UnderProducing = pPowermeterWatts > (pTargetPoint + pTolerance)
+    AtMax = pPreviousSetpoint >= pMaxWatt
+    # producing too much power: reduce limit
+    if pActualPower is not None:
+        ActualSetpoint = pActualPower + pPowermeterWatts - pTargetPoint
+        LimitDifference = abs(pActualPower - ActualSetpoint)
+        ActualSetpoint = Where(LimitDifference > pSlowApproxLimit, ActualSetpoint + (LimitDifference * pSlowApproxFactorInPercent / 100), ActualSetpoint)
+        ActualSetpoint = Where(ActualSetpoint > pActualPower, pActualPower, ActualSetpoint)
+    else:
+        ActualSetpoint = pSetpoint
+    PreviousSetpoint = pPreviousSetpoint + pPowermeterWatts - pTargetPoint
+    # check if it is necessary to approximate to the setpoint with some more passes. this reduce overshoot
+    LimitDifference = abs(pPreviousSetpoint - PreviousSetpoint)
+    Approximate = LimitDifference > pSlowApproxLimit
+    ReducedSetpoint = Where(AtMax, ActualSetpoint, Where(Approximate, PreviousSetpoint + (LimitDifference * pSlowApproxFactorInPercent / 100), PreviousSetpoint))
+    # producing too little power: increase limit
+    IncreasedSetpoint = Where(AtMax, pSetpoint, PreviousSetpoint)
+    if not IsArray(OverProducing):
+        if OverProducing and AtMax:
+            logger.info("overproducing: reduce limit based on actual power")
+        elif OverProducing and Approximate:
+            logger.info("overproducing: reduce limit based on previous limit setpoint by approximation")
+        elif OverProducing:
+            logger.info("overproducing: reduce limit based on previous limit setpoint")
+        elif UnderProducing and not AtMax:
+            logger.info("Not enough energy producing: increasing limit")
+        elif UnderProducing:
+            logger.info("Not enough energy producing: limit already at maximum")
+    return Where(OverProducing, ReducedSetpoint, Where(UnderProducing, IncreasedSetpoint, pSetpoint))
+
+def ApplyLimitsToSetpoint(pSetpoint, pMinWatt: int, pMaxWatt: int):
+    pSetpoint = Where(pSetpoint > pMaxWatt, pMaxWatt, pSetpoint)
+    return Where(pSetpoint < pMinWatt, pMinWatt, pSetpoint)
+
+def IsRelevantLimitChange(pLimit: int, pCurrentLimit: int, pResolution: int, pMinWatt: int, pMaxWatt: int, pMinStepWatt: int):
+    # LIMIT_MIN_STEP_WATT: changes the DTU can't resolve or smaller than the min step are dropped, except to reach the min or max limit
+    Resolved = (pLimit != pCurrentLimit) & (ToInt(pLimit / pResolution) != ToInt(pCurrentLimit / pResolution))
+    return Resolved & ((pLimit <= pMinWatt) | (pLimit >= pMaxWatt) | (abs(pLimit - pCurrentLimit) >= pMinStepWatt))
+
+def WaterFill(pAmount, pLower: list, pUpper: list):
+    # raise all entries from their lower bound by the same fraction of their free capacity (upper - lower) until pAmount is used up
+    Capacity = sum(upper - lower for lower, upper in zip(pLower, pUpper))
+    if Capacity <= 0:
+        return list(pLower)
+    Fraction = max(0.0, min(1.0, pAmount / Capacity))
+    return [lower + (upper - lower) * Fraction for lower, upper in zip(pLower, pUpper)]
+
+def AllocateLimit(pLimit: int, pGroups: list, pMinWatt: dict, pMaxWatt: dict):
+    """
+    Split pLimit on the inverters of pGroups (lists of inverter ids, filled one after the other) in one pass: every inverter
+    gets its min watt, the rest fills the groups in order, within a group proportional to the free capacity (max - min).
+    The watts lost by rounding down go to the inverters with the largest remainders. Only single values, returns {inverter id: watts}.
+    """
+    Inverters = [i for group in pGroups for i in group]
+    # whole watts: an inverter can't take the fraction of a fractional max (e.g. rating / HOY_COMPENSATE_WATT_FACTOR) in the rounding step
+    MaxWatt = {i: max(pMinWatt[i], int(pMaxWatt[i])) for i in Inverters}
+    Output = {i: float(pMinWatt[i]) for i in Inverters}
+    Remaining = pLimit - sum(Output.values())
+    for group in pGroups:
+        if Remaining <= 0:
+            break
+        Lower = [Output[i] for i in group]
+        Filled = WaterFill(Remaining, Lower, [MaxWatt[i] for i in group])
+        for i, watt in zip(group, Filled):
+            Output[i] = watt
+        Remaining -= sum(Filled) - sum(Lower)
+
+    # round down, then give the lost watts to the inverters with the largest remainders
+    Target = int(round(sum(Output.values())))
+    Rounded = {i: int(Output[i]) for i in Inverters}
+    Missing = Target - sum(Rounded.values())
+    for i in sorted(Inverters, key=lambda i: Output[i] - Rounded[i], reverse=True):
+        if Missing <= 0:
+            break
+        if Rounded[i] + 1 <= MaxWatt[i]:
+            Rounded[i] += 1
+            Missing -= 1
+    return Rounded
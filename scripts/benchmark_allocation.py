@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the limit allocation of HoymilesZeroExport (AllocateLimit in regulation.py).
+
+Builds a plant of mixed inverters (non-battery and battery inverters with priority 1..3, different ratings,
+min watts and HOY_COMPENSATE_WATT_FACTOR) and times one complete allocation like CalculateInverterLimits does it:
+bounds per inverter, water-filling, rounding and compensation. Every result is checked to reach the requested
+total in one step.
+
+Example:
+    python3 scripts/benchmark_allocation.py --inverters 16,32,64
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from regulation import AllocateLimit
+
+RATINGS = [300, 400, 600, 800, 1500, 2000]
+FACTORS = [0, 1.0, 1.05, 1.1]
+
+def CreateInverters(pCount: int, pRandom: random.Random):
+    Inverters = []
+    for i in range(pCount):
+        Rating = pRandom.choice(RATINGS)
+        Inverters.append({
+            'rating': Rating,
+            'max_watt': Rating,
+            'min_watt': int(Rating * pRandom.choice([0, 5, 10]) / 100),
+            'factor': pRandom.choice(FACTORS),
+            # every third inverter is a non-battery inverter, the others have battery priority 1..3
+            'priority': 0 if i % 3 == 0 else 1 + i % 3,
+        })
+    return Inverters
+
+def GetMaxOutputWatt(pInverter: dict):
+    # same as the script without learned compensation
+    if pInverter['factor'] <= 0:
+        return pInverter['max_watt']
+    return max(pInverter['min_watt'], min(pInverter['max_watt'], pInverter['rating'] / pInverter['factor']))
+
+def CalculateInverterLimits(pLimit: int, pInverters: list):
+    Groups = [[i for i, inverter in enumerate(pInverters) if inverter['priority'] == priority] for priority in range(6)]
+    Groups = [group for group in Groups if group]
+    Inverters = [i for group in Groups for i in group]
+    Output = AllocateLimit(pLimit, Groups, {i: pInverters[i]['min_watt'] for i in Inverters}, {i: GetMaxOutputWatt(pInverters[i]) for i in Inverters})
+    Limits = {}
+    for i in Inverters:
+        Factor = pInverters[i]['factor']
+        Limits[i] = min(pInverters[i]['rating'], int(round(Output[i] * Factor))) if Factor > 0 else Output[i]
+    return Output, Limits
+
+def Benchmark(pCount: int, pRuns: int, pSeed: int):
+    Random = random.Random(pSeed)
+    Inverters = CreateInverters(pCount, Random)
+    MinTotal = sum(inverter['min_watt'] for inverter in Inverters)
+    MaxTotal = sum(int(GetMaxOutputWatt(inverter)) for inverter in Inverters)
+    Targets = [Random.randint(MinTotal, MaxTotal) for _ in range(pRuns)]
+    Start = time.perf_counter()
+    Results = [CalculateInverterLimits(target, Inverters) for target in Targets]
+    Elapsed = time.perf_counter() - Start
+    Missed = sum(1 for target, (output, limits) in zip(Targets, Results) if sum(output.values()) != target)
+    return Elapsed / pRuns, Missed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the limit allocation across inverters')
+    parser.add_argument('--inverters', default='16,32,64', help='comma separated numbers of inverters (default: 16,32,64)')
+    parser.add_argument('--runs', type=int, default=2000, help='allocations per number of inverters (default: 2000)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random plant and targets (default: 1)')
+    args = parser.parse_args()
+    print(f'{"inverters":>9} {"us/allocation":>14} {"missed target":>14}')
+    for Count in [int(value) for value in args.inverters.split(',')]:
+        Time, Missed = Benchmark(Count, args.runs, args.seed)
+        print(f'{Count:>9} {Time * 1e6:>14.1f} {Missed:>14}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Local stand-in for the web server of an ESPHome device with a power sensor (intermediate meter).
+
+Sends the Server-Sent Events stream /events like ESPHome: "retry", a "ping" event, a "state" event for
+every new value and keep-alive comments. Every event is written in several chunks that split lines (and
+the JSON) at random positions, so the reader has to put the lines together. The REST endpoint
+/sensor/<id> answers with the current value.
+
+Run:
+    python3 scripts/standin/esphome.py --port 8084 --sensor power [--drop-after 20] [--stall-after 20]
+
+Config:
+    [SELECT_INTERMEDIATE_METER]   USE_ESPHOME_INTERMEDIATE = true
+    [INTERMEDIATE_ESPHOME]        ESPHOME_IP_INTERMEDIATE = 127.0.0.1
+                                  ESPHOME_PORT_INTERMEDIATE = 8084
+                                  ESPHOME_DOMAIN_INTERMEDIATE = sensor
+                                  ESPHOME_ID_INTERMEDIATE = power
+                                  ESPHOME_USE_EVENTS_INTERMEDIATE = true
+                                  ESPHOME_EVENTS_MAX_AGE_SECONDS_INTERMEDIATE = 5
+"""
+import json
+import random
+import time
+
+from standin import StandInHandler, logger, run, watts
+
+
+class ESPHomeHandler(StandInHandler):
+    def sensor_state(self):
+        value = watts(300)
+        return {'id': f'sensor-{self.options.sensor}', 'value': value, 'state': f'{value} W'}
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):X}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def write_split(self, text: str):
+        # one event in up to four pieces, cut anywhere
+        data = text.encode()
+        cuts = sorted(random.sample(range(1, len(data)), min(3, len(data) - 1)))
+        for start, end in zip([0] + cuts, cuts + [len(data)]):
+            self.write_chunk(data[start:end])
+            time.sleep(0.01)
+
+    def do_GET(self):
+        path = self.path_only
+        if path == '/events':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.close_connection = True
+            logger.info('%s: event stream %s connected', self.address_string(), path)
+            self.write_split(f'retry: 3000\nid: {int(time.time())}\nevent: ping\ndata: {json.dumps({"title": "standin", "lang": "en"})}\n\n')
+            pushes = [0]
+
+            def push():
+                pushes[0] += 1
+                if pushes[0] % 5 == 0:
+                    self.write_split(': keepalive\n\n')
+                self.write_split(f'event: state\ndata: {json.dumps(self.sensor_state())}\n\n')
+            self.push_loop(None, push)
+        elif path == f'/sensor/{self.options.sensor}':
+            self.send_json(self.sensor_state())
+        else:
+            self.send_json({'message': 'not found'}, 404)
+
+
+def add_arguments(parser):
+    parser.add_argument('--sensor', default='power', help='object id of the power sensor')
+
+
+if __name__ == '__main__':
+    run(ESPHomeHandler, 'ESPHome stand-in', 8084, add_arguments)
@@ -0,0 +1,92 @@
+"""
+Local stand-in for the Home Assistant API with power sensors.
+
+Answers the websocket API /api/websocket like Home Assistant: "auth_required", authentication with the
+access token, then "subscribe_entities" gets the result, one event with the complete states ("a") and
+afterwards events with the changes ("c"). The REST endpoint /api/states/<entity> needs the same token.
+
+Run:
+    python3 scripts/standin/homeassistant.py --port 8123 --token secret --entity sensor.power [--drop-after 20] [--stall-after 20]
+
+Config:
+    [SELECT_POWERMETER]   USE_HOMEASSISTANT = true
+    [HOMEASSISTANT]       HA_IP = 127.0.0.1
+                          HA_PORT = 8123
+                          HA_ACCESS_TOKEN = secret
+                          HA_CURRENT_POWER_ENTITY = sensor.power
+                          HA_USE_WEBSOCKET = true
+                          HA_WEBSOCKET_MAX_AGE_SECONDS = 5
+"""
+import json
+
+from standin import StandInHandler, run, watts
+
+
+def state(entity_id: str):
+    # entities with "output" or "feed" in their name are the export side of a calculated power
+    return str(watts(100 if ('output' in entity_id or 'feed' in entity_id) else 400))
+
+
+class HomeAssistantHandler(StandInHandler):
+    def do_GET(self):
+        path = self.path_only
+        if path == '/api/websocket':
+            ws = self.accept_websocket()
+            if ws is not None:
+                self.serve_websocket(ws)
+        elif self.headers.get('Authorization') != f'Bearer {self.options.token}':
+            self.send_json({'message': 'Unauthorized'}, 401)
+        elif path.startswith('/api/states/'):
+            entity_id = path[len('/api/states/'):]
+            if entity_id in self.options.entity:
+                self.send_json({'entity_id': entity_id, 'state': state(entity_id), 'attributes': {'unit_of_measurement': 'W'}})
+            else:
+                self.send_json({'message': 'Entity not found.'}, 404)
+        else:
+            self.send_json({'message': 'Not found'}, 404)
+
+    def serve_websocket(self, ws):
+        ws.send({'type': 'auth_required', 'ha_version': '2024.6.0'})
+        try:
+            message = json.loads(ws.receive())
+        except (OSError, ValueError):
+            return
+        if message.get('type') != 'auth' or message.get('access_token') != self.options.token:
+            # Home Assistant closes the connection after a failed authentication
+            ws.send({'type': 'auth_invalid', 'message': 'Invalid access token or password'})
+            ws.abort()
+            return
+        ws.send({'type': 'auth_ok', 'ha_version': '2024.6.0'})
+        subscription = {}
+
+        def on_message(message):
+            request = json.loads(message)
+            if request.get('type') == 'subscribe_entities':
+                entity_ids = [entity_id for entity_id in request.get('entity_ids', self.options.entity) if entity_id in self.options.entity]
+                ws.send({'id': request['id'], 'type': 'result', 'success': True, 'result': None})
+                ws.send({'id': request['id'], 'type': 'event', 'event': {'a': {entity_id: {'s': state(entity_id), 'a': {'unit_of_measurement': 'W'}, 'lc': 0} for entity_id in entity_ids}}})
+                subscription['id'] = request['id']
+                subscription['entity_ids'] = entity_ids
+            else:
+                ws.send({'id': request.get('id'), 'type': 'result', 'success': False, 'error': {'code': 'unknown_command', 'message': 'Unknown command.'}})
+
+        def push():
+            if 'id' in subscription:
+                changes = {entity_id: {'+': {'s': state(entity_id), 'lc': 0}} for entity_id in subscription['entity_ids']}
+                ws.send({'id': subscription['id'], 'type': 'event', 'event': {'c': changes}})
+
+        self.push_loop(ws, push, on_message)
+
+
+def add_arguments(parser):
+    parser.add_argument('--token', default='secret')
+    parser.add_argument('--entity', action='append', help='entity id of a power sensor, can be given more than once')
+
+
+def set_default_entities(options):
+    if not options.entity:
+        options.entity = ['sensor.power']
+
+
+if __name__ == '__main__':
+    run(HomeAssistantHandler, 'Home Assistant stand-in', 8123, add_arguments, set_default_entities)
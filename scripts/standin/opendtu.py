@@ -0,0 +1,105 @@
+"""
+Local stand-in for an OpenDTU with one or more inverters.
+
+Pushes the live data of all inverters over the websocket /livedata and answers the REST endpoints
+HoymilesZeroExport uses (live data, version, limit status, limit and power commands). A new limit is
+acknowledged and the simulated AC power follows it.
+
+Run:
+    python3 scripts/standin/opendtu.py --port 8081 --inverters 2 [--drop-after 20] [--stall-after 20]
+
+Config:
+    [SELECT_DTU]          USE_OPENDTU = true
+    [OPEN_DTU]            OPENDTU_IP = 127.0.0.1:8081
+                          OPENDTU_USE_WEBSOCKET = true
+                          OPENDTU_WEBSOCKET_MAX_AGE_SECONDS = 5
+    [INVERTER_1] ...      HOY_INVERTER_WATT = 600 (--inverter-watt)
+"""
+import json
+import threading
+from urllib.parse import parse_qs
+
+from standin import StandInHandler, run, watts
+
+LOCK = threading.Lock()
+INVERTERS = []
+
+
+def create_inverters(options):
+    for i in range(options.inverters):
+        INVERTERS.append({'serial': f'11418{i:07d}', 'name': f'HM-{options.inverter_watt} #{i + 1}', 'limit_relative': 100.0, 'producing': True})
+
+
+def live_data(inverter, options):
+    limit = options.inverter_watt * inverter['limit_relative'] / 100
+    power = max(0, min(limit, watts(int(limit * 0.9)))) if inverter['producing'] else 0
+    return {
+        'serial': inverter['serial'],
+        'name': inverter['name'],
+        'reachable': True,
+        'producing': inverter['producing'],
+        'limit_relative': inverter['limit_relative'],
+        'AC': {'0': {'Power': {'v': power, 'u': 'W', 'd': 1}}},
+        'INV': {'0': {'Temperature': {'v': 31.4, 'u': '°C', 'd': 1}}},
+        'DC': {str(i): {'Power': {'v': round(power / 2, 1), 'u': 'W', 'd': 1}, 'Voltage': {'v': 34.5, 'u': 'V', 'd': 1}} for i in range(2)},
+    }
+
+
+def find_inverter(serial):
+    for inverter in INVERTERS:
+        if inverter['serial'] == serial:
+            return inverter
+    return None
+
+
+class OpenDTUHandler(StandInHandler):
+    def do_GET(self):
+        path = self.path_only
+        if path == '/livedata':
+            ws = self.accept_websocket()
+            if ws is not None:
+                # like OpenDTU, each push contains the complete live data of the inverters
+                def push():
+                    with LOCK:
+                        message = {'inverters': [live_data(inverter, self.options) for inverter in INVERTERS]}
+                    ws.send(message)
+                self.push_loop(ws, push)
+        elif path == '/api/livedata/status':
+            serial = self.query().get('inv')
+            with LOCK:
+                inverters = [inverter for inverter in INVERTERS if serial is None or inverter['serial'] == serial]
+                self.send_json({'inverters': [live_data(inverter, self.options) for inverter in inverters]})
+        elif path == '/api/system/status':
+            self.send_json({'git_hash': 'v24.6.10', 'hostname': 'OpenDTU-StandIn'})
+        elif path == '/api/limit/status':
+            with LOCK:
+                self.send_json({inverter['serial']: {'limit_relative': inverter['limit_relative'], 'max_power': self.options.inverter_watt, 'limit_set_status': 'Ok'} for inverter in INVERTERS})
+        else:
+            self.send_json({'type': 'error', 'message': 'not found'}, 404)
+
+    def do_POST(self):
+        try:
+            data = json.loads(parse_qs(self.read_body())['data'][0])
+            with LOCK:
+                inverter = find_inverter(str(data['serial']))
+                if inverter is None:
+                    raise KeyError(data['serial'])
+                if self.path_only == '/api/limit/config':
+                    inverter['limit_relative'] = float(data['limit_value'])
+                elif self.path_only == '/api/power/config':
+                    inverter['producing'] = bool(data.get('power', True))
+                else:
+                    self.send_json({'type': 'error', 'message': 'not found'}, 404)
+                    return
+            self.send_json({'type': 'success', 'message': 'Settings saved!'})
+        except (KeyError, ValueError) as e:
+            self.send_json({'type': 'warning', 'message': f'Invalid request: {e}'})
+
+
+def add_arguments(parser):
+    parser.add_argument('--inverters', type=int, default=1)
+    parser.add_argument('--inverter-watt', type=int, default=600)
+
+
+if __name__ == '__main__':
+    run(OpenDTUHandler, 'OpenDTU stand-in', 8081, add_arguments, create_inverters)
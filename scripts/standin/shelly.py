@@ -0,0 +1,121 @@
+"""
+Local stand-in for a Shelly "Generation 2" device (Pro 3EM "em:0" and Plus 1PM "switch:0").
+
+Answers the RPC websocket /rpc like the device: with --password, the first request of a connection gets the
+401 digest challenge and the request has to be repeated with the SHA-256 "auth" object. Every request with
+"src" subscribes the connection to NotifyStatus, which only contains the changed fields of a component.
+The REST endpoints /rpc/EM.GetStatus and /rpc/Switch.GetStatus use HTTP digest authentication (SHA-256).
+
+Run:
+    python3 scripts/standin/shelly.py --port 8082 --password secret [--drop-after 20] [--stall-after 20]
+
+Config:
+    [SELECT_POWERMETER]   USE_SHELLY_3EM_PRO = true
+    [SHELLY]              SHELLY_IP = 127.0.0.1:8082
+                          SHELLY_USER = admin
+                          SHELLY_PASS = secret
+                          SHELLY_USE_WEBSOCKET = true
+                          SHELLY_WEBSOCKET_MAX_AGE_SECONDS = 5
+"""
+import hashlib
+import json
+import re
+import secrets
+import time
+
+from standin import StandInHandler, run, watts
+
+DEVICE_ID = 'shellypro3em-standin'
+REALM = DEVICE_ID
+
+
+def sha256(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def em_status():
+    phases = [watts(150), watts(-400), watts(100)]
+    return {'id': 0, 'a_act_power': phases[0], 'b_act_power': phases[1], 'c_act_power': phases[2], 'total_act_power': sum(phases)}
+
+
+def switch_status():
+    return {'id': 0, 'output': True, 'apower': watts(250)}
+
+
+class ShellyHandler(StandInHandler):
+    def ha1(self):
+        return sha256(f'{self.options.user}:{REALM}:{self.options.password}')
+
+    def check_rpc_auth(self, auth, nonce):
+        # digest of the RPC protocol: the second part is always "dummy_method:dummy_uri"
+        if not isinstance(auth, dict) or auth.get('nonce') != nonce or auth.get('username') != self.options.user:
+            return False
+        ha2 = sha256('dummy_method:dummy_uri')
+        expected = sha256(f'{self.ha1()}:{nonce}:{auth.get("nc", 1)}:{auth.get("cnonce")}:auth:{ha2}')
+        return auth.get('response') == expected
+
+    def check_http_auth(self):
+        fields = dict(re.findall(r'(\w+)="?([^",]*)"?', self.headers.get('Authorization', '')))
+        if not self.headers.get('Authorization', '').startswith('Digest ') or fields.get('realm') != REALM:
+            return False
+        ha2 = sha256(f'{self.command}:{fields.get("uri")}')
+        expected = sha256(f'{self.ha1()}:{fields.get("nonce")}:{fields.get("nc")}:{fields.get("cnonce")}:{fields.get("qop")}:{ha2}')
+        return fields.get('response') == expected
+
+    def do_GET(self):
+        path = self.path_only
+        if path == '/rpc':
+            ws = self.accept_websocket()
+            if ws is not None:
+                self.serve_rpc(ws)
+            return
+        if self.options.password and not self.check_http_auth():
+            body = b'401 Unauthorized'
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', f'Digest qop="auth", realm="{REALM}", nonce="{secrets.token_hex(8)}", algorithm=SHA-256')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/rpc/EM.GetStatus':
+            self.send_json(em_status())
+        elif path == '/rpc/Switch.GetStatus':
+            self.send_json(switch_status())
+        else:
+            self.send_json({'code': 404, 'message': 'No handler for ' + path}, 404)
+
+    def serve_rpc(self, ws):
+        nonce = int(time.time())
+        subscriber = {}
+
+        def on_message(message):
+            request = json.loads(message)
+            reply = {'id': request.get('id'), 'src': DEVICE_ID, 'dst': request.get('src')}
+            if self.options.password and not self.check_rpc_auth(request.get('auth'), nonce):
+                challenge = {'auth_type': 'digest', 'nonce': nonce, 'nc': 1, 'realm': REALM, 'algorithm': 'SHA-256'}
+                reply['error'] = {'code': 401, 'message': json.dumps(challenge)}
+            elif request.get('method') == 'Shelly.GetStatus':
+                reply['result'] = {'em:0': em_status(), 'switch:0': switch_status()}
+                if request.get('src'):
+                    subscriber['src'] = request['src']
+            else:
+                reply['error'] = {'code': 404, 'message': f'No handler for {request.get("method")}'}
+            ws.send(reply)
+
+        def push():
+            if 'src' not in subscriber:
+                return
+            # notifications only contain the changed fields
+            em = em_status()
+            params = {'ts': round(time.time(), 2), 'em:0': {'id': 0, 'total_act_power': em['total_act_power']}, 'switch:0': {'id': 0, 'apower': switch_status()['apower']}}
+            ws.send({'src': DEVICE_ID, 'dst': subscriber['src'], 'method': 'NotifyStatus', 'params': params})
+
+        self.push_loop(ws, push, on_message)
+
+
+def add_arguments(parser):
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--password', default='')
+
+
+if __name__ == '__main__':
+    run(ShellyHandler, 'Shelly Gen2 stand-in', 8082, add_arguments)
@@ -0,0 +1,201 @@
+"""
+Shared code of the local device stand-ins in this folder.
+
+The stand-ins answer the REST endpoints HoymilesZeroExport polls and push values over the same websocket or
+event stream as the real device, so the push readers can be tried without the hardware. They only use the
+standard library and listen on 127.0.0.1; point the IP of the device in the config at 127.0.0.1:<port>.
+
+Every stand-in accepts:
+    --port          port to listen on
+    --interval      seconds between two pushed values
+    --drop-after    close every push connection abruptly after this many seconds (the reader has to reconnect)
+    --stall-after   stop pushing after this many seconds but keep the connection open (the reader has to
+                    drop the stale value after its max age and poll instead)
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger()
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+def abort(connection: socket.socket):
+    # drop the TCP connection without closing the stream, like a device that reboots or loses WiFi.
+    # close() alone would wait for the file objects of the handler.
+    try:
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class WebSocket:
+    """
+    Server side of a websocket connection (RFC 6455): text frames only, no extensions, pings are answered.
+    """
+    def __init__(self, handler: BaseHTTPRequestHandler):
+        self.rfile = handler.rfile
+        self.wfile = handler.wfile
+        self.connection = handler.connection
+        self.send_lock = threading.Lock()
+
+    def send_frame(self, opcode: int, payload: bytes):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack('!H', len(payload))
+        else:
+            header += bytes([127]) + struct.pack('!Q', len(payload))
+        with self.send_lock:
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def send(self, message):
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        self.send_frame(0x1, message.encode())
+
+    def read_exactly(self, count: int):
+        data = self.rfile.read(count)
+        if len(data) < count:
+            raise ConnectionError('connection closed')
+        return data
+
+    def receive(self):
+        # returns the next text message, control frames are handled here
+        while True:
+            first, second = self.read_exactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self.read_exactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self.read_exactly(8))[0]
+            mask = self.read_exactly(4) if second & 0x80 else bytes(4)
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.read_exactly(length)))
+            if opcode == 0x8:
+                try:
+                    self.send_frame(0x8, payload[:2])
+                except OSError:
+                    pass
+                raise ConnectionError('closed by client')
+            if opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode in (0x1, 0x2):
+                return payload.decode()
+
+    def abort(self):
+        abort(self.connection)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s', self.address_string(), format % args)
+
+    @property
+    def path_only(self):
+        return urlparse(self.path).path
+
+    def query(self):
+        return {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def accept_websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_json({'message': 'websocket expected'}, 400)
+            return None
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        logger.info('%s: websocket %s connected', self.address_string(), self.path_only)
+        return WebSocket(self)
+
+    def push_loop(self, ws: WebSocket, push, on_message=None):
+        # calls push() every interval until the client disconnects, honouring --drop-after and --stall-after.
+        # Incoming websocket messages (and pings) are read by a second thread and passed to on_message.
+        # Without a websocket (event streams) a failing push() ends the loop.
+        closed = threading.Event()
+
+        def read():
+            try:
+                while True:
+                    message = ws.receive()
+                    if on_message is not None:
+                        on_message(message)
+            except (OSError, ValueError):
+                pass
+            closed.set()
+        if ws is not None:
+            threading.Thread(target=read, daemon=True).start()
+
+        connected = time.monotonic()
+        try:
+            while not closed.is_set():
+                elapsed = time.monotonic() - connected
+                if self.options.drop_after and elapsed >= self.options.drop_after:
+                    logger.info('%s: dropping the connection', self.address_string())
+                    abort(self.connection)
+                    return
+                if not (self.options.stall_after and elapsed >= self.options.stall_after):
+                    push()
+                closed.wait(self.options.interval)
+        except OSError:
+            pass
+        logger.info('%s: client disconnected', self.address_string())
+
+
+def watts(base: int):
+    # some noise around a base value, so every push is visibly a new reading
+    return base + random.randint(-25, 25)
+
+
+def run(handler, description: str, default_port: int, add_arguments=None, setup=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--interval', type=float, default=1)
+    parser.add_argument('--drop-after', type=float, default=0)
+    parser.add_argument('--stall-after', type=float, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    if add_arguments is not None:
+        add_arguments(parser)
+    handler.options = parser.parse_args()
+    if setup is not None:
+        setup(handler.options)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.DEBUG if handler.options.verbose else logging.INFO)
+    server = ThreadingHTTPServer(('127.0.0.1', handler.options.port), handler)
+    server.daemon_threads = True
+    logger.info('%s listening on 127.0.0.1:%s', description, handler.options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass